@@ -2,76 +2,242 @@ import sqlite3
 import hashlib
 import secrets
 import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import logging
+from db_pool import get_pool
+
+# Thời gian tối đa (giây) một token được tin từ cache. Mỗi process (file_manager, server) có cache
+# riêng nên logout ở process này được process kia thấy chậm nhất sau khoảng thời gian này.
+TOKEN_CACHE_TTL = int(os.environ.get('AUTH_TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 4096))
+# Số thread hash mật khẩu chạy song song (PBKDF2/scrypt của hashlib nhả GIL nên dùng thread là đủ)
+PASSWORD_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', os.cpu_count() or 2))
+# Số yêu cầu được xếp hàng chờ thêm; quá số này login bị từ chối ngay thay vì giữ worker Flask
+PASSWORD_HASH_QUEUE = int(os.environ.get('AUTH_HASH_QUEUE', PASSWORD_HASH_WORKERS * 2))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('AUTH_HASH_TIMEOUT', 10))
+
+class TokenCache:
+    """LRU cache token -> user có TTL, không giữ quá thời điểm hết hạn của session"""
+    
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_size=TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # token -> (user, hết hạn theo time.monotonic())
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return dict(entry[0])
+            if entry:
+                del self._entries[token]
+            self.misses += 1
+            return None
+    
+    def put(self, token, user, session_expires_at=None):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        lifetime = self.ttl
+        if session_expires_at:
+            try:
+                remaining = (datetime.fromisoformat(str(session_expires_at)) - datetime.now()).total_seconds()
+                lifetime = min(lifetime, remaining)
+            except ValueError:
+                pass
+        if lifetime <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (dict(user), time.monotonic() + lifetime)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, token):
+        with self._lock:
+            if self._entries.pop(token, None):
+                self.invalidations += 1
+    
+    def invalidate_user(self, user_id):
+        with self._lock:
+            tokens = [token for token, (user, _) in self._entries.items() if user['id'] == user_id]
+            for token in tokens:
+                del self._entries[token]
+            self.invalidations += len(tokens)
+    
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl
+            }
+
+class PasswordHashBusy(Exception):
+    """Pool hash mật khẩu đã đầy (hoặc chờ quá lâu) - route nên trả 503 kèm Retry-After"""
+
+class PasswordHashPool:
+    """Pool thread riêng cho hash/verify mật khẩu, giới hạn số việc đang chạy + đang chờ"""
+    
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, queue_size=PASSWORD_HASH_QUEUE, timeout=PASSWORD_HASH_TIMEOUT):
+        self.workers = max(0, workers)
+        self.capacity = self.workers + max(0, queue_size)
+        self.timeout = timeout
+        # workers=0: hash ngay trong thread gọi (như trước đây)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pwhash') if self.workers else None
+        self._slots = threading.BoundedSemaphore(self.capacity) if self.workers else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+    
+    def run(self, fn, *args, wait=False):
+        """Chạy fn(*args) trong pool và trả kết quả.
+        
+        wait=False: pool đầy thì báo PasswordHashBusy ngay (login); wait=True: chờ slot tối đa timeout giây.
+        """
+        if self._executor is None:
+            return fn(*args)
+        admitted = self._slots.acquire(timeout=self.timeout) if wait else self._slots.acquire(blocking=False)
+        if not admitted:
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHashBusy()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._finished(None)
+            raise
+        # Slot chỉ được trả khi hash thật sự xong, kể cả khi người gọi đã bỏ cuộc vì timeout
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHashBusy()
+    
+    def _finished(self, future):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._slots.release()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
 
 class AuthDatabase:
-    def __init__(self, db_path="auth.db"):
+    def __init__(self, db_path="auth.db", token_cache_ttl=TOKEN_CACHE_TTL, token_cache_size=TOKEN_CACHE_SIZE,
+                 hash_pool=None):
         self.db_path = db_path
+        # Connection dùng lại giữa các request (WAL, busy_timeout) - xem db_pool.py
+        self.pool = get_pool(self.db_path)
+        # Cache kết quả xác thực token để login_required / WS auth không JOIN auth.db mỗi request
+        self.token_cache = TokenCache(ttl=token_cache_ttl, max_size=token_cache_size)
+        # Hash mật khẩu chạy trong pool giới hạn để login dồn dập không chiếm hết worker của app
+        self.hash_pool = hash_pool or PasswordHashPool()
         self.init_database()
     
     def init_database(self):
         """Khởi tạo database với các bảng cần thiết"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Tạo bảng users
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'user',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-        
-        # Tạo bảng files (cập nhật từ JSON sang SQL)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS files (
-                id TEXT PRIMARY KEY,
-                filename TEXT NOT NULL,
-                original_filename TEXT NOT NULL,
-                path TEXT NOT NULL,
-                size INTEGER,
-                mimetype TEXT,
-                user_id INTEGER NOT NULL,
-                folder_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (folder_id) REFERENCES folders (id)
-            )
-        ''')
-        
-        # Tạo bảng folders (cập nhật từ JSON sang SQL)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS folders (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                path TEXT NOT NULL,
-                parent_id TEXT,
-                user_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (parent_id) REFERENCES folders (id)
-            )
-        ''')
-        
-        # Tạo bảng sessions để quản lý đăng nhập
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                token TEXT UNIQUE NOT NULL,
-                expires_at TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Tạo bảng users
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    role TEXT DEFAULT 'user',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_login TIMESTAMP
+                )
+            ''')
+            
+            # Migration: hạn mức dung lượng riêng của user (NULL = theo role, xem quota.py)
+            user_columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+            if 'storage_quota' not in user_columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN storage_quota INTEGER')
+            
+            # Tạo bảng files (cập nhật từ JSON sang SQL)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    original_filename TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER,
+                    mimetype TEXT,
+                    user_id INTEGER NOT NULL,
+                    folder_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (folder_id) REFERENCES folders (id)
+                )
+            ''')
+            
+            # Tạo bảng folders (cập nhật từ JSON sang SQL)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS folders (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    parent_id TEXT,
+                    user_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (parent_id) REFERENCES folders (id)
+                )
+            ''')
+            
+            # Tạo bảng sessions để quản lý đăng nhập
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    token TEXT UNIQUE NOT NULL,
+                    expires_at TIMESTAMP NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Tra cứu token kèm hạn dùng và user_id ngay trên index (covering), dọn session theo user / hết hạn
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_token_expires ON sessions(token, expires_at, user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+            
+            conn.commit()
         logging.info("Database initialized successfully")
     
     def hash_password(self, password):
@@ -116,52 +282,45 @@ class AuthDatabase:
     
     def create_user(self, username, password, role='user'):
         """Tạo user mới"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        password_hash = self.hash_pool.run(self.hash_password, password, wait=True)
         
         try:
-            password_hash = self.hash_password(password)
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, role)
-                VALUES (?, ?, ?)
-            ''', (username, password_hash, role))
-            
-            user_id = cursor.lastrowid
-            conn.commit()
+            with self.pool.connection() as conn:
+                cursor = conn.execute('''
+                    INSERT INTO users (username, password_hash, role)
+                    VALUES (?, ?, ?)
+                ''', (username, password_hash, role))
+                
+                user_id = cursor.lastrowid
             logging.info(f"User created: {username} (ID: {user_id})")
             return user_id
         except sqlite3.IntegrityError:
             logging.warning(f"Username already exists: {username}")
             return None
-        finally:
-            conn.close()
     
     def authenticate_user(self, username, password):
         """Xác thực user login"""
         # SECURITY FIX: Do not log sensitive data
         logging.info(f"🔍 AUTH: Authentication attempt for username: {username}")
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, username, password_hash, role
-            FROM users 
-            WHERE username = ?
-        ''', (username,))
-        
-        user = cursor.fetchone()
+        with self.pool.connection() as conn:
+            user = conn.execute('''
+                SELECT id, username, password_hash, role
+                FROM users 
+                WHERE username = ?
+            ''', (username,)).fetchone()
         logging.debug(f"🔍 AUTH: User found in DB: {user is not None}")
         
+        # Hash password (tốn CPU) sau khi đã trả connection về pool
         if user:
             logging.debug(f"🔍 AUTH: User details: ID={user[0]}, username='{user[1]}', role='{user[3]}'")
             # SECURITY FIX: Do not log password hash
             
-            password_valid = self.verify_password(password, user[2])
+            # Pool đầy -> PasswordHashBusy, route login trả 503
+            password_valid = self.hash_pool.run(self.verify_password, password, user[2])
             logging.debug(f"🔍 AUTH: Password verification: {password_valid}")
             
             if password_valid:
-                conn.close()
                 # Update last login
                 self.update_last_login(user[0])
                 return {
@@ -170,23 +329,17 @@ class AuthDatabase:
                     'role': user[3]
                 }
         
-        conn.close()
         print(f"🔍 AUTH: Authentication failed for username='{username}'")
         return None
     
     def update_last_login(self, user_id):
         """Cập nhật thời gian login cuối"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET last_login = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE users 
+                SET last_login = CURRENT_TIMESTAMP 
+                WHERE id = ?
+            ''', (user_id,))
     
     def create_session(self, user_id):
         """Tạo session token cho user"""
@@ -197,76 +350,74 @@ class AuthDatabase:
         from datetime import datetime, timedelta
         expires_at = datetime.now() + timedelta(hours=24)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO sessions (id, user_id, token, expires_at)
-            VALUES (?, ?, ?, ?)
-        ''', (session_id, user_id, token, expires_at))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            conn.execute('''
+                INSERT INTO sessions (id, user_id, token, expires_at)
+                VALUES (?, ?, ?, ?)
+            ''', (session_id, user_id, token, expires_at))
         
         return token
     
     def get_user_by_token(self, token):
-        """Lấy thông tin user từ session token"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT u.id, u.username, u.role, s.expires_at
-            FROM users u
-            JOIN sessions s ON u.id = s.user_id
-            WHERE s.token = ? AND s.expires_at > CURRENT_TIMESTAMP
-        ''', (token,))
+        """Lấy thông tin user từ session token (qua token cache)"""
+        if not token:
+            return None
+        user = self.token_cache.get(token)
+        if user:
+            return user
         
-        result = cursor.fetchone()
-        conn.close()
+        with self.pool.connection() as conn:
+            result = conn.execute('''
+                SELECT u.id, u.username, u.role, s.expires_at, u.storage_quota
+                FROM users u
+                JOIN sessions s ON u.id = s.user_id
+                WHERE s.token = ? AND s.expires_at > CURRENT_TIMESTAMP
+            ''', (token,)).fetchone()
         
         if result:
-            return {
+            user = {
                 'id': result[0],
                 'username': result[1],
                 'role': result[2],
-                'expires_at': result[3]
+                'expires_at': result[3],
+                'storage_quota': result[4]
             }
+            self.token_cache.put(token, user, session_expires_at=result[3])
+            return user
         return None
     
+    def get_token_cache_stats(self):
+        """Số liệu hit/miss của token cache"""
+        return self.token_cache.stats()
+    
     def invalidate_session(self, token):
         """Xóa session (logout)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM sessions WHERE token = ?', (token,))
-        
-        conn.commit()
-        conn.close()
+        self.token_cache.invalidate(token)
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
     
-    def cleanup_expired_sessions(self):
-        """Dọn dẹp các session hết hạn"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM sessions WHERE expires_at <= CURRENT_TIMESTAMP')
-        
-        conn.commit()
-        conn.close()
+    def cleanup_expired_sessions(self, batch_size=500):
+        """Dọn dẹp các session hết hạn (theo lô, mỗi lô một transaction), trả về số session đã xóa"""
+        deleted_count = 0
+        while True:
+            with self.pool.transaction() as conn:
+                cursor = conn.execute('''
+                    DELETE FROM sessions WHERE rowid IN (
+                        SELECT rowid FROM sessions WHERE expires_at <= CURRENT_TIMESTAMP LIMIT ?
+                    )
+                ''', (batch_size,))
+            deleted_count += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted_count
     
     def get_all_users(self):
         """Lấy danh sách tất cả users (cho admin)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, username, role, created_at, last_login
-            FROM users
-            ORDER BY id ASC
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
+        with self.pool.connection() as conn:
+            results = conn.execute('''
+                SELECT id, username, role, created_at, last_login, storage_quota
+                FROM users
+                ORDER BY id ASC
+            ''').fetchall()
         
         users = []
         for row in results:
@@ -275,49 +426,64 @@ class AuthDatabase:
                 'username': row[1], 
                 'role': row[2],
                 'created_at': row[3],
-                'last_login': row[4]
+                'last_login': row[4],
+                'storage_quota': row[5]
             })
         
         return users
     
+    def get_user_counts(self):
+        """Đếm tổng số users và số users đã từng đăng nhập (cho admin stats)"""
+        with self.pool.connection() as conn:
+            total_users, active_users = conn.execute(
+                'SELECT COUNT(*), COUNT(last_login) FROM users'
+            ).fetchone()
+        
+        return {
+            'total_users': total_users,
+            'active_users': active_users
+        }
+    
     def delete_user(self, user_id):
         """Xóa user (cho admin)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Xóa sessions của user trước
-        cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-        
-        # Xóa user
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
+        with self.pool.transaction() as conn:
+            # Xóa sessions của user trước
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            
+            # Xóa user
+            cursor = conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            success = cursor.rowcount > 0
         
+        self.token_cache.invalidate_user(user_id)
+        return success
+    
+    def set_user_quota(self, user_id, quota_bytes):
+        """Đặt hạn mức dung lượng riêng cho user (None = dùng hạn mức theo role)"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('UPDATE users SET storage_quota = ? WHERE id = ?', (quota_bytes, user_id))
+            success = cursor.rowcount > 0
+        
+        # User đang đăng nhập thấy hạn mức mới ngay (token cache giữ bản sao thông tin user)
+        self.token_cache.invalidate_user(user_id)
         return success
     
     def reset_password(self, user_id, new_password):
         """Reset password của user (cho admin)"""
-        password_hash = self.hash_password(new_password)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET password_hash = ?
-            WHERE id = ?
-        ''', (password_hash, user_id))
-        
-        success = cursor.rowcount > 0
-        
-        # Xóa tất cả sessions của user để force re-login
-        cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        password_hash = self.hash_pool.run(self.hash_password, new_password, wait=True)
+        
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE users 
+                SET password_hash = ?
+                WHERE id = ?
+            ''', (password_hash, user_id))
+            
+            success = cursor.rowcount > 0
+            
+            # Xóa tất cả sessions của user để force re-login
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
         
+        self.token_cache.invalidate_user(user_id)
         return success
 
 # Test function để tạo admin user
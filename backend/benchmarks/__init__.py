@@ -0,0 +1 @@
+"""Benchmark scripts cho backend - chạy từ thư mục backend: python -m benchmarks.<tên_module>"""
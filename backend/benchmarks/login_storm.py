@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmark login storm: nhiều client login cùng lúc (đa số sai mật khẩu) trong khi vài user
+đang liệt kê file. Đo p99 của /api/login và /api/files ở hai chế độ:
+  - unprotected: hash mật khẩu ngay trong worker, không throttle (cách cũ)
+  - protected:   pool hash giới hạn + admission control + throttle theo tài khoản/IP
+
+App Flask chạy trong process này với số worker giới hạn (giống gunicorn) trên database tạm.
+
+Chạy: python -m benchmarks.login_storm --duration 10 --storm-threads 48
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from werkzeug.serving import make_server
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+class BoundedWorkers:
+    """WSGI middleware: tối đa `workers` request được xử lý cùng lúc, giống số worker của gunicorn.
+    Header X-Bench-Client được dùng làm REMOTE_ADDR để giả lập nhiều IP.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.slots = threading.Semaphore(workers)
+
+    def __call__(self, environ, start_response):
+        environ['REMOTE_ADDR'] = environ.get('HTTP_X_BENCH_CLIENT', environ['REMOTE_ADDR'])
+        with self.slots:
+            return list(self.app(environ, start_response))
+
+
+def request(port, method, path, body=None, headers=None):
+    """Gửi một request, trả về (status, thời gian ms)"""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        conn.request(method, path, body=payload, headers={'Content-Type': 'application/json', **(headers or {})})
+        response = conn.getresponse()
+        response.read()
+        status = response.status
+    except (OSError, http.client.HTTPException):
+        status = 0
+    finally:
+        conn.close()
+    return status, (time.perf_counter() - start) * 1000
+
+
+def run_phase(port, accounts, reader_token, args, storm):
+    """Chạy readers (+ storm nếu bật) trong args.duration giây"""
+    stop = threading.Event()
+    lock = threading.Lock()
+    login_times, files_times = [], []
+    login_status, files_status = Counter(), Counter()
+
+    def storm_client(index):
+        rng = random.Random(index)
+        # Mỗi client giả lập một máy trạm; vài client chung một IP (NAT văn phòng)
+        ip = f"10.0.{index % 8}.{index}"
+        while not stop.is_set():
+            username, password = rng.choice(accounts)
+            if rng.random() >= args.valid_ratio:
+                password = 'wrong-password'
+            status, elapsed = request(port, 'POST', '/api/login', {'username': username, 'password': password},
+                                      {'X-Bench-Client': ip})
+            with lock:
+                login_times.append(elapsed)
+                login_status[status] += 1
+
+    def reader():
+        while not stop.is_set():
+            status, elapsed = request(port, 'GET', '/api/files?limit=100',
+                                      headers={'Authorization': f"Bearer {reader_token}"})
+            with lock:
+                files_times.append(elapsed)
+                files_status[status] += 1
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(args.readers)]
+    if storm:
+        threads += [threading.Thread(target=storm_client, args=(i,), daemon=True) for i in range(args.storm_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'login_requests': len(login_times),
+        'login_p50_ms': statistics.median(login_times) if login_times else 0.0,
+        'login_p99_ms': percentile(login_times, 0.99),
+        'login_status': dict(login_status),
+        'files_requests': len(files_times),
+        'files_p50_ms': statistics.median(files_times) if files_times else 0.0,
+        'files_p99_ms': percentile(files_times, 0.99),
+        'files_status': dict(files_status),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark login storm vs file listing latency")
+    parser.add_argument('--duration', type=float, default=10, help="Số giây mỗi pha")
+    parser.add_argument('--accounts', type=int, default=20, help="Số tài khoản bị login dồn dập")
+    parser.add_argument('--storm-threads', type=int, default=48, help="Số client login đồng thời")
+    parser.add_argument('--valid-ratio', type=float, default=0.2, help="Tỉ lệ login đúng mật khẩu")
+    parser.add_argument('--readers', type=int, default=4, help="Số client liệt kê file đồng thời")
+    parser.add_argument('--files', type=int, default=500, help="Số file của user đọc")
+    parser.add_argument('--app-workers', type=int, default=16, help="Số request app xử lý cùng lúc")
+    parser.add_argument('--mode', choices=['both', 'protected', 'unprotected'], default='both')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.TemporaryDirectory(prefix="login_storm_")
+    # files.db / auth.db mặc định nằm ở thư mục hiện tại - chuyển sang thư mục tạm trước khi import app
+    backend_dir = os.getcwd()
+    sys.path.insert(0, backend_dir)
+    os.chdir(tmp_dir.name)
+    try:
+        import file_manager
+        from auth_database import PasswordHashPool
+        from login_throttle import LoginThrottle
+
+        auth_db, db = file_manager.auth_db, file_manager.db
+        accounts = []
+        for i in range(args.accounts):
+            username, password = f"staff{i}", f"password-{i}"
+            auth_db.create_user(username, password)
+            accounts.append((username, password))
+        reader_id = auth_db.create_user("reader", "reader-password")
+        reader_token = auth_db.create_session(reader_id)
+        for i in range(args.files):
+            file_id = db.add_file(f"{i}_doc.pdf", f"doc_{i}.pdf", 1000 + i, "reader", reader_id)
+            db.update_file_status(file_id, "completed", f"reader/doc_{i}.pdf")
+
+        # Log mỗi lần login sai làm chậm chính benchmark
+        logging.disable(logging.WARNING)
+
+        server = make_server('127.0.0.1', 0, BoundedWorkers(file_manager.app, args.app_workers), threaded=True)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        modes = ['unprotected', 'protected'] if args.mode == 'both' else [args.mode]
+        results = {'baseline': run_phase(port, accounts, reader_token, args, storm=False)}
+        for mode in modes:
+            if mode == 'unprotected':
+                auth_db.hash_pool = PasswordHashPool(workers=0)
+                file_manager.login_throttle = LoginThrottle(account_limit=0, ip_limit=0)
+            else:
+                auth_db.hash_pool = PasswordHashPool()
+                file_manager.login_throttle = LoginThrottle()
+            results[mode] = run_phase(port, accounts, reader_token, args, storm=True)
+            results[mode]['hash_pool'] = auth_db.hash_pool.stats()
+            results[mode]['throttle'] = file_manager.login_throttle.stats()
+        server.shutdown()
+    finally:
+        os.chdir(backend_dir)
+        tmp_dir.cleanup()
+
+    print(f"\n{'phase':<14}{'login p50/p99 ms':>22}{'files p50/p99 ms':>22}{'logins':>8}{'lists':>8}  login statuses")
+    for phase, r in results.items():
+        print(f"{phase:<14}{r['login_p50_ms']:>10.1f}/{r['login_p99_ms']:<11.1f}"
+              f"{r['files_p50_ms']:>10.1f}/{r['files_p99_ms']:<11.1f}"
+              f"{r['login_requests']:>8}{r['files_requests']:>8}  {r['login_status']}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark tìm kiếm tên file: FileDatabase.search_files (tự chọn FTS5 hoặc quét theo user),
+FTS5 trigram ép buộc, và LIKE '%q%' không xếp hạng (cách cũ) trên bảng files
+
+Chạy: python -m benchmarks.search_bench --rows 1000000
+      python -m benchmarks.search_bench --rows 1000000 --users 1   # một catalog lớn
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from database import FileDatabase, get_file_extension, vietnam_now_isoformat
+
+WORDS = [
+    'report', 'invoice', 'photo', 'holiday', 'project', 'budget', 'meeting', 'notes', 'draft', 'final',
+    'backup', 'contract', 'design', 'lecture', 'assignment', 'video', 'music', 'scan', 'receipt', 'plan',
+    'bao_cao', 'hop_dong', 'tai_lieu', 'bai_giang', 'do_an', 'hinh_anh', 'nhom8', 'slide', 'thesis', 'data',
+]
+EXTENSIONS = ['.pdf', '.docx', '.xlsx', '.jpg', '.png', '.mp4', '.zip', '.txt', '.csv', '.pptx']
+
+# (mô tả, query, mode, extension)
+QUERIES = [
+    ('substring', 'voic', 'substring', None),
+    ('substring (rare)', 'nhom8_contract', 'substring', None),
+    ('prefix', 'budget', 'prefix', None),
+    ('extension', None, 'substring', '.pdf'),
+    ('substring + extension', 'lecture', 'substring', '.pptx'),
+    ('short query (LIKE fallback)', 'ba', 'substring', None),
+]
+
+
+def random_filename(rng):
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    return f"{'_'.join(words)}_{rng.randint(1, 99999)}{rng.choice(EXTENSIONS)}"
+
+
+def populate(db, rows, users, seed=8):
+    """Sinh `rows` files phân bố đều cho `users` users (insert theo lô trong một transaction)"""
+    rng = random.Random(seed)
+    now = vietnam_now_isoformat()
+    batch = []
+    with sqlite3.connect(db.db_path) as conn:
+        for user_id in range(1, users + 1):
+            conn.execute(
+                "INSERT INTO folders (id, name, path, user_id) VALUES (?, ?, ?, ?)",
+                (f"folder-{user_id}", 'tai_lieu', f"user{user_id}/tai_lieu", user_id)
+            )
+        for i in range(rows):
+            name = random_filename(rng)
+            user_id = i % users + 1
+            folder_id = f"folder-{user_id}" if i % 4 == 0 else None
+            batch.append((f"{i}_{name}", name, get_file_extension(name), rng.randint(1, 10 ** 8),
+                          user_id, folder_id, now, now))
+            if len(batch) >= 10000:
+                conn.executemany("""
+                    INSERT INTO files (filename, original_filename, extension, size, user_id, status, folder_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, 'completed', ?, ?, ?)
+                """, batch)
+                batch = []
+        if batch:
+            conn.executemany("""
+                INSERT INTO files (filename, original_filename, extension, size, user_id, status, folder_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 'completed', ?, ?, ?)
+            """, batch)
+        conn.commit()
+
+
+def like_scan(db, user_id, query, mode, extension, limit):
+    """Cách cũ: LIKE trên bảng files (không dùng được index cho '%q%')"""
+    conditions = ["status != 'deleted'", "user_id = ?"]
+    params = [user_id]
+    if query:
+        conditions.append("original_filename LIKE ?")
+        params.append(f"{query}%" if mode == 'prefix' else f"%{query}%")
+    if extension:
+        conditions.append("extension = ?")
+        params.append(extension)
+    with sqlite3.connect(db.db_path) as conn:
+        return conn.execute(
+            f"SELECT * FROM files WHERE {' AND '.join(conditions)} ORDER BY created_at DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+
+
+def measure(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'results': len(result['files']) if isinstance(result, dict) else len(result),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FTS5 trigram filename search")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="Số files sinh ra")
+    parser.add_argument('--users', type=int, default=100, help="Số users (files chia đều)")
+    parser.add_argument('--repeat', type=int, default=20, help="Số lần chạy mỗi query")
+    parser.add_argument('--limit', type=int, default=50, help="Số kết quả mỗi trang")
+    parser.add_argument('--db', help="Đường dẫn database (mặc định: file tạm, bị xóa sau khi chạy)")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    db_path = args.db
+    if not db_path:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="search_bench_")
+        db_path = os.path.join(tmp_dir.name, "files.db")
+
+    try:
+        db = FileDatabase(db_path)
+        existing = sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        if existing < args.rows:
+            print(f"Populating {args.rows - existing:,} rows ...")
+            start = time.perf_counter()
+            populate(db, args.rows - existing, args.users)
+            print(f"  done in {time.perf_counter() - start:.1f}s")
+        print(f"FTS5 trigram enabled: {db.fts_enabled}")
+
+        user_id = 1
+        # Cùng database nhưng luôn dùng FTS khi query đủ dài
+        fts_db = FileDatabase(db_path)
+        fts_db.SEARCH_SCAN_MAX_FILES = -1
+        print(f"User {user_id} owns {db._count_user_files(user_id):,} files "
+              f"(scan threshold {db.SEARCH_SCAN_MAX_FILES:,})")
+
+        print(f"\n{'query (p50 / p95 ms)':<30}{'search_files':>16}{'FTS only':>16}{'LIKE unranked':>16}{'hits':>7}")
+        for label, query, mode, extension in QUERIES:
+            results = [
+                measure(lambda: db.search_files(user_id, query=query, mode=mode, extension=extension,
+                                                limit=args.limit), args.repeat),
+                measure(lambda: fts_db.search_files(user_id, query=query, mode=mode, extension=extension,
+                                                    limit=args.limit), args.repeat),
+                measure(lambda: like_scan(db, user_id, query, mode, extension, args.limit), args.repeat),
+            ]
+            cells = "".join(f"{r['p50_ms']:>8.2f}/{r['p95_ms']:<7.2f}" for r in results)
+            print(f"{label:<30}{cells}{results[0]['results']:>7}")
+    finally:
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
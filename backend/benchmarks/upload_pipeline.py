@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+Benchmark toàn tuyến upload: client (AsyncUploader) -> gateway WebSocket (server.py) -> file manager
+(/api/upload) -> blob store. Chạy file_manager.py và server.py thành process riêng trên thư mục / database
+tạm, tạo user giả lập rồi cho N client đồng thời upload file sinh theo phân bố kích thước.
+
+Kết quả: throughput, percentile ack RTT mỗi chunk, thời gian hoàn tất mỗi file (theo nhóm kích thước),
+CPU / RSS từng process (đọc /proc, tính cả process con như pool derivative), tổng hợp /metrics của hai
+server. Lưu JSON (--output) để so sánh trước / sau khi đổi giao thức hoặc cách lưu trữ.
+Thoát với mã 1 (và "ok": false trong JSON) nếu có file không hoàn tất hoặc log của server có lỗi.
+
+Chạy: python -m benchmarks.upload_pipeline --clients 8 --files-per-client 4 \\
+          --sizes "64KB:0.5,1MB:0.3,16MB:0.2" --chunk-size 65536 --output before.json
+      python -m benchmarks.upload_pipeline ... --env STORAGE_CODEC=none --output after.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+# Histogram / counter lấy từ /metrics của từng server sau khi chạy xong
+SERVER_METRICS = {
+    'gateway': ('upload_chunk_seconds', 'relay_seconds', 'upload_chunk_bytes_total', 'relay_bytes_total'),
+    'file_manager': ('db_query_seconds', 'file_download_bytes_total', 'file_download_throughput_bytes_per_second'),
+}
+# Dòng log lỗi của hai server (console format của logger.py và logging.basicConfig); finalize lỗi được đếm riêng
+LOG_ERROR_PATTERN = re.compile(r' - ERROR: |^ERROR:|^Traceback ')
+FINALIZE_ERROR_PATTERN = re.compile(r'Failed to finalize upload')
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def summarize_ms(seconds):
+    """p50 / p90 / p99 / max (ms) của danh sách thời gian tính bằng giây"""
+    return {
+        'count': len(seconds),
+        'p50_ms': round(percentile(seconds, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(seconds, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(seconds, 0.99) * 1000, 3),
+        'max_ms': round(max(seconds, default=0.0) * 1000, 3),
+    }
+
+
+def parse_size(text):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?B)?\s*', text.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or 'B'])
+
+
+def parse_distribution(text):
+    """"64KB:0.5,1MB:0.3,16MB:0.2" -> [(nhãn, số byte, trọng số)]"""
+    distribution = []
+    for item in text.split(','):
+        label, _, weight = item.partition(':')
+        distribution.append((label.strip(), parse_size(label), float(weight or 1)))
+    if not distribution or sum(weight for _, _, weight in distribution) <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid size distribution: {text}")
+    return distribution
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def generate_payloads(directory, count, distribution, content, seed):
+    """Sinh `count` file theo phân bố kích thước. Mỗi file có nội dung khác nhau (không bị dedup);
+    content=text cho dữ liệu nén được, random cho dữ liệu không nén được"""
+    rng = random.Random(seed)
+    labels = [label for label, _, _ in distribution]
+    sizes = {label: size for label, size, _ in distribution}
+    weights = [weight for _, _, weight in distribution]
+    text_block = ' '.join(rng.choice(('upload', 'chunk', 'relay', 'blob', 'tệp', 'dữ liệu', 'báo cáo'))
+                          for _ in range(20000)).encode('utf-8') + b'\n'
+    payloads = []
+    for index in range(count):
+        label = rng.choices(labels, weights)[0]
+        size = sizes[label]
+        path = directory / f"bench_{index:05d}.{'txt' if content == 'text' else 'bin'}"
+        header = f"bench file {index} seed {seed}\n".encode()
+        with open(path, 'wb') as f:
+            f.write(header[:size])
+            remaining = size - min(size, len(header))
+            while remaining > 0:
+                block = os.urandom(min(remaining, 1024 * 1024)) if content == 'random' else text_block[:remaining]
+                f.write(block)
+                remaining -= len(block)
+        payloads.append((path, label, size))
+    return payloads
+
+
+class ProcessSampler(threading.Thread):
+    """Lấy mẫu CPU (utime + stime, cả con đã kết thúc) và RSS của cây process định kỳ qua /proc.
+    Không có /proc (không phải Linux) thì kết quả để trống"""
+
+    def __init__(self, pids, interval=0.25):
+        super().__init__(daemon=True)
+        self.pids = pids  # tên -> pid gốc
+        self.interval = interval
+        self.available = os.path.isdir('/proc/self')
+        self._stop_event = threading.Event()
+        self._cpu = {}  # tên -> {pid: giây CPU mới nhất}
+        self._cpu_start = {}
+        self._rss = defaultdict(list)
+        self.started_at = self.stopped_at = None
+
+    def _tree(self, pid):
+        """pid và mọi process con, trừ các cây được đo riêng (server là con của process benchmark)"""
+        roots = set(self.pids.values())
+        pids, pending = [], [pid]
+        while pending:
+            current = pending.pop()
+            pids.append(current)
+            try:
+                with open(f'/proc/{current}/task/{current}/children') as f:
+                    pending.extend(child for child in map(int, f.read().split()) if child not in roots)
+            except OSError:
+                pass
+        return pids
+
+    @staticmethod
+    def _read(pid):
+        """(giây CPU, RSS byte) của một process, None nếu process đã mất"""
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # Tên process có thể chứa khoảng trắng: các trường số bắt đầu sau dấu ')' cuối cùng
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as f:
+                rss_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return None
+        utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+        return (utime + stime + cutime + cstime) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+    def sample(self):
+        for name, root in self.pids.items():
+            rss_total = 0
+            cpu = self._cpu.setdefault(name, {})
+            for pid in self._tree(root):
+                reading = self._read(pid)
+                if reading is None:
+                    continue
+                cpu[pid] = reading[0]
+                self._cpu_start.setdefault(name, {}).setdefault(pid, reading[0] if pid == root else 0.0)
+                rss_total += reading[1]
+            self._rss[name].append(rss_total)
+
+    def run(self):
+        if not self.available:
+            return
+        self.started_at = time.perf_counter()
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        if self.available:
+            self.sample()
+            self.stopped_at = time.perf_counter()
+
+    def results(self):
+        if not self.available or self.started_at is None:
+            return {}
+        elapsed = max(self.stopped_at - self.started_at, 1e-9)
+        results = {}
+        for name in self.pids:
+            cpu = sum(self._cpu.get(name, {}).values()) - sum(self._cpu_start.get(name, {}).values())
+            rss = self._rss.get(name) or [0]
+            results[name] = {
+                'cpu_seconds': round(cpu, 3),
+                'cpu_percent': round(100 * cpu / elapsed, 1),
+                'rss_peak_mb': round(max(rss) / 1024 ** 2, 1),
+                'rss_mean_mb': round(sum(rss) / len(rss) / 1024 ** 2, 1),
+            }
+        return results
+
+
+def scrape_metrics(url, names):
+    """Cộng _sum / _count (histogram) và giá trị (counter) theo tên metric, gộp mọi label"""
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            text = response.read().decode('utf-8')
+    except OSError as e:
+        return {'error': str(e)}
+    totals = {}
+    for line in text.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        series, _, value = line.rpartition(' ')
+        metric = series.split('{', 1)[0]
+        for name in names:
+            suffix = metric[len(name):] if metric.startswith(name) else None
+            if suffix not in ('', '_sum', '_count'):
+                continue
+            entry = totals.setdefault(name, {})
+            key = suffix.lstrip('_') or 'value'
+            entry[key] = entry.get(key, 0) + float(value)
+    for entry in totals.values():
+        if entry.get('count'):
+            entry['mean'] = entry['sum'] / entry['count']
+    return totals
+
+
+class Stack:
+    """file_manager.py + server.py chạy trên thư mục tạm, mỗi process một process group để dừng cả con"""
+
+    def __init__(self, root, env_overrides):
+        self.root = root
+        self.data_dir = root / 'data'
+        self.log_dir = root / 'logs'
+        for directory in (self.data_dir, self.log_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.fm_port, self.ws_port, self.metrics_port = free_port(), free_port(), free_port()
+        self.fm_url = f"http://127.0.0.1:{self.fm_port}"
+        self.ws_url = f"ws://127.0.0.1:{self.ws_port}/ws"
+        self.gateway_metrics_url = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        self.env = {
+            **os.environ,
+            'PYTHONPATH': str(BACKEND_DIR),
+            'PYTHONUNBUFFERED': '1',
+            'UPLOAD_FOLDER': str(root / 'uploads'),
+            'TEMP_UPLOAD_FOLDER': str(root / 'temp'),
+            'COLD_STORAGE_FOLDER': str(root / 'cold'),
+            'DERIVATIVE_FOLDER': str(root / 'derivatives'),
+            'TRACE_DIR': str(root / 'traces'),
+            'MAINTENANCE_ENABLED': '0',
+            'METRICS_TOKEN': '',
+            'WS_HOST': '127.0.0.1',
+            'WS_PORT': str(self.ws_port),
+            'METRICS_PORT': str(self.metrics_port),
+            'REMOTE_UPLOAD_URL': f"{self.fm_url}/api/upload",
+            **env_overrides,
+        }
+        self.processes = {}
+
+    def create_users(self, count):
+        """Tạo user + session token trực tiếp trong auth.db tạm (trước khi server mở database)"""
+        from auth_database import AuthDatabase
+        auth_db = AuthDatabase(db_path=str(self.data_dir / 'auth.db'))
+        tokens = []
+        for i in range(count):
+            user_id = auth_db.create_user(f"bench{i}", f"bench-password-{i}")
+            tokens.append(auth_db.create_session(user_id))
+        return tokens
+
+    def start(self, timeout=60):
+        commands = {
+            'file_manager': [sys.executable, '-c',
+                             "import file_manager; file_manager.app.run(host='127.0.0.1', "
+                             f"port={self.fm_port}, threaded=True, use_reloader=False, debug=False)"],
+            'gateway': [sys.executable, str(BACKEND_DIR / 'server.py')],
+        }
+        for name, command in commands.items():
+            log = open(self.log_dir / f"{name}.log", 'wb')
+            self.processes[name] = subprocess.Popen(command, cwd=self.data_dir, env=self.env, stdout=log,
+                                                    stderr=subprocess.STDOUT, start_new_session=True)
+            log.close()
+        deadline = time.monotonic() + timeout
+        for name, url in (('file_manager', f"{self.fm_url}/metrics"), ('gateway', self.gateway_metrics_url)):
+            while True:
+                if self.processes[name].poll() is not None:
+                    raise RuntimeError(f"{name} exited early, see {self.log_dir / (name + '.log')}:\n"
+                                       + self.log_tail(name))
+                try:
+                    urllib.request.urlopen(url, timeout=2).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"{name} did not start within {timeout}s:\n" + self.log_tail(name))
+                    time.sleep(0.2)
+
+    def log_tail(self, name, lines=20):
+        try:
+            return '\n'.join((self.log_dir / f"{name}.log").read_text(errors='replace').splitlines()[-lines:])
+        except OSError:
+            return ''
+
+    def log_errors(self, samples=5):
+        """Số dòng lỗi trong log của từng server (gọi sau stop(), trước khi xóa thư mục tạm)"""
+        errors = {}
+        for name in self.processes:
+            try:
+                lines = (self.log_dir / f"{name}.log").read_text(errors='replace').splitlines()
+            except OSError:
+                continue
+            matched = [line for line in lines if LOG_ERROR_PATTERN.search(line)]
+            errors[name] = {
+                'count': len(matched),
+                'finalize_failures': sum(1 for line in matched if FINALIZE_ERROR_PATTERN.search(line)),
+                'samples': matched[:samples],
+            }
+        return errors
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                with_group(process, signal.SIGTERM)
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                with_group(process, signal.SIGKILL)
+                process.wait()
+
+
+def with_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def upload_file(ws_url, client, token, payload, chunk_size, timeout):
+    from client import AsyncUploader
+    path, label, size = payload
+    record = {'client': client, 'file': path.name, 'size_label': label, 'size': size, 'result': None, 'remote_file_id': None,
+              'seconds': None, 'ack_rtts': []}
+    started = time.perf_counter()
+    try:
+        async with AsyncUploader(ws_url, chunk_size, token=token) as uploader:
+            await uploader.start(str(path))
+            await uploader.upload()
+            await asyncio.wait_for(uploader.finished.wait(), timeout)
+            record['result'] = uploader.result
+            record['remote_file_id'] = uploader.remote_file_id
+            record['ack_rtts'] = uploader.ack_rtts
+    except asyncio.TimeoutError:
+        record['result'] = 'timeout'
+    except Exception as e:
+        record['result'] = f"exception: {type(e).__name__}"
+    record['seconds'] = time.perf_counter() - started
+    return record
+
+
+async def run_uploads(stack, tokens, payloads, args):
+    """Mỗi client (một user) upload lần lượt các file của mình, các client chạy đồng thời"""
+    async def simulated_client(index):
+        records = []
+        for payload in payloads[index::args.clients]:
+            records.append(await upload_file(stack.ws_url, index, tokens[index], payload, args.chunk_size, args.timeout))
+        return records
+
+    per_client = await asyncio.gather(*(simulated_client(i) for i in range(args.clients)))
+    return [record for records in per_client for record in records]
+
+
+async def run_downloads(stack, tokens, records, args):
+    """Tải lại các file đã upload qua /api/files/<id>/download, cùng mức đồng thời"""
+    import aiohttp
+
+    async def simulated_client(index, session):
+        results = []
+        for record in records:
+            if record['client'] != index or record['result'] != 'completed' or not record['remote_file_id']:
+                continue
+            started, received, status = time.perf_counter(), 0, 0
+            url = f"{stack.fm_url}/api/files/{record['remote_file_id']}/download"
+            try:
+                async with session.get(url, headers={'Authorization': f"Bearer {tokens[index]}"}) as response:
+                    status = response.status
+                    async for chunk in response.content.iter_chunked(256 * 1024):
+                        received += len(chunk)
+            except aiohttp.ClientError:
+                pass
+            results.append({'status': status, 'bytes': received, 'seconds': time.perf_counter() - started,
+                            'size_label': record['size_label']})
+        return results
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        per_client = await asyncio.gather(*(simulated_client(i, session) for i in range(args.clients)))
+    return [result for results in per_client for result in results]
+
+
+def summarize_uploads(records, seconds):
+    completed = [r for r in records if r['result'] == 'completed']
+    uploaded = sum(r['size'] for r in completed)
+    by_size = defaultdict(list)
+    for record in completed:
+        by_size[record['size_label']].append(record['seconds'])
+    return {
+        'files': len(records),
+        'completed': len(completed),
+        'results': dict(Counter(r['result'] for r in records)),
+        'bytes': uploaded,
+        'seconds': round(seconds, 3),
+        'throughput_mb_s': round(uploaded / 1024 ** 2 / seconds, 3) if seconds else 0.0,
+        'files_per_s': round(len(completed) / seconds, 3) if seconds else 0.0,
+        'time_to_complete': summarize_ms([r['seconds'] for r in completed]),
+        'time_to_complete_by_size': {label: summarize_ms(values) for label, values in sorted(by_size.items())},
+        'chunk_ack_rtt': summarize_ms([rtt for r in records for rtt in r['ack_rtts']]),
+    }
+
+
+def summarize_downloads(results, seconds):
+    ok = [r for r in results if r['status'] == 200]
+    received = sum(r['bytes'] for r in ok)
+    return {
+        'files': len(results),
+        'ok': len(ok),
+        'statuses': dict(Counter(r['status'] for r in results)),
+        'bytes': received,
+        'seconds': round(seconds, 3),
+        'throughput_mb_s': round(received / 1024 ** 2 / seconds, 3) if seconds else 0.0,
+        'time_to_complete': summarize_ms([r['seconds'] for r in ok]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(results):
+    for name, errors in results['server_errors'].items():
+        if errors['count']:
+            print(f"\nWARNING: {name} logged {errors['count']} error(s) "
+                  f"({errors['finalize_failures']} finalize failures), results are not trustworthy:")
+            for line in errors['samples']:
+                print(f"    {line}")
+    upload = results['upload']
+    print(f"\nupload: {upload['completed']}/{upload['files']} files, {upload['bytes'] / 1024 ** 2:.1f} MB "
+          f"in {upload['seconds']:.2f}s -> {upload['throughput_mb_s']:.2f} MB/s, {upload['files_per_s']:.2f} files/s"
+          f"  results={upload['results']}")
+    print(f"\n{'':<24}{'count':>8}{'p50 ms':>12}{'p90 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+    rows = [('chunk ack RTT', upload['chunk_ack_rtt']), ('time to complete', upload['time_to_complete'])]
+    rows += [(f"  {label}", stats) for label, stats in upload['time_to_complete_by_size'].items()]
+    if 'download' in results:
+        rows.append(('download', results['download']['time_to_complete']))
+    for name, stats in rows:
+        print(f"{name:<24}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p90_ms']:>12.1f}"
+              f"{stats['p99_ms']:>12.1f}{stats['max_ms']:>12.1f}")
+    if 'download' in results:
+        download = results['download']
+        print(f"\ndownload: {download['ok']}/{download['files']} files -> {download['throughput_mb_s']:.2f} MB/s"
+              f"  statuses={download['statuses']}")
+    if results['processes']:
+        print(f"\n{'process':<16}{'cpu s':>10}{'cpu %':>10}{'rss peak MB':>14}{'rss mean MB':>14}")
+        for name, stats in results['processes'].items():
+            print(f"{name:<16}{stats['cpu_seconds']:>10.2f}{stats['cpu_percent']:>10.1f}"
+                  f"{stats['rss_peak_mb']:>14.1f}{stats['rss_mean_mb']:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upload pipeline end to end (client -> gateway -> "
+                                                 "file manager)")
+    parser.add_argument('--clients', type=int, default=8, help="Số client upload đồng thời (mỗi client một user)")
+    parser.add_argument('--files-per-client', type=int, default=4, help="Số file mỗi client upload lần lượt")
+    parser.add_argument('--sizes', type=parse_distribution, default='64KB:0.5,1MB:0.3,16MB:0.2',
+                        help="Phân bố kích thước file: <kích thước>:<trọng số>,...")
+    parser.add_argument('--content', choices=['random', 'text'], default='random',
+                        help="random: không nén được; text: nén được (thử blob compression)")
+    parser.add_argument('--chunk-size', type=parse_size, default=64 * 1024, help="Kích thước chunk của client")
+    parser.add_argument('--timeout', type=float, default=300, help="Số giây tối đa chờ mỗi file hoàn tất")
+    parser.add_argument('--seed', type=int, default=1, help="Seed sinh file (cùng seed -> cùng bộ file)")
+    parser.add_argument('--no-download', action='store_true', help="Bỏ pha tải lại file đã upload")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="Biến môi trường thêm cho hai server (lặp lại được)")
+    parser.add_argument('--output', help="Ghi kết quả JSON vào file này")
+    parser.add_argument('--keep', action='store_true', help="Giữ thư mục tạm (log, trace, database) để xem lại")
+    args = parser.parse_args()
+
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+    # Log INFO mỗi chunk của AsyncUploader làm chậm chính client benchmark
+    logging.disable(logging.WARNING)
+
+    tmp_dir = tempfile.mkdtemp(prefix="upload_pipeline_")
+    root = Path(tmp_dir)
+    stack = Stack(root, env_overrides)
+    try:
+        tokens = stack.create_users(args.clients)
+        payload_dir = root / 'payloads'
+        payload_dir.mkdir()
+        payloads = generate_payloads(payload_dir, args.clients * args.files_per_client, args.sizes, args.content,
+                                     args.seed)
+        stack.start()
+        sampler = ProcessSampler({**{name: p.pid for name, p in stack.processes.items()}, 'bench_client': os.getpid()})
+        sampler.start()
+
+        started = time.perf_counter()
+        records = asyncio.run(run_uploads(stack, tokens, payloads, args))
+        results = {'upload': summarize_uploads(records, time.perf_counter() - started)}
+
+        if not args.no_download:
+            started = time.perf_counter()
+            downloads = asyncio.run(run_downloads(stack, tokens, records, args))
+            results['download'] = summarize_downloads(downloads, time.perf_counter() - started)
+
+        sampler.stop()
+        results['processes'] = sampler.results()
+        results['server_metrics'] = {
+            'gateway': scrape_metrics(stack.gateway_metrics_url, SERVER_METRICS['gateway']),
+            'file_manager': scrape_metrics(f"{stack.fm_url}/metrics", SERVER_METRICS['file_manager']),
+        }
+    finally:
+        stack.stop()
+        server_errors = stack.log_errors()
+        if args.keep:
+            print(f"Kept {tmp_dir}")
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = {
+        'benchmark': 'upload_pipeline',
+        'git_commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'clients': args.clients,
+            'files_per_client': args.files_per_client,
+            'sizes': [{'label': label, 'bytes': size, 'weight': weight} for label, size, weight in args.sizes],
+            'content': args.content,
+            'chunk_size': args.chunk_size,
+            'seed': args.seed,
+            'env': env_overrides,
+        },
+        **results,
+        'server_errors': server_errors,
+    }
+    # Upload "completed" phía client không đủ: lỗi trong log server (vd. finalize lỗi, session bị giữ lại)
+    # nghĩa là số đo được không phản ánh một pipeline chạy đúng
+    results['ok'] = (results['upload']['completed'] == results['upload']['files']
+                     and not any(errors['count'] for errors in server_errors.values()))
+    print_report(results)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding='utf-8')
+        print(f"\nSaved {args.output}")
+    else:
+        print(json.dumps(results, indent=2))
+    return 0 if results['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
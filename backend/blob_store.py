@@ -0,0 +1,140 @@
+import os
+import errno
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+from storage_codec import ZSTD_SUFFIX, open_stored, stored_exists
+
+logger = logging.getLogger(__name__)
+
+# Nội dung file nằm ở <UPLOAD_FOLDER>/blobs/<aa>/<bb>/<tên>; tên và folder chỉ còn là metadata trong DB
+#   - blob theo nội dung (upload mới): <tên> = SHA-256 của nội dung, dùng chung giữa các file giống nhau
+#   - blob theo ID (migrate_blobs.py từ cây thư mục cũ): <tên> = ID của file
+BLOB_DIRNAME = "blobs"
+WRITE_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+
+def is_blob_path(relative_path):
+    """file_path trong DB có trỏ tới blob (thay vì cây thư mục username/... kiểu cũ) không"""
+    return bool(relative_path) and relative_path.replace('\\', '/').startswith(f"{BLOB_DIRNAME}/")
+
+
+def _sharded(name, digest):
+    return f"{BLOB_DIRNAME}/{digest[:2]}/{digest[2:4]}/{name}"
+
+
+class BlobStore:
+    """Lưu nội dung file trong thư mục chia 2 cấp theo hash để mỗi thư mục chỉ có ít file.
+
+    cold_root (tùy chọn) là tầng lạnh có cùng cấu trúc; đường dẫn tương đối của blob không đổi khi chuyển tầng.
+    """
+
+    def __init__(self, root, temp_dir, cold_root=None):
+        self.root = Path(root)
+        self.temp_dir = Path(temp_dir)
+        self.cold_root = Path(cold_root) if cold_root else None
+
+    def relative_path(self, blob_id):
+        """Đường dẫn blob theo ID, tương đối với root (giá trị lưu vào files.file_path)"""
+        return _sharded(blob_id, hashlib.sha256(str(blob_id).encode('utf-8')).hexdigest())
+
+    def content_path(self, digest):
+        """Đường dẫn blob theo nội dung (SHA-256 hex), tương đối với root"""
+        return _sharded(digest, digest)
+
+    def path(self, blob_id):
+        return self.root / self.relative_path(blob_id)
+
+    def receive(self, name, stream, chunk_size=WRITE_CHUNK_SIZE):
+        """Ghi stream ra file .part trong temp_dir, tính SHA-256 trong lúc ghi.
+        Trả về (đường dẫn file tạm, số byte, digest hex); người gọi chịu trách nhiệm đưa vào kho hoặc xóa
+        """
+        partial_path = self.temp_dir / f"blob_{name}.part"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(partial_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+        return partial_path, size, digest.hexdigest()
+
+    def adopt(self, blob_id, source):
+        """Chuyển một file có sẵn thành blob theo ID"""
+        return self.place(self.relative_path(blob_id), source)
+
+    def place(self, relative_path, source):
+        """Đưa file vào vị trí blob (rename nếu cùng filesystem, ngược lại copy)"""
+        target = self.root / relative_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(str(source), str(target))
+        return relative_path
+
+    def locate(self, relative_path):
+        """Vị trí hiện tại của blob: tầng nóng nếu có, ngược lại tầng lạnh (nếu blob ở đó)"""
+        hot = self.root / relative_path
+        if self.cold_root is None or stored_exists(hot):
+            return hot
+        cold = self.cold_root / relative_path
+        return cold if stored_exists(cold) else hot
+
+    def is_cold(self, path):
+        return self.cold_root is not None and Path(path).is_relative_to(self.cold_root)
+
+    def open(self, relative_path):
+        """Mở nội dung gốc của blob (tự giải nén nếu đã được nén). Trả về (file object, kích thước gốc, mtime)"""
+        try:
+            return open_stored(self.locate(relative_path))
+        except FileNotFoundError:
+            # Blob vừa chuyển tầng giữa lúc locate và open
+            return open_stored(self.locate(relative_path))
+
+    def move_to_tier(self, relative_path, cold):
+        """Chuyển blob (bản gốc và / hoặc bản nén) sang tầng lạnh / nóng. Trả về số byte đã chuyển.
+
+        Bản ở tầng đích được ghi vào file tạm rồi rename vào chỗ, sau đó mới xóa bản ở tầng nguồn.
+        """
+        source_root, target_root = (self.root, self.cold_root) if cold else (self.cold_root, self.root)
+        moved = 0
+        for name in (relative_path, f"{relative_path}{ZSTD_SUFFIX}"):
+            source = source_root / name
+            if not source.is_file():
+                continue
+            target = target_root / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            partial = target.with_name(f"{target.name}.tiering")
+            shutil.copy2(source, partial)
+            os.replace(partial, target)
+            moved += source.stat().st_size
+            source.unlink()
+        return moved
+
+    def remove(self, relative_path):
+        """Xóa blob (cả bản nén và bản ở tầng lạnh nếu có); trả về số byte giải phóng (0 nếu không còn trên đĩa)"""
+        freed = 0
+        for root in (self.root, self.cold_root):
+            if root is None:
+                continue
+            target = root / relative_path
+            for path in (target, target.with_name(target.name + ZSTD_SUFFIX)):
+                try:
+                    size = path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                freed += size
+        return freed
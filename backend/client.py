@@ -2,6 +2,7 @@ import asyncio
 import base64
 import os
 import sys
+import time
 import uuid
 from dataclasses import dataclass
 from pathlib import Path
@@ -28,14 +29,23 @@ class UploadState:
 
 
 class AsyncUploader:
-    def __init__(self, ws_url: str = DEFAULT_WS_URL, chunk_size: int = CHUNK_SIZE) -> None:
+    def __init__(self, ws_url: str = DEFAULT_WS_URL, chunk_size: int = CHUNK_SIZE, token: Optional[str] = None) -> None:
         self.ws_url = ws_url
         self.chunk_size = chunk_size
+        self.token = token  # Session token (server yêu cầu xác thực trước khi start)
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.state: Optional[UploadState] = None
         self._recv_task: Optional[asyncio.Task] = None
         self._pause_event = asyncio.Event()
         self._pause_event.set()  # start in running state
+        self._chunk_sent_at = {}  # offset sau chunk -> thời điểm gửi, để đo ack RTT
+        # Ack RTT (giây) của từng chunk: đo ở client vì chỉ client biết lúc gửi; benchmark tính percentile
+        self.ack_rtts = []
+        self.authenticated = False
+        self._authenticated = asyncio.Event()
+        self.finished = asyncio.Event()  # Set khi server báo hoàn tất (complete-ack) hoặc lỗi
+        self.result: Optional[str] = None  # "completed" | "error" | "rejected"
+        self.remote_file_id = None
         logger.debug("AsyncUploader initialized with ws_url=%s, chunk_size=%d", ws_url, chunk_size)
 
     async def __aenter__(self):
@@ -43,6 +53,12 @@ class AsyncUploader:
         self.websocket = await websockets.connect(self.ws_url, max_size=8 * 1024 * 1024)
         self._recv_task = asyncio.create_task(self._receiver())
         logger.info("Connected to WebSocket server")
+        if self.token:
+            await self._send_json({"type": "auth", "token": self.token, "user": {}})
+            await asyncio.wait_for(self._authenticated.wait(), timeout=10)
+            if not self.authenticated:
+                await self.__aexit__(None, None, None)
+                raise PermissionError("WebSocket authentication failed")
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
@@ -74,14 +90,30 @@ class AsyncUploader:
             return
 
         event = data.get("event")
+        if event in ("auth-success", "auth-error"):
+            self.authenticated = event == "auth-success"
+            self._authenticated.set()
+            return
         if not self.state:
             logger.debug("Received message without state: %s", data)
             return
 
-        if event == "start-ack":
+        if event == "start-ack" and data.get("status") == "rejected":
+            # Vượt hạn mức / server hết dung lượng: dừng ngay, không gửi chunk
+            self.state.is_stopped = True
+            self._pause_event.set()
+            self.result = "rejected"
+            self.finished.set()
+            logger.error("Upload rejected: %s (quota=%s) for %s",
+                         data.get('error'), data.get('quota'), self.state.file_path.name)
+        elif event == "start-ack":
             self.state.offset = int(data.get("offset", 0))
             logger.info("Start acknowledged: resume at offset=%d for %s", 
                        self.state.offset, self.state.file_path.name)
+        elif event == "chunk-ack":
+            sent_at = self._chunk_sent_at.pop(int(data.get("offset", 0)), None)
+            if sent_at is not None:
+                self.ack_rtts.append(time.perf_counter() - sent_at)
         elif event == "progress":
             off = int(data.get("offset", 0))
             self.state.offset = off
@@ -99,6 +131,9 @@ class AsyncUploader:
         elif event == "stop-ack":
             logger.info("Stop acknowledged for %s", self.state.file_path.name)
         elif event == "complete-ack":
+            self.remote_file_id = data.get("remoteFileId")
+            self.result = self.result or "completed"
+            self.finished.set()
             logger.info("Upload completed: path=%s for %s", 
                        data.get('filePath'), self.state.file_path.name)
         elif event == "offset-mismatch":
@@ -106,7 +141,10 @@ class AsyncUploader:
             logger.warning("Offset mismatch, expected=%d for %s", 
                           expected, self.state.file_path.name)
             self.state.offset = expected
+            self._chunk_sent_at.clear()
         elif event == "error":
+            self.result = self.result or "error"
+            self.finished.set()
             logger.error("Server error: %s for %s", 
                         data.get('error'), self.state.file_path.name)
         else:
@@ -172,6 +210,7 @@ class AsyncUploader:
                 # base64 encode
                 data_b64 = base64.b64encode(chunk).decode("ascii")
                 offset_before = self.state.offset
+                self._chunk_sent_at[offset_before + len(chunk)] = time.perf_counter()
 
                 await self._send_json({
                     "action": "chunk",
@@ -239,7 +278,8 @@ class AsyncUploader:
         await self.websocket.send(json.dumps(obj))
 
 
-async def upload_many(ws_url: str, files: Iterable[str], concurrency: int = 2, chunk: int = CHUNK_SIZE):
+async def upload_many(ws_url: str, files: Iterable[str], concurrency: int = 2, chunk: int = CHUNK_SIZE,
+                      token: Optional[str] = None):
     """
     Upload nhiều files với concurrency control và progress tracking
     
@@ -248,6 +288,7 @@ async def upload_many(ws_url: str, files: Iterable[str], concurrency: int = 2, c
         files: Danh sách file paths
         concurrency: Số lượng upload đồng thời
         chunk: Kích thước chunk
+        token: Session token để xác thực với server
     """
     file_list = list(files)
     total_files = len(file_list)
@@ -264,7 +305,7 @@ async def upload_many(ws_url: str, files: Iterable[str], concurrency: int = 2, c
         async with semaphore:
             try:
                 logger.debug("Processing file: %s", file_path)
-                async with AsyncUploader(ws_url, chunk) as up:
+                async with AsyncUploader(ws_url, chunk, token=token) as up:
                     await up.start(file_path)
                     await up.upload()
                 logger.info("File uploaded successfully: %s", file_path)
@@ -360,6 +401,7 @@ def main():
     parser.add_argument("--dir", dest="directory_paths", nargs="+", default=None, help="Directory path(s) to upload all files from")
     parser.add_argument("--recursive", action="store_true", help="Recursively scan subdirectories when using --dir")
     parser.add_argument("--id", dest="file_id", default=None, help="Optional file id (only for single-file mode)")
+    parser.add_argument("--token", default=os.environ.get("WS_TOKEN"), help="Session token (default $WS_TOKEN)")
     parser.add_argument("--chunk", dest="chunk", type=int, default=CHUNK_SIZE, help="Chunk size in bytes (default 65536)")
     parser.add_argument("--concurrency", dest="concurrency", type=int, default=2, help="Number of concurrent uploads for multi-file mode")
     parser.add_argument("--interactive", dest="interactive", action="store_true", help="Interactive mode (only for single-file mode)")
@@ -408,9 +450,10 @@ def main():
             if args.interactive:
                 asyncio.run(interactive_upload(args.ws_url, unique_files[0], args.file_id))
             else:
-                asyncio.run(upload_many(args.ws_url, unique_files, concurrency=1, chunk=args.chunk))
+                asyncio.run(upload_many(args.ws_url, unique_files, concurrency=1, chunk=args.chunk, token=args.token))
         else:
-            asyncio.run(upload_many(args.ws_url, unique_files, concurrency=args.concurrency, chunk=args.chunk))
+            asyncio.run(upload_many(args.ws_url, unique_files, concurrency=args.concurrency, chunk=args.chunk,
+                                    token=args.token))
     except KeyboardInterrupt:
         logger.info("Upload interrupted by user")
     except Exception as e:
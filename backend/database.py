@@ -1,8 +1,13 @@
 import sqlite3
 import os
+import json
+import base64
+from collections import Counter
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 import logging
+from db_pool import get_pool
+from metrics import instrument_methods, DB_QUERY_SECONDS
 
 # Timezone Việt Nam (UTC+7)
 VIETNAM_TZ = timezone(timedelta(hours=7))
@@ -17,15 +22,84 @@ def vietnam_now_isoformat():
 
 logger = logging.getLogger(__name__)
 
+# Các cột được phép sort trong danh sách files (tham số API -> cột DB)
+FILE_SORT_COLUMNS = {
+    'created_at': 'created_at',
+    'name': 'original_filename',
+    'size': 'size',
+}
+
+# Giá trị folder_id đặc biệt để lọc các file nằm ở thư mục gốc
+ROOT_FOLDER = 'root'
+
+def get_file_extension(filename):
+    """Lấy extension (chữ thường, có dấu chấm) từ tên file"""
+    return Path(filename or '').suffix.lower()
+
+# Các status có cột đếm riêng trong bảng user_stats
+STATS_STATUSES = ('completed', 'uploading', 'paused', 'error')
+
+def _stats_delta_sql(row, sign):
+    """Sinh các câu lệnh SQL (dùng trong trigger) cộng/trừ một dòng files vào user_stats"""
+    op = '+' if sign > 0 else '-'
+    owner = f"COALESCE({row}.user_id, 0)"
+    status_columns = ",\n".join(
+        f"{status}_files = {status}_files {op} ({row}.status IS '{status}')" for status in STATS_STATUSES
+    )
+    statements = [
+        f"INSERT INTO user_stats (user_id) VALUES ({owner}) ON CONFLICT(user_id) DO NOTHING;",
+        f"""UPDATE user_stats SET
+            total_files = total_files {op} ({row}.status IS NOT 'deleted'),
+            {status_columns},
+            completed_bytes = completed_bytes {op} (CASE WHEN {row}.status IS 'completed' THEN COALESCE({row}.size, 0) ELSE 0 END),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {owner};""",
+    ]
+    if sign > 0:
+        statements.append(f"""INSERT INTO user_extension_stats (user_id, extension, file_count)
+            SELECT {owner}, {row}.extension, 1
+            WHERE {row}.status IS 'completed' AND COALESCE({row}.extension, '') != ''
+            ON CONFLICT(user_id, extension) DO UPDATE SET file_count = file_count + 1;""")
+    else:
+        statements.append(f"""UPDATE user_extension_stats SET file_count = file_count - 1
+            WHERE user_id = {owner} AND extension = {row}.extension AND {row}.status IS 'completed';""")
+        statements.append(f"""DELETE FROM user_extension_stats
+            WHERE user_id = {owner} AND extension = {row}.extension AND file_count <= 0;""")
+    return "\n".join(statements)
+
+def escape_like(value):
+    """Escape ký tự đại diện của LIKE (dùng kèm ESCAPE '\\')"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def encode_cursor(sort_value, file_id):
+    """Mã hóa vị trí (giá trị sort, id) của dòng cuối trang thành cursor"""
+    raw = json.dumps([sort_value, file_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    """Giải mã cursor, trả về (giá trị sort, id); ValueError nếu cursor không hợp lệ"""
+    try:
+        sort_value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(file_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
 class FileDatabase:
     def __init__(self, db_path="files.db"):
         self.db_path = db_path
+        # auth.db nằm cùng thư mục, được ATTACH khi cần JOIN với bảng users
+        self.auth_db_path = os.path.join(os.path.dirname(self.db_path), "auth.db")
+        # Connection dùng lại giữa các lời gọi (WAL, busy_timeout) - xem db_pool.py
+        self.pool = get_pool(self.db_path)
+        self.auth_pool = get_pool(self.auth_db_path)
+        # Connection tới files.db có ATTACH auth.db (schema 'auth') để JOIN với bảng users
+        self.joined_pool = get_pool(self.db_path, attach={'auth': self.auth_db_path})
         self.init_database()
     
     def init_database(self):
         """Khởi tạo database và tạo bảng files với user support"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 # Cập nhật bảng files để support user_id
                 conn.execute("""
                     CREATE TABLE IF NOT EXISTS files (
@@ -63,27 +137,256 @@ class FileDatabase:
                     )
                 """)
                 
+                # Migration: thêm cột extension để lọc theo loại file bằng index
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+                if 'extension' not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN extension TEXT")
+                    rows = conn.execute("SELECT id, original_filename FROM files").fetchall()
+                    conn.executemany(
+                        "UPDATE files SET extension = ? WHERE id = ?",
+                        [(get_file_extension(name), file_id) for file_id, name in rows]
+                    )
+                    logger.info(f"Added extension column to files ({len(rows)} rows backfilled)")
+                
+                # Migration: thùng rác giữ file vật lý trong khu .trash (trash_path) cho tới khi worker purge xóa
+                recycle_columns = [row[1] for row in conn.execute("PRAGMA table_info(recycle_bin)")]
+                if 'trash_path' not in recycle_columns:
+                    conn.execute("ALTER TABLE recycle_bin ADD COLUMN trash_path TEXT")
+                if 'purged_at' not in recycle_columns:
+                    conn.execute("ALTER TABLE recycle_bin ADD COLUMN purged_at TIMESTAMP")
+                    # Trước đây xóa vĩnh viễn đã xóa file ngay (đường dẫn có thể đã được file mới dùng lại)
+                    conn.execute("""
+                        UPDATE recycle_bin SET purged_at = deleted_at WHERE status = 'permanently_deleted'
+                    """)
+                
+                # Kho blob theo nội dung: mỗi SHA-256 một file vật lý, ref_count = số dòng files / recycle_bin
+                # (chưa purge) đang trỏ tới. File cũ (trước khi có kho) có content_hash NULL
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS blobs (
+                        sha256 TEXT PRIMARY KEY,
+                        file_path TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        ref_count INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ) WITHOUT ROWID
+                """)
+                if 'content_hash' not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+                if 'content_hash' not in recycle_columns:
+                    conn.execute("ALTER TABLE recycle_bin ADD COLUMN content_hash TEXT")
+                # Nén khi lưu (storage_codec.py): codec NULL = chưa đánh giá, 'none' = lưu nguyên bản,
+                # 'zstd' = lưu tại file_path + '.zst'; stored_size = dung lượng thực trên đĩa
+                blob_columns = [row[1] for row in conn.execute("PRAGMA table_info(blobs)")]
+                if 'codec' not in blob_columns:
+                    conn.execute("ALTER TABLE blobs ADD COLUMN codec TEXT")
+                if 'stored_size' not in blob_columns:
+                    conn.execute("ALTER TABLE blobs ADD COLUMN stored_size INTEGER")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_uncoded ON blobs(created_at) WHERE codec IS NULL")
+                
+                # Phân tầng lưu trữ (tiering.py): lượt đọc được ghi theo lô, blob lâu không đọc chuyển sang tầng lạnh
+                if 'access_count' not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN access_count INTEGER NOT NULL DEFAULT 0")
+                if 'last_accessed_at' not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN last_accessed_at TIMESTAMP")
+                if 'storage_tier' not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN storage_tier TEXT NOT NULL DEFAULT 'hot'")
+                # Ứng viên chuyển tầng lạnh: blob ở tầng nóng, theo lần đọc cuối (chưa đọc lần nào -> lúc upload)
+                conn.execute("""CREATE INDEX IF NOT EXISTS idx_files_hot_access
+                                ON files(COALESCE(last_accessed_at, created_at))
+                                WHERE storage_tier = 'hot' AND file_path LIKE 'blobs/%'""")
+                # Các file cùng trỏ tới một blob (nội dung trùng, khôi phục từ thùng rác)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files(file_path)")
+                
                 # Tạo index để tăng tốc truy vấn
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON files(status)")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_filename ON files(filename)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON files(user_id)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_recycle_user ON recycle_bin(user_id)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_recycle_status ON recycle_bin(status)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_recycle_deadline ON recycle_bin(restore_deadline)")
+                # Index đơn cột cũ đã được thay bằng các index ghép bên dưới (cột đầu giống nhau)
+                for old_index in ('idx_status', 'idx_user_id', 'idx_files_user_status', 'idx_recycle_user',
+                                  'idx_recycle_status', 'idx_recycle_deadline', 'idx_folders_user_parent'):
+                    conn.execute(f"DROP INDEX IF EXISTS {old_index}")
+                # Dọn file upload dở theo status + thời gian
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_status_created ON files(status, created_at)")
+                # Thùng rác: danh sách theo user / toàn hệ thống (mới xóa trước) và job hết hạn
+                conn.execute("""CREATE INDEX IF NOT EXISTS idx_recycle_user_status_deleted
+                                ON recycle_bin(user_id, status, deleted_at)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_recycle_status_deleted ON recycle_bin(status, deleted_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_recycle_status_deadline ON recycle_bin(status, restore_deadline)")
+                # Hàng đợi purge: chỉ chứa các dòng đã hết hạn / xóa vĩnh viễn nhưng chưa xóa file vật lý
+                conn.execute("""CREATE INDEX IF NOT EXISTS idx_recycle_purge_pending ON recycle_bin(purged_at, id)
+                                WHERE purged_at IS NULL AND status IN ('expired', 'permanently_deleted')""")
+                # Index cho keyset pagination (user_id, cột sort, id) và đếm tổng theo user
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_created ON files(user_id, created_at, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_name ON files(user_id, original_filename, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_size ON files(user_id, size, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_status_created ON files(user_id, status, created_at, id)")
+                # Files trong một folder (kể cả thư mục gốc: folder_id IS NULL) theo thời gian
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_folder_created ON files(user_id, folder_id, created_at, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_user_ext ON files(user_id, extension)")
+                # Index cho danh sách admin (toàn hệ thống) và đếm upload theo khoảng ngày
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_files_created ON files(created_at, id)")
+                
+                # Tạo bảng folders (trước đây lưu trong remote_uploads/files_db.json)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS folders (
+                        id TEXT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        parent_id TEXT,
+                        user_id INTEGER NOT NULL,
+                        username TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (parent_id) REFERENCES folders (id)
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_folders_user_parent_name ON folders(user_id, parent_id, name)")
+                
+                # Ghi nhận các migration dữ liệu chỉ chạy một lần
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        name TEXT PRIMARY KEY,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                
+                # Bộ đếm thống kê theo user, được trigger cập nhật trong cùng transaction với thay đổi
+                # trên files/folders (user_id = 0 cho các file không có chủ)
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS user_stats (
+                        user_id INTEGER PRIMARY KEY,
+                        total_files INTEGER NOT NULL DEFAULT 0,
+                        {", ".join(f"{status}_files INTEGER NOT NULL DEFAULT 0" for status in STATS_STATUSES)},
+                        completed_bytes INTEGER NOT NULL DEFAULT 0,
+                        folder_count INTEGER NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS user_extension_stats (
+                        user_id INTEGER NOT NULL,
+                        extension TEXT NOT NULL,
+                        file_count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, extension)
+                    ) WITHOUT ROWID
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_files_stats_insert AFTER INSERT ON files
+                    BEGIN
+                        {_stats_delta_sql('NEW', +1)}
+                    END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_files_stats_delete AFTER DELETE ON files
+                    BEGIN
+                        {_stats_delta_sql('OLD', -1)}
+                    END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_files_stats_update
+                    AFTER UPDATE OF status, size, extension, user_id ON files
+                    BEGIN
+                        {_stats_delta_sql('OLD', -1)}
+                        {_stats_delta_sql('NEW', +1)}
+                    END
+                """)
+                conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS trg_folders_stats_insert AFTER INSERT ON folders
+                    BEGIN
+                        INSERT INTO user_stats (user_id, folder_count) VALUES (NEW.user_id, 1)
+                        ON CONFLICT(user_id) DO UPDATE SET folder_count = folder_count + 1, updated_at = CURRENT_TIMESTAMP;
+                    END
+                """)
+                conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS trg_folders_stats_delete AFTER DELETE ON folders
+                    BEGIN
+                        UPDATE user_stats SET folder_count = folder_count - 1, updated_at = CURRENT_TIMESTAMP
+                        WHERE user_id = OLD.user_id;
+                    END
+                """)
+                
+                # Migration: tính bộ đếm lần đầu cho database đã có dữ liệu
+                applied = conn.execute("SELECT 1 FROM schema_migrations WHERE name = 'user_stats_backfill'").fetchone()
+                if not applied:
+                    self._rebuild_user_stats(conn)
+                    conn.execute("INSERT INTO schema_migrations (name, applied_at) VALUES ('user_stats_backfill', ?)",
+                                 (vietnam_now_isoformat(),))
+                
+                self.fts_enabled = self._init_search_index(conn)
+                
                 conn.commit()
                 logger.info("Database initialized successfully")
         except sqlite3.Error as e:
             logger.error(f"Database initialization error: {e}")
             raise
     
+    def _init_search_index(self, conn):
+        """Tạo bảng FTS5 (trigram) cho tìm kiếm tên file, đồng bộ với files/folders bằng trigger
+
+        Trả về False nếu SQLite không hỗ trợ FTS5 trigram (< 3.34) - khi đó search dùng LIKE.
+        """
+        try:
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                    original_filename, folder_path, extension, tokenize = 'trigram'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 trigram not available, filename search falls back to LIKE: {e}")
+            return False
+        
+        # rowid của files_fts = files.id
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_files_fts_insert AFTER INSERT ON files
+            BEGIN
+                INSERT INTO files_fts (rowid, original_filename, folder_path, extension)
+                VALUES (NEW.id, NEW.original_filename,
+                        (SELECT path FROM folders WHERE id = NEW.folder_id), NEW.extension);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_files_fts_delete AFTER DELETE ON files
+            BEGIN
+                DELETE FROM files_fts WHERE rowid = OLD.id;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_files_fts_update
+            AFTER UPDATE OF original_filename, folder_id, extension ON files
+            BEGIN
+                UPDATE files_fts SET
+                    original_filename = NEW.original_filename,
+                    folder_path = (SELECT path FROM folders WHERE id = NEW.folder_id),
+                    extension = NEW.extension
+                WHERE rowid = NEW.id;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_folders_fts_path AFTER UPDATE OF path ON folders
+            BEGIN
+                UPDATE files_fts SET folder_path = NEW.path
+                WHERE rowid IN (SELECT id FROM files WHERE folder_id = NEW.id);
+            END
+        """)
+        
+        # Migration: index các file đã có trước khi có bảng FTS
+        applied = conn.execute("SELECT 1 FROM schema_migrations WHERE name = 'files_fts_backfill'").fetchone()
+        if not applied:
+            conn.execute("DELETE FROM files_fts")
+            conn.execute("""
+                INSERT INTO files_fts (rowid, original_filename, folder_path, extension)
+                SELECT f.id, f.original_filename, d.path, f.extension
+                FROM files f LEFT JOIN folders d ON d.id = f.folder_id
+            """)
+            conn.execute("INSERT INTO schema_migrations (name, applied_at) VALUES ('files_fts_backfill', ?)",
+                         (vietnam_now_isoformat(),))
+        return True
+    
     def add_file(self, filename, original_filename, size, uploader="Anonymous", user_id=None, temp_path=None, folder_id=None):
         """Thêm file mới vào database với user context"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.execute("""
-                    INSERT INTO files (filename, original_filename, size, uploader, user_id, status, temp_path, folder_id, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, 'uploading', ?, ?, ?, ?)
-                """, (filename, original_filename, size, uploader, user_id, temp_path, folder_id, vietnam_now_isoformat(), vietnam_now_isoformat()))
+                    INSERT INTO files (filename, original_filename, extension, size, uploader, user_id, status, temp_path, folder_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, 'uploading', ?, ?, ?, ?)
+                """, (filename, original_filename, get_file_extension(original_filename), size, uploader, user_id, temp_path, folder_id, vietnam_now_isoformat(), vietnam_now_isoformat()))
                 
                 file_id = cursor.lastrowid
                 conn.commit()
@@ -96,7 +399,7 @@ class FileDatabase:
     def update_file_status(self, file_id, status, file_path=None):
         """Cập nhật trạng thái file"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 if file_path:
                     conn.execute("""
                         UPDATE files 
@@ -120,7 +423,7 @@ class FileDatabase:
     def get_file_by_id(self, file_id):
         """Lấy thông tin file theo ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,))
                 result = cursor.fetchone()
@@ -132,7 +435,7 @@ class FileDatabase:
     def get_file_by_filename(self, filename):
         """Lấy thông tin file theo tên file"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.execute("SELECT * FROM files WHERE filename = ?", (filename,))
                 result = cursor.fetchone()
@@ -147,8 +450,7 @@ class FileDatabase:
             return None
             
         try:
-            auth_db_path = os.path.join(os.path.dirname(self.db_path), "auth.db")
-            with sqlite3.connect(auth_db_path) as conn:
+            with self.auth_pool.connection() as conn:
                 cursor = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,))
                 result = cursor.fetchone()
                 return result[0] if result else None
@@ -156,48 +458,191 @@ class FileDatabase:
             logger.error(f"Error getting username by ID {user_id}: {e}")
             return None
     
-    def get_all_files(self, status=None, limit=None, offset=0, user_id=None):
-        """Lấy danh sách files theo user (nếu user_id được cung cấp)"""
+    def _build_file_filters(self, status=None, user_id=None, folder_id=None, extension=None, prefix=''):
+        """Tạo điều kiện WHERE chung cho các truy vấn danh sách files (prefix = alias bảng khi JOIN)"""
+        where_conditions = [f"{prefix}status != 'deleted'"]  # FIX: Exclude deleted files
+        params = []
+        
+        if status:
+            where_conditions.append(f"{prefix}status = ?")
+            params.append(status)
+        
+        if user_id is not None:
+            where_conditions.append(f"{prefix}user_id = ?")
+            params.append(user_id)
+        
+        if folder_id == ROOT_FOLDER:
+            where_conditions.append(f"{prefix}folder_id IS NULL")
+        elif folder_id:
+            where_conditions.append(f"{prefix}folder_id = ?")
+            params.append(folder_id)
+        
+        if extension:
+            extension = extension.lower()
+            if not extension.startswith('.'):
+                extension = f".{extension}"
+            where_conditions.append(f"{prefix}extension = ?")
+            params.append(extension)
+        
+        return where_conditions, params
+    
+    def get_all_files(self, status=None, limit=None, offset=0, user_id=None, folder_id=None,
+                      extension=None, sort='created_at', order='desc', cursor=None):
+        """Lấy danh sách files theo user (nếu user_id được cung cấp)
+
+        Hỗ trợ lọc theo status/folder/extension, sort phía server và keyset pagination
+        qua `cursor` (vị trí dòng cuối của trang trước) thay cho OFFSET.
+        """
+        sort_column = FILE_SORT_COLUMNS.get(sort)
+        if not sort_column:
+            raise ValueError(f"Invalid sort field: {sort}")
+        direction = 'ASC' if str(order).lower() == 'asc' else 'DESC'
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 conn.row_factory = sqlite3.Row
                 
-                # Build query với user filtering
-                where_conditions = ["status != 'deleted'"]  # FIX: Exclude deleted files
-                params = []
+                where_conditions, params = self._build_file_filters(status, user_id, folder_id, extension)
                 
-                if status:
-                    where_conditions.append("status = ?")
-                    params.append(status)
+                if cursor:
+                    # Keyset: lấy các dòng nằm sau (giá trị sort, id) của cursor theo chiều sort
+                    sort_value, last_id = decode_cursor(cursor)
+                    comparator = '>' if direction == 'ASC' else '<'
+                    where_conditions.append(f"({sort_column}, id) {comparator} (?, ?)")
+                    params.extend([sort_value, last_id])
                 
-                if user_id is not None:
-                    where_conditions.append("user_id = ?")
-                    params.append(user_id)
-                
-                # Build complete query
-                query = "SELECT * FROM files"
-                if where_conditions:
-                    query += " WHERE " + " AND ".join(where_conditions)
-                query += " ORDER BY created_at DESC"
+                query = "SELECT * FROM files WHERE " + " AND ".join(where_conditions)
+                query += f" ORDER BY {sort_column} {direction}, id {direction}"
                 
                 if limit:
-                    query += " LIMIT ? OFFSET ?"
-                    params.extend([limit, offset])
-                
-                logger.info(f"Executing query: {query} with params: {params}")
-                cursor = conn.execute(query, params)
-                results = cursor.fetchall()
-                logger.info(f"Query returned {len(results)} files")
-                
-                # Debug: show first few results
-                for i, row in enumerate(results[:3]):
-                    logger.info(f"File {i+1}: ID={row['id']}, filename={row['filename']}, user_id={row['user_id']}, status={row['status']}")
+                    query += " LIMIT ?"
+                    params.append(limit)
+                    if offset and not cursor:
+                        query += " OFFSET ?"
+                        params.append(offset)
                 
-                return [dict(row) for row in results]
+                logger.debug(f"Executing query: {query} with params: {params}")
+                cursor_result = conn.execute(query, params)
+                return [dict(row) for row in cursor_result.fetchall()]
         except sqlite3.Error as e:
             logger.error(f"Error getting files: {e}")
             return []
     
+    def count_files(self, status=None, user_id=None, folder_id=None, extension=None):
+        """Đếm số files theo bộ lọc (COUNT trên index, không tải dữ liệu)"""
+        try:
+            with self.pool.connection() as conn:
+                where_conditions, params = self._build_file_filters(status, user_id, folder_id, extension)
+                query = "SELECT COUNT(*) FROM files WHERE " + " AND ".join(where_conditions)
+                return conn.execute(query, params).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error counting files: {e}")
+            return 0
+    
+    def get_files_page(self, user_id=None, status=None, folder_id=None, extension=None,
+                       sort='created_at', order='desc', limit=100, cursor=None):
+        """Lấy một trang files kèm cursor cho trang tiếp theo và tổng số file"""
+        # Lấy dư 1 dòng để biết còn trang sau hay không
+        files = self.get_all_files(status=status, limit=limit + 1, user_id=user_id, folder_id=folder_id,
+                                   extension=extension, sort=sort, order=order, cursor=cursor)
+        next_cursor = None
+        if len(files) > limit:
+            files = files[:limit]
+            last = files[-1]
+            next_cursor = encode_cursor(last[FILE_SORT_COLUMNS[sort]], last['id'])
+        
+        return {
+            'files': files,
+            'next_cursor': next_cursor,
+            'total': self.count_files(status=status, user_id=user_id, folder_id=folder_id, extension=extension)
+        }
+    
+    # Trọng số bm25 cho các cột files_fts: tên file > đường dẫn folder > extension
+    SEARCH_RANK = "bm25(files_fts, 10.0, 2.0, 1.0)"
+    # Trigram tokenizer cần ít nhất 3 ký tự để dùng được index
+    MIN_FTS_QUERY_LENGTH = 3
+    # User có ít file hơn ngưỡng này thì quét files của user qua index (user_id, ...) nhanh hơn
+    # MATCH trên toàn bộ files_fts rồi mới lọc theo user
+    SEARCH_SCAN_MAX_FILES = 20000
+    
+    def search_files(self, user_id, query=None, mode='substring', extension=None, limit=50, cursor=None):
+        """Tìm file theo tên trong phạm vi một user, xếp hạng theo độ liên quan và phân trang bằng cursor
+
+        mode: 'substring' (tên file hoặc đường dẫn folder chứa query) hoặc 'prefix' (tên file bắt đầu bằng query).
+        Query >= 3 ký tự trên catalog lớn dùng FTS5 trigram (bm25); query ngắn hoặc user ít file
+        thì LIKE trên các dòng files của user, ưu tiên tên ngắn (khớp sát hơn).
+        """
+        if mode not in ('substring', 'prefix'):
+            raise ValueError(f"Invalid search mode: {mode}")
+        query = (query or '').strip()
+        if not query and not extension:
+            raise ValueError("Search query or extension is required")
+        
+        where_conditions, params = self._build_file_filters(user_id=user_id, extension=extension, prefix='f.')
+        score_params = []
+        use_fts = (self.fts_enabled and len(query) >= self.MIN_FTS_QUERY_LENGTH
+                   and (user_id is None or self._count_user_files(user_id) > self.SEARCH_SCAN_MAX_FILES))
+        
+        if use_fts:
+            # Điểm bm25 càng nhỏ càng liên quan; CROSS JOIN giữ files_fts ở vòng ngoài
+            source = "files_fts CROSS JOIN files f ON f.id = files_fts.rowid"
+            score = self.SEARCH_RANK
+            phrase = '"' + query.replace('"', '""') + '"'
+            where_conditions.append("files_fts MATCH ?")
+            if mode == 'prefix':
+                # MATCH lấy ứng viên qua index trigram, LIKE giữ lại các tên bắt đầu bằng query
+                # (LIKE ... ESCAPE trực tiếp trên files_fts không dùng được index)
+                params.append(f"original_filename : {phrase}")
+                where_conditions.append("f.original_filename LIKE ? ESCAPE '\\'")
+                params.append(f"{escape_like(query)}%")
+            else:
+                params.append(f"{{original_filename folder_path}} : {phrase}")
+        else:
+            source = "files f LEFT JOIN folders d ON d.id = f.folder_id"
+            score = "length(f.original_filename)"
+            if mode == 'prefix' and query:
+                where_conditions.append("f.original_filename LIKE ? ESCAPE '\\'")
+                params.append(f"{escape_like(query)}%")
+            elif query:
+                # Khớp theo tên file xếp trước khớp theo đường dẫn folder
+                pattern = f"%{escape_like(query)}%"
+                score = f"(f.original_filename NOT LIKE ? ESCAPE '\\') * 1000 + {score}"
+                score_params.append(pattern)
+                where_conditions.append("(f.original_filename LIKE ? ESCAPE '\\' OR d.path LIKE ? ESCAPE '\\')")
+                params.extend([pattern, pattern])
+        
+        sql = f"SELECT * FROM (SELECT f.*, {score} AS score FROM {source} WHERE {' AND '.join(where_conditions)})"
+        if cursor:
+            last_score, last_id = decode_cursor(cursor)
+            sql += " WHERE (score, id) > (?, ?)"
+            params.extend([last_score, last_id])
+        sql += " ORDER BY score, id LIMIT ?"
+        params = score_params + params + [limit + 1]
+        
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                files = [dict(row) for row in conn.execute(sql, params).fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error searching files: {e}")
+            return {'files': [], 'next_cursor': None}
+        
+        next_cursor = None
+        if len(files) > limit:
+            files = files[:limit]
+            next_cursor = encode_cursor(files[-1]['score'], files[-1]['id'])
+        return {'files': files, 'next_cursor': next_cursor}
+    
+    def _count_user_files(self, user_id):
+        """Số file của user từ bộ đếm user_stats (một lần tra PK)"""
+        try:
+            with self.pool.connection() as conn:
+                row = conn.execute("SELECT total_files FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+                return row[0] if row else 0
+        except sqlite3.Error as e:
+            logger.error(f"Error counting files for user {user_id}: {e}")
+            return 0
+    
     def get_user_files(self, user_id, status=None):
         """Lấy tất cả files của một user cụ thể"""
         return self.get_all_files(status=status, user_id=user_id)
@@ -205,7 +650,7 @@ class FileDatabase:
     def get_files_by_folder(self, folder_id, user_id=None):
         """Lấy tất cả files trong một folder cụ thể"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 conn.row_factory = sqlite3.Row
                 
                 if user_id:
@@ -229,10 +674,194 @@ class FileDatabase:
             logger.error(f"Error getting files by folder: {e}")
             return []
     
+    def get_files_by_ids(self, file_ids, user_id=None):
+        """Lấy nhiều file theo danh sách ID trong một truy vấn (dùng cho kiểm tra quyền hàng loạt)"""
+        if not file_ids:
+            return []
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                # json_each cho phép truyền cả danh sách ID qua một tham số duy nhất
+                query = """
+                    SELECT * FROM files
+                    WHERE id IN (SELECT value FROM json_each(?)) AND status != 'deleted'
+                """
+                params = [json.dumps([int(file_id) for file_id in file_ids])]
+                if user_id is not None:
+                    query += " AND user_id = ?"
+                    params.append(user_id)
+                cursor = conn.execute(query, params)
+                return [dict(row) for row in cursor.fetchall()]
+        except (sqlite3.Error, ValueError, TypeError) as e:
+            logger.error(f"Error getting files by IDs: {e}")
+            return []
+
+    def get_files_in_folders(self, folder_ids, user_id=None):
+        """Lấy tất cả files thuộc một tập folder trong một truy vấn"""
+        if not folder_ids:
+            return []
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                query = """
+                    SELECT * FROM files
+                    WHERE folder_id IN (SELECT value FROM json_each(?)) AND status != 'deleted'
+                """
+                params = [json.dumps([str(folder_id) for folder_id in folder_ids])]
+                if user_id is not None:
+                    query += " AND user_id = ?"
+                    params.append(user_id)
+                query += " ORDER BY folder_id, created_at"
+                cursor = conn.execute(query, params)
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error getting files in folders: {e}")
+            return []
+
+    # ==================== FOLDER METHODS ====================
+    
+    def migrate_legacy_folders(self, json_path):
+        """Migration một lần: chuyển folders từ file JSON cũ sang bảng folders"""
+        try:
+            # BEGIN IMMEDIATE để chỉ một worker process thực hiện migration
+            with self.pool.transaction() as conn:
+                applied = conn.execute(
+                    "SELECT 1 FROM schema_migrations WHERE name = 'legacy_folders_json'"
+                ).fetchone()
+                if applied:
+                    conn.rollback()
+                    return 0
+                
+                folders = []
+                if os.path.exists(json_path):
+                    with open(json_path, 'r', encoding='utf-8') as f:
+                        folders = json.load(f).get("folders", [])
+                
+                conn.executemany("""
+                    INSERT OR IGNORE INTO folders (id, name, path, parent_id, user_id, username, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (folder["id"], folder["name"], folder.get("path") or folder["name"], folder.get("parent_id"),
+                     folder.get("user_id"), folder.get("username"), folder.get("created_time"))
+                    for folder in folders if folder.get("user_id") is not None
+                ])
+                conn.execute("INSERT INTO schema_migrations (name, applied_at) VALUES ('legacy_folders_json', ?)",
+                             (vietnam_now_isoformat(),))
+                conn.commit()
+                logger.info(f"Migrated {len(folders)} folders from legacy JSON: {json_path}")
+                return len(folders)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.error(f"Error migrating legacy folders: {e}")
+            return 0
+    
+    def create_folder(self, folder_id, name, path, user_id, username=None, parent_id=None):
+        """Tạo folder mới cho user"""
+        try:
+            with self.pool.connection() as conn:
+                conn.execute("""
+                    INSERT INTO folders (id, name, path, parent_id, user_id, username, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (folder_id, name, path, parent_id, user_id, username, vietnam_now_isoformat()))
+                conn.commit()
+                logger.info(f"Folder added to database: {name} (ID: {folder_id})")
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Error creating folder: {e}")
+            return False
+    
+    def get_folder(self, folder_id, user_id=None):
+        """Lấy thông tin folder theo ID (chỉ trong folders của user nếu có user_id)"""
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                if user_id is not None:
+                    cursor = conn.execute("SELECT * FROM folders WHERE id = ? AND user_id = ?", (folder_id, user_id))
+                else:
+                    cursor = conn.execute("SELECT * FROM folders WHERE id = ?", (folder_id,))
+                result = cursor.fetchone()
+                return dict(result) if result else None
+        except sqlite3.Error as e:
+            logger.error(f"Error getting folder: {e}")
+            return None
+    
+    def get_user_folders(self, user_id, parent_id=None):
+        """Lấy folders của user; parent_id lọc theo folder cha ('root' = folder cấp gốc)"""
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                if parent_id == ROOT_FOLDER:
+                    cursor = conn.execute("""
+                        SELECT * FROM folders WHERE user_id = ? AND parent_id IS NULL ORDER BY name
+                    """, (user_id,))
+                elif parent_id is not None:
+                    cursor = conn.execute("""
+                        SELECT * FROM folders WHERE user_id = ? AND parent_id = ? ORDER BY name
+                    """, (user_id, parent_id))
+                else:
+                    cursor = conn.execute("SELECT * FROM folders WHERE user_id = ?", (user_id,))
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error getting user folders: {e}")
+            return []
+    
+    def get_folder_subtree(self, folder_id, user_id):
+        """Lấy folder và toàn bộ folder con (recursive CTE), kèm đường dẫn tương đối từ folder gốc
+
+        Hàng đợi của recursive CTE là FIFO nên kết quả theo thứ tự depth, folder gốc đứng đầu.
+        """
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                cursor = conn.execute("""
+                    WITH RECURSIVE subtree(id, name, path, parent_id, user_id, username, created_at, relative_path, depth) AS (
+                        SELECT id, name, path, parent_id, user_id, username, created_at, name, 0
+                        FROM folders WHERE id = ? AND user_id = ?
+                        UNION ALL
+                        SELECT f.id, f.name, f.path, f.parent_id, f.user_id, f.username, f.created_at,
+                               s.relative_path || '/' || f.name, s.depth + 1
+                        FROM folders f
+                        JOIN subtree s ON f.user_id = s.user_id AND f.parent_id = s.id
+                    )
+                    SELECT * FROM subtree
+                """, (folder_id, user_id))
+                return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error getting folder subtree: {e}")
+            return []
+    
+    def delete_folder_tree(self, folder_id, user_id):
+        """Xóa folder và toàn bộ folder con trong một câu lệnh, trả về số folder đã xóa"""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.execute("""
+                    WITH RECURSIVE subtree(id, user_id) AS (
+                        SELECT id, user_id FROM folders WHERE id = ? AND user_id = ?
+                        UNION ALL
+                        SELECT f.id, f.user_id FROM folders f
+                        JOIN subtree s ON f.user_id = s.user_id AND f.parent_id = s.id
+                    )
+                    DELETE FROM folders WHERE id IN (SELECT id FROM subtree)
+                """, (folder_id, user_id))
+                conn.commit()
+                logger.info(f"Deleted {cursor.rowcount} folders (root: {folder_id})")
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting folder tree: {e}")
+            return 0
+    
+    def count_user_folders(self, user_id):
+        """Đếm số folders của user"""
+        try:
+            with self.pool.connection() as conn:
+                return conn.execute("SELECT COUNT(*) FROM folders WHERE user_id = ?", (user_id,)).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error counting folders: {e}")
+            return 0
+    
     def delete_file(self, file_id):
         """Xóa file khỏi database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
                 conn.commit()
                 
@@ -246,42 +875,250 @@ class FileDatabase:
             logger.error(f"Error deleting file: {e}")
             return False
     
-    def get_file_stats(self):
-        """Lấy thống kê files"""
+    # ==================== ADMIN METHODS ====================
+    
+    def get_admin_files_page(self, user_id=None, status=None, extension=None, search=None,
+                             created_from=None, created_to=None, sort='created_at', order='desc',
+                             limit=100, cursor=None):
+        """Danh sách files toàn hệ thống cho admin: JOIN username trong SQL, lọc, sort và keyset pagination"""
+        sort_column = FILE_SORT_COLUMNS.get(sort)
+        if not sort_column:
+            raise ValueError(f"Invalid sort field: {sort}")
+        direction = 'ASC' if str(order).lower() == 'asc' else 'DESC'
+        
+        where_conditions, params = self._build_file_filters(status, user_id, None, extension, prefix='f.')
+        if search:
+            where_conditions.append("f.original_filename LIKE ? ESCAPE '\\'")
+            escaped = escape_like(search)
+            params.append(f"%{escaped}%")
+        if created_from:
+            where_conditions.append("f.created_at >= ?")
+            params.append(created_from)
+        if created_to:
+            where_conditions.append("f.created_at < ?")
+            params.append(created_to)
+        count_conditions, count_params = list(where_conditions), list(params)
+        
+        if cursor:
+            sort_value, last_id = decode_cursor(cursor)
+            comparator = '>' if direction == 'ASC' else '<'
+            where_conditions.append(f"(f.{sort_column}, f.id) {comparator} (?, ?)")
+            params.extend([sort_value, last_id])
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT 
-                        COUNT(*) as total_files,
-                        COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_files,
-                        COUNT(CASE WHEN status = 'uploading' THEN 1 END) as uploading_files,
-                        COUNT(CASE WHEN status = 'paused' THEN 1 END) as paused_files,
-                        COALESCE(SUM(CASE WHEN status = 'completed' THEN size ELSE 0 END), 0) as total_size
-                    FROM files
-                """)
-                
-                result = cursor.fetchone()
-                return {
-                    'total_files': result[0],
-                    'completed_files': result[1],
-                    'uploading_files': result[2],
-                    'paused_files': result[3],
-                    'total_size': result[4]
-                }
-        except sqlite3.Error as e:
-            logger.error(f"Error getting file stats: {e}")
-            return {
-                'total_files': 0,
-                'completed_files': 0,
-                'uploading_files': 0,
-                'paused_files': 0,
-                'total_size': 0
-            }
+            with self.joined_pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                rows = conn.execute(f"""
+                    SELECT f.*, COALESCE(u.username, 'Unknown') AS username
+                    FROM files f
+                    LEFT JOIN auth.users u ON u.id = f.user_id
+                    WHERE {" AND ".join(where_conditions)}
+                    ORDER BY f.{sort_column} {direction}, f.id {direction}
+                    LIMIT ?
+                """, params + [limit + 1]).fetchall()
+                total = conn.execute(
+                    "SELECT COUNT(*) FROM files f WHERE " + " AND ".join(count_conditions), count_params
+                ).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error getting admin files: {e}")
+            return {'files': [], 'next_cursor': None, 'total': 0}
+        
+        files = [dict(row) for row in rows]
+        next_cursor = None
+        if len(files) > limit:
+            files = files[:limit]
+            next_cursor = encode_cursor(files[-1][sort_column], files[-1]['id'])
+        return {'files': files, 'next_cursor': next_cursor, 'total': total}
+    
+    # Các cột được phép sort trong danh sách users của admin
+    ADMIN_USER_SORT_COLUMNS = {
+        'id': 'u.id',
+        'username': 'u.username',
+        'created_at': 'u.created_at',
+        'last_login': 'u.last_login',
+        'total_files': 'total_files',
+        'total_size': 'total_size',
+    }
+    
+    def get_admin_users_page(self, search=None, role=None, sort='id', order='asc', page=1, page_size=50):
+        """Danh sách users cho admin kèm số file / dung lượng của từng user (JOIN với user_stats)"""
+        sort_column = self.ADMIN_USER_SORT_COLUMNS.get(sort)
+        if not sort_column:
+            raise ValueError(f"Invalid sort field: {sort}")
+        direction = 'ASC' if str(order).lower() == 'asc' else 'DESC'
+        
+        where_conditions = ["1 = 1"]
+        params = []
+        if search:
+            where_conditions.append("u.username LIKE ?")
+            params.append(f"%{search}%")
+        if role:
+            where_conditions.append("u.role = ?")
+            params.append(role)
+        where = " AND ".join(where_conditions)
+        
+        try:
+            with self.joined_pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                rows = conn.execute(f"""
+                    SELECT u.id, u.username, u.role, u.created_at, u.last_login,
+                           COALESCE(s.total_files, 0) AS total_files,
+                           COALESCE(s.completed_files, 0) AS completed_files,
+                           COALESCE(s.completed_bytes, 0) AS total_size,
+                           COALESCE(s.folder_count, 0) AS total_folders
+                    FROM auth.users u
+                    LEFT JOIN user_stats s ON s.user_id = u.id
+                    WHERE {where}
+                    ORDER BY {sort_column} {direction}, u.id {direction}
+                    LIMIT ? OFFSET ?
+                """, params + [page_size, (page - 1) * page_size]).fetchall()
+                total = conn.execute(f"SELECT COUNT(*) FROM auth.users u WHERE {where}", params).fetchone()[0]
+                return {'users': [dict(row) for row in rows], 'total': total, 'page': page, 'page_size': page_size}
+        except sqlite3.Error as e:
+            logger.error(f"Error getting admin users: {e}")
+            return {'users': [], 'total': 0, 'page': page, 'page_size': page_size}
+    
+    def count_uploads_between(self, start, end):
+        """Đếm số file được upload trong khoảng [start, end) bằng range query trên index created_at"""
+        try:
+            with self.pool.connection() as conn:
+                return conn.execute("""
+                    SELECT COUNT(*) FROM files
+                    WHERE created_at >= ? AND created_at < ? AND status != 'deleted'
+                """, (start, end)).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error counting uploads: {e}")
+            return 0
+    
+    def get_daily_upload_counts(self, days=7):
+        """Số upload theo từng ngày (giờ Việt Nam) trong `days` ngày gần nhất"""
+        today = get_vietnam_time().date()
+        counts = []
+        for offset in range(days - 1, -1, -1):
+            day = today - timedelta(days=offset)
+            counts.append({
+                'date': day.isoformat(),
+                'count': self.count_uploads_between(day.isoformat(), (day + timedelta(days=1)).isoformat())
+            })
+        return counts
+    
+    # ==================== USER STATS METHODS ====================
+    
+    def _rebuild_user_stats(self, conn, user_id=None):
+        """Tính lại bộ đếm từ bảng files/folders (trong transaction của conn)"""
+        owner = "COALESCE(user_id, 0)"
+        files_where = "WHERE 1 = 1"
+        stats_where = ""
+        params = []
+        if user_id is not None:
+            files_where = f"WHERE {owner} = ?"
+            stats_where = "WHERE user_id = ?"
+            params = [user_id]
+        
+        conn.execute(f"DELETE FROM user_stats {stats_where}", params)
+        conn.execute(f"DELETE FROM user_extension_stats {stats_where}", params)
+        status_sums = ", ".join(f"SUM(status IS '{status}')" for status in STATS_STATUSES)
+        status_columns = ", ".join(f"{status}_files" for status in STATS_STATUSES)
+        conn.execute(f"""
+            INSERT INTO user_stats (user_id, total_files, {status_columns}, completed_bytes, updated_at)
+            SELECT {owner}, SUM(status IS NOT 'deleted'), {status_sums},
+                   COALESCE(SUM(CASE WHEN status = 'completed' THEN size ELSE 0 END), 0), CURRENT_TIMESTAMP
+            FROM files {files_where}
+            GROUP BY {owner}
+        """, params)
+        conn.execute(f"""
+            INSERT INTO user_stats (user_id, folder_count, updated_at)
+            SELECT user_id, COUNT(*), CURRENT_TIMESTAMP FROM folders {stats_where or "WHERE 1 = 1"}
+            GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET folder_count = excluded.folder_count
+        """, params)
+        conn.execute(f"""
+            INSERT INTO user_extension_stats (user_id, extension, file_count)
+            SELECT {owner}, extension, COUNT(*) FROM files
+            {files_where} AND status = 'completed' AND COALESCE(extension, '') != ''
+            GROUP BY {owner}, extension
+        """, params)
+    
+    def rebuild_user_stats(self, user_id=None):
+        """Job sửa chữa: tính lại toàn bộ bộ đếm thống kê (hoặc của một user) từ đầu"""
+        try:
+            with self.pool.transaction() as conn:
+                self._rebuild_user_stats(conn, user_id)
+                conn.commit()
+                logger.info(f"Rebuilt user stats (user: {user_id if user_id is not None else 'all'})")
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Error rebuilding user stats: {e}")
+            return False
+    
+    def _format_stats(self, row, file_types):
+        """Chuyển dòng user_stats thành format API"""
+        return {
+            'total_files': row['total_files'] if row else 0,
+            'completed_files': row['completed_files'] if row else 0,
+            'uploading_files': row['uploading_files'] if row else 0,
+            'paused_files': row['paused_files'] if row else 0,
+            'error_files': row['error_files'] if row else 0,
+            'total_folders': row['folder_count'] if row else 0,
+            'total_size': row['completed_bytes'] if row else 0,
+            'file_types': file_types
+        }
+    
+    def get_user_stats(self, user_id):
+        """Lấy thống kê của user từ bộ đếm (O(1), không quét bảng files)"""
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                row = conn.execute("SELECT * FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+                file_types = dict(conn.execute("""
+                    SELECT extension, file_count FROM user_extension_stats WHERE user_id = ?
+                """, (user_id,)).fetchall())
+                return self._format_stats(row, file_types)
+        except sqlite3.Error as e:
+            logger.error(f"Error getting user stats: {e}")
+            return self._format_stats(None, {})
+    
+    def get_user_used_bytes(self, user_id):
+        """Tổng dung lượng file completed của user từ bộ đếm user_stats (kiểm tra hạn mức)"""
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT completed_bytes FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+    
+    def get_global_stats(self):
+        """Lấy thống kê toàn hệ thống bằng cách cộng bộ đếm của các user"""
+        try:
+            with self.pool.connection() as conn:
+                conn.row_factory = sqlite3.Row
+                status_sums = ", ".join(f"COALESCE(SUM({status}_files), 0) AS {status}_files" for status in STATS_STATUSES)
+                row = conn.execute(f"""
+                    SELECT COALESCE(SUM(total_files), 0) AS total_files, {status_sums},
+                           COALESCE(SUM(completed_bytes), 0) AS completed_bytes,
+                           COALESCE(SUM(folder_count), 0) AS folder_count
+                    FROM user_stats
+                """).fetchone()
+                file_types = dict(conn.execute("""
+                    SELECT extension, SUM(file_count) FROM user_extension_stats GROUP BY extension
+                """).fetchall())
+                return self._format_stats(row, file_types)
+        except sqlite3.Error as e:
+            logger.error(f"Error getting global stats: {e}")
+            return self._format_stats(None, {})
+    
+    def get_file_stats(self):
+        """Lấy thống kê files (từ bộ đếm user_stats)"""
+        stats = self.get_global_stats()
+        return {
+            'total_files': stats['total_files'],
+            'completed_files': stats['completed_files'],
+            'uploading_files': stats['uploading_files'],
+            'paused_files': stats['paused_files'],
+            'total_size': stats['total_size']
+        }
     
     def get_file_by_id(self, file_id):
         """Lấy thông tin file theo ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,))
                 result = cursor.fetchone()
@@ -293,15 +1130,15 @@ class FileDatabase:
     def update_file_path(self, file_id, new_path):
         """Cập nhật đường dẫn file"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
+            with self.pool.connection() as conn:
+                cursor = conn.execute("""
                     UPDATE files 
                     SET file_path = ?, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, (new_path, file_id))
                 conn.commit()
                 
-                if conn.total_changes > 0:
+                if cursor.rowcount > 0:
                     logger.info(f"Updated file path for ID {file_id}: {new_path}")
                     return True
                 else:
@@ -314,15 +1151,15 @@ class FileDatabase:
     def update_file_folder(self, file_id, folder_id):
         """Cập nhật folder_id của file"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
+            with self.pool.connection() as conn:
+                cursor = conn.execute("""
                     UPDATE files 
                     SET folder_id = ?, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, (folder_id, file_id))
                 conn.commit()
                 
-                if conn.total_changes > 0:
+                if cursor.rowcount > 0:
                     logger.info(f"Updated file folder for ID {file_id}: {folder_id}")
                     return True
                 else:
@@ -335,15 +1172,15 @@ class FileDatabase:
     def update_file_name(self, file_id, new_name, new_path):
         """Cập nhật tên file và đường dẫn file"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
+            with self.pool.connection() as conn:
+                cursor = conn.execute("""
                     UPDATE files 
-                    SET original_filename = ?, file_path = ?, updated_at = CURRENT_TIMESTAMP 
+                    SET original_filename = ?, extension = ?, file_path = ?, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
-                """, (new_name, new_path, file_id))
+                """, (new_name, get_file_extension(new_name), new_path, file_id))
                 conn.commit()
                 
-                if conn.total_changes > 0:
+                if cursor.rowcount > 0:
                     logger.info(f"Updated file name for ID {file_id}: {new_name} -> {new_path}")
                     return True
                 else:
@@ -353,37 +1190,47 @@ class FileDatabase:
             logger.error(f"Error updating file name: {e}")
             return False
     
-    def cleanup_temp_files(self):
-        """Dọn dẹp các file tạm cũ (có thể chạy định kỳ)"""
+    # Số dòng xóa/cập nhật mỗi transaction của các job dọn dẹp (giữ write lock ngắn)
+    CLEANUP_BATCH_SIZE = 500
+    
+    def cleanup_stuck_uploads(self, max_age_minutes=30, batch_size=None):
+        """Xóa các file kẹt ở trạng thái uploading lâu hơn max_age_minutes (theo lô, mỗi lô một transaction)"""
+        batch_size = batch_size or self.CLEANUP_BATCH_SIZE
+        cutoff = (get_vietnam_time() - timedelta(minutes=max_age_minutes)).isoformat()
+        deleted_count = 0
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # Xóa các file uploading cũ hơn 24h
-                conn.execute("""
-                    DELETE FROM files 
-                    WHERE status = 'uploading' 
-                    AND datetime(created_at) < datetime('now', '-1 day')
-                """)
-                
-                deleted_count = conn.total_changes
-                conn.commit()
-                
-                if deleted_count > 0:
-                    logger.info(f"Cleaned up {deleted_count} old temp files")
-                
-                return deleted_count
+            while True:
+                with self.pool.transaction() as conn:
+                    cursor = conn.execute("""
+                        DELETE FROM files WHERE id IN (
+                            SELECT id FROM files
+                            WHERE status = 'uploading' AND created_at < ?
+                            LIMIT ?
+                        )
+                    """, (cutoff, batch_size))
+                deleted_count += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
         except sqlite3.Error as e:
-            logger.error(f"Error cleaning up temp files: {e}")
-            return 0
+            logger.error(f"Error cleaning up stuck uploads: {e}")
+        
+        if deleted_count > 0:
+            logger.info(f"Cleaned up {deleted_count} stuck uploads")
+        return deleted_count
+    
+    def cleanup_temp_files(self):
+        """Dọn dẹp các file tạm cũ (uploading quá 24h)"""
+        return self.cleanup_stuck_uploads(max_age_minutes=24 * 60)
     
     # ==================== RECYCLE BIN METHODS ====================
     
-    def move_to_recycle_bin(self, file_id, deleted_by_user_id, days_to_keep=30):
-        """Di chuyển file vào thùng rác"""
+    def move_to_recycle_bin(self, file_id, deleted_by_user_id, days_to_keep=30, trash_path=None):
+        """Di chuyển file vào thùng rác (trash_path: nơi file vật lý đã được rename tới, tương đối với UPLOAD_FOLDER)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 # Lấy thông tin file
                 cursor = conn.execute("""
-                    SELECT filename, original_filename, size, user_id, file_path 
+                    SELECT filename, original_filename, size, user_id, file_path, content_hash
                     FROM files WHERE id = ?
                 """, (file_id,))
                 
@@ -391,7 +1238,7 @@ class FileDatabase:
                 if not file_info:
                     return False
                 
-                filename, original_filename, size, user_id, file_path = file_info
+                filename, original_filename, size, user_id, file_path, content_hash = file_info
                 
                 # Tính restore deadline với timezone Việt Nam
                 vietnam_time = get_vietnam_time()
@@ -401,11 +1248,11 @@ class FileDatabase:
                 conn.execute("""
                     INSERT INTO recycle_bin 
                     (original_file_id, filename, original_filename, size, user_id, 
-                     file_path, deleted_by, deleted_at, restore_deadline) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     file_path, trash_path, content_hash, deleted_by, deleted_at, restore_deadline) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, 
-                (file_id, filename, original_filename, size, user_id, file_path, deleted_by_user_id, 
-                 vietnam_time.isoformat(), restore_deadline.isoformat()))
+                (file_id, filename, original_filename, size, user_id, file_path, trash_path, content_hash,
+                 deleted_by_user_id, vietnam_time.isoformat(), restore_deadline.isoformat()))
                 
                 # Xóa khỏi bảng files chính
                 conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
@@ -421,7 +1268,7 @@ class FileDatabase:
     def get_recycle_bin_files(self, user_id=None):
         """Lấy danh sách file trong thùng rác với username thật"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 if user_id:
                     cursor = conn.execute("""
                         SELECT r.id, r.original_file_id, r.filename, r.original_filename, 
@@ -471,14 +1318,30 @@ class FileDatabase:
             logger.error(f"Error getting recycle bin files: {e}")
             return []
     
-    def restore_from_recycle_bin(self, recycle_id, user_id=None):
-        """Khôi phục file từ thùng rác"""
+    def get_recycle_entry(self, recycle_id, user_id=None):
+        """Lấy một file đang nằm trong thùng rác (user_id=None: admin, không giới hạn chủ sở hữu)"""
+        query = """
+            SELECT id, original_filename, size, user_id, file_path, trash_path
+            FROM recycle_bin
+            WHERE id = ? AND status = 'in_recycle'
+        """
+        params = [recycle_id]
+        if user_id:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(query, params).fetchone()
+        return dict(row) if row else None
+    
+    def restore_from_recycle_bin(self, recycle_id, user_id=None, file_path=None):
+        """Khôi phục file từ thùng rác (file_path: đường dẫn mới nếu file vật lý được khôi phục sang tên khác)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 # Lấy thông tin file từ recycle_bin
                 query = """
                     SELECT original_file_id, filename, original_filename, size, 
-                           user_id, file_path, deleted_at 
+                           user_id, file_path, deleted_at, content_hash
                     FROM recycle_bin 
                     WHERE id = ? AND status = 'in_recycle'
                 """
@@ -495,14 +1358,17 @@ class FileDatabase:
                 if not file_info:
                     return False
                 
-                original_file_id, filename, original_filename, size, owner_id, file_path, deleted_at = file_info
+                original_file_id, filename, original_filename, size, owner_id, original_path, deleted_at, content_hash = file_info
+                file_path = file_path or original_path
                 
                 # Thêm lại vào bảng files chính
                 conn.execute("""
                     INSERT INTO files 
-                    (filename, original_filename, size, user_id, status, file_path, created_at, updated_at) 
-                    VALUES (?, ?, ?, ?, 'completed', ?, ?, CURRENT_TIMESTAMP)
-                """, (filename, original_filename, size, owner_id, file_path, deleted_at))
+                    (filename, original_filename, extension, size, user_id, status, file_path, content_hash,
+                     created_at, updated_at) 
+                    VALUES (?, ?, ?, ?, ?, 'completed', ?, ?, ?, CURRENT_TIMESTAMP)
+                """, (filename, original_filename, get_file_extension(original_filename), size, owner_id, file_path,
+                      content_hash, deleted_at))
                 
                 # Đánh dấu trong recycle_bin là đã restore
                 conn.execute("""
@@ -520,7 +1386,7 @@ class FileDatabase:
     def permanently_delete_from_recycle(self, recycle_id, user_id=None):
         """Xóa vĩnh viễn file từ thùng rác"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 query = """
                     SELECT file_path FROM recycle_bin 
                     WHERE id = ? AND status = 'in_recycle'
@@ -553,34 +1419,429 @@ class FileDatabase:
             logger.error(f"Error permanently deleting file from recycle bin: {e}")
             return False, None
     
-    def cleanup_expired_recycle_files(self):
-        """Dọn dẹp các file hết hạn trong thùng rác"""
+    def cleanup_expired_recycle_files(self, batch_size=None):
+        """Đánh dấu expired các file quá hạn trong thùng rác (theo lô), trả về [(id, file_path)] để xóa file vật lý"""
+        batch_size = batch_size or self.CLEANUP_BATCH_SIZE
+        now = vietnam_now_isoformat()
+        expired_files = []
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # Lấy danh sách file hết hạn
-                cursor = conn.execute("""
-                    SELECT id, file_path FROM recycle_bin 
-                    WHERE status = 'in_recycle' 
-                    AND restore_deadline < datetime('now')
-                """)
-                
-                expired_files = cursor.fetchall()
-                
-                # Đánh dấu các file hết hạn
-                conn.execute("""
-                    UPDATE recycle_bin 
-                    SET status = 'expired' 
-                    WHERE status = 'in_recycle' 
-                    AND restore_deadline < datetime('now')
-                """)
-                
-                conn.commit()
-                logger.info(f"Marked {len(expired_files)} expired recycle bin files")
-                return expired_files
-                
+            while True:
+                with self.pool.transaction() as conn:
+                    batch = conn.execute("""
+                        SELECT id, file_path FROM recycle_bin 
+                        WHERE status = 'in_recycle' AND restore_deadline < ?
+                        LIMIT ?
+                    """, (now, batch_size)).fetchall()
+                    conn.execute("""
+                        UPDATE recycle_bin SET status = 'expired'
+                        WHERE id IN (SELECT value FROM json_each(?))
+                    """, (json.dumps([row[0] for row in batch]),))
+                expired_files.extend(batch)
+                if len(batch) < batch_size:
+                    break
         except sqlite3.Error as e:
             logger.error(f"Error cleaning up expired recycle files: {e}")
+        
+        if expired_files:
+            logger.info(f"Marked {len(expired_files)} expired recycle bin files")
+        return expired_files
+
+    def get_purgeable_recycle_files(self, after_id=0, limit=None):
+        """Các dòng thùng rác đã hết hạn / xóa vĩnh viễn nhưng file vật lý chưa bị xóa (theo id tăng dần)"""
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("""
+                SELECT id, size, file_path, trash_path, content_hash FROM recycle_bin
+                WHERE purged_at IS NULL AND status IN ('expired', 'permanently_deleted') AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (after_id, limit or self.CLEANUP_BATCH_SIZE)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def mark_recycle_files_purged(self, recycle_ids):
+        """Đánh dấu đã xóa file vật lý cho một lô dòng thùng rác (một transaction)"""
+        if not recycle_ids:
+            return 0
+        with self.pool.transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE recycle_bin SET purged_at = ?, trash_path = NULL
+                WHERE id IN (SELECT value FROM json_each(?)) AND purged_at IS NULL
+            """, (vietnam_now_isoformat(), json.dumps(list(recycle_ids))))
+            return cursor.rowcount
+
+    # ==================== BULK METHODS ====================
+    # Dùng cho các API bulk: một truy vấn cho cả danh sách, mọi thay đổi trong một transaction
+    
+    def find_files_by_names(self, user_ids, names):
+        """Tìm file (không phân biệt hoa thường) theo tên trong các user cho trước - kiểm tra trùng tên khi đổi tên hàng loạt"""
+        if not user_ids or not names:
+            return []
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("""
+                SELECT id, user_id, original_filename FROM files
+                WHERE user_id IN (SELECT value FROM json_each(?))
+                  AND lower(original_filename) IN (SELECT value FROM json_each(?))
+                  AND status != 'deleted'
+            """, (json.dumps(list(user_ids)), json.dumps([name.lower() for name in names]))).fetchall()
+        return [dict(row) for row in rows]
+    
+    def move_files_to_recycle_bin(self, entries, deleted_by_user_id, days_to_keep=30):
+        """Chuyển nhiều file vào thùng rác trong một transaction
+        
+        entries: [(file_id, trash_path)]. Trả về danh sách file_id đã chuyển ([] nếu transaction lỗi).
+        """
+        if not entries:
+            return []
+        vietnam_time = get_vietnam_time()
+        restore_deadline = vietnam_time + timedelta(days=days_to_keep)
+        payload = json.dumps([{'id': int(file_id), 'trash_path': trash_path} for file_id, trash_path in entries])
+        try:
+            with self.pool.transaction() as conn:
+                # File upload dở (chưa có file_path) không vào được thùng rác
+                moved = [row[0] for row in conn.execute("""
+                    SELECT f.id FROM json_each(?) j
+                    CROSS JOIN files f ON f.id = json_extract(j.value, '$.id')
+                    WHERE f.file_path IS NOT NULL
+                """, (payload,))]
+                conn.execute("""
+                    INSERT INTO recycle_bin
+                    (original_file_id, filename, original_filename, size, user_id,
+                     file_path, trash_path, content_hash, deleted_by, deleted_at, restore_deadline)
+                    SELECT f.id, f.filename, f.original_filename, f.size, f.user_id,
+                           f.file_path, json_extract(j.value, '$.trash_path'), f.content_hash, ?, ?, ?
+                    FROM json_each(?) j
+                    CROSS JOIN files f ON f.id = json_extract(j.value, '$.id')
+                    WHERE f.file_path IS NOT NULL
+                """, (deleted_by_user_id, vietnam_time.isoformat(), restore_deadline.isoformat(), payload))
+                conn.execute("DELETE FROM files WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(moved),))
+            logger.info(f"Moved {len(moved)} files to recycle bin")
+            return moved
+        except sqlite3.Error as e:
+            logger.error(f"Error moving files to recycle bin: {e}")
+            return []
+    
+    def update_file_locations(self, updates, folder_id=None):
+        """Cập nhật file_path của nhiều file và đặt folder_id (None = thư mục gốc) trong một transaction
+        
+        updates: [(file_id, new_path)]
+        """
+        if not updates:
+            return True
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany("""
+                    UPDATE files
+                    SET file_path = ?, folder_id = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, [(new_path, folder_id, file_id) for file_id, new_path in updates])
+            logger.info(f"Updated location of {len(updates)} files (folder: {folder_id})")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error updating file locations: {e}")
+            return False
+    
+    def rename_files(self, updates):
+        """Đổi tên nhiều file trong một transaction. updates: [(file_id, new_name, new_path)]"""
+        if not updates:
+            return True
+        try:
+            with self.pool.transaction() as conn:
+                conn.executemany("""
+                    UPDATE files
+                    SET original_filename = ?, extension = ?, file_path = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, [(new_name, get_file_extension(new_name), new_path, file_id)
+                      for file_id, new_name, new_path in updates])
+            logger.info(f"Renamed {len(updates)} files")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error renaming files: {e}")
+            return False
+    
+    def get_recycle_entries(self, recycle_ids, user_id=None):
+        """Lấy nhiều file đang nằm trong thùng rác theo ID (user_id=None: admin)"""
+        if not recycle_ids:
+            return []
+        query = """
+            SELECT id, original_filename, size, user_id, file_path, trash_path
+            FROM recycle_bin
+            WHERE id IN (SELECT value FROM json_each(?)) AND status = 'in_recycle'
+        """
+        params = [json.dumps([int(recycle_id) for recycle_id in recycle_ids])]
+        if user_id:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
+    
+    def restore_many_from_recycle_bin(self, entries, user_id=None):
+        """Khôi phục nhiều file trong một transaction. entries: [(recycle_id, file_path)]. Trả về các recycle_id đã khôi phục"""
+        if not entries:
+            return []
+        owner_filter = " AND user_id = ?" if user_id else ""
+        restored = []
+        try:
+            with self.pool.transaction() as conn:
+                names = dict(conn.execute("""
+                    SELECT id, original_filename FROM recycle_bin WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps([recycle_id for recycle_id, _ in entries]),)).fetchall())
+                for recycle_id, file_path in entries:
+                    if recycle_id not in names:
+                        continue
+                    params = [get_file_extension(names[recycle_id]), file_path, recycle_id] + ([user_id] if user_id else [])
+                    cursor = conn.execute(f"""
+                        INSERT INTO files
+                        (filename, original_filename, extension, size, user_id, status, file_path, content_hash,
+                         created_at, updated_at)
+                        SELECT filename, original_filename, ?, size, user_id, 'completed', ?, content_hash,
+                               deleted_at, CURRENT_TIMESTAMP
+                        FROM recycle_bin
+                        WHERE id = ? AND status = 'in_recycle'{owner_filter}
+                    """, params)
+                    if cursor.rowcount:
+                        restored.append(recycle_id)
+                conn.execute("""
+                    UPDATE recycle_bin SET status = 'restored'
+                    WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(restored),))
+            logger.info(f"Restored {len(restored)} files from recycle bin")
+            return restored
+        except sqlite3.Error as e:
+            logger.error(f"Error restoring files from recycle bin: {e}")
             return []
+    
+    def permanently_delete_many_from_recycle(self, recycle_ids, user_id=None):
+        """Xóa vĩnh viễn nhiều file trong thùng rác (file vật lý do job purge xóa). Trả về các recycle_id đã xóa"""
+        if not recycle_ids:
+            return []
+        query = """
+            SELECT id FROM recycle_bin
+            WHERE id IN (SELECT value FROM json_each(?)) AND status = 'in_recycle'
+        """
+        params = [json.dumps([int(recycle_id) for recycle_id in recycle_ids])]
+        if user_id:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        try:
+            with self.pool.transaction() as conn:
+                deleted = [row[0] for row in conn.execute(query, params)]
+                conn.execute("""
+                    UPDATE recycle_bin SET status = 'permanently_deleted'
+                    WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(deleted),))
+            logger.info(f"Permanently deleted {len(deleted)} files from recycle bin")
+            return deleted
+        except sqlite3.Error as e:
+            logger.error(f"Error permanently deleting files from recycle bin: {e}")
+            return []
+
+    # ==================== BLOB STORAGE METHODS ====================
+    # Dùng cho migrate_blobs.py: chuyển file từ cây thư mục username/... sang blobs/<aa>/<bb>/<id>
+    
+    def get_legacy_path_files(self, after_id=0, limit=None):
+        """Các file đã upload xong nhưng còn lưu theo đường dẫn cũ (chưa phải blob), theo id tăng dần"""
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("""
+                SELECT id, user_id, uploader, original_filename, size, file_path FROM files
+                WHERE id > ? AND +status = 'completed' AND file_path IS NOT NULL AND file_path NOT LIKE 'blobs/%'
+                ORDER BY id
+                LIMIT ?
+            """, (after_id, limit or self.CLEANUP_BATCH_SIZE)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def update_file_paths(self, updates):
+        """Cập nhật file_path của nhiều file trong một transaction (không đổi folder). updates: [(file_id, new_path)]"""
+        if not updates:
+            return 0
+        with self.pool.transaction() as conn:
+            cursor = conn.executemany("""
+                UPDATE files SET file_path = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, [(new_path, file_id) for file_id, new_path in updates])
+            return cursor.rowcount
+
+    # ==================== CONTENT-ADDRESSED BLOBS ====================
+    # Upload mới được lưu theo SHA-256 nội dung; file giống nhau dùng chung một blob (đếm tham chiếu)
+    
+    def attach_blob(self, file_id, sha256, size, file_path, store_new):
+        """Hoàn tất upload: trỏ file tới blob có digest sha256, tăng ref_count.
+        
+        Nếu chưa có blob này, gọi store_new() để đặt file vào file_path. store_new chạy trong transaction
+        (đang giữ write lock) nên không xen giữa lúc release_recycled_blobs xóa cùng blob đó.
+        Trả về True nếu dùng lại blob đã có (nội dung trùng), False nếu blob mới được tạo.
+        """
+        with self.pool.transaction() as conn:
+            row = conn.execute("SELECT file_path FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row:
+                file_path = row[0]
+                conn.execute("UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = ?", (sha256,))
+            else:
+                store_new()
+                conn.execute("""
+                    INSERT INTO blobs (sha256, file_path, size, ref_count, created_at) VALUES (?, ?, ?, 1, ?)
+                """, (sha256, file_path, size, vietnam_now_isoformat()))
+            conn.execute("""
+                UPDATE files SET status = 'completed', file_path = ?, content_hash = ?, updated_at = ?
+                WHERE id = ?
+            """, (file_path, sha256, vietnam_now_isoformat(), file_id))
+        return row is not None
+    
+    def release_recycled_blobs(self, recycle_ids, remove):
+        """Purge các dòng thùng rác trỏ tới blob theo nội dung: giảm ref_count, blob nào về 0 thì xóa dòng
+        và gọi remove(file_path) (trả về số byte giải phóng) ngay trong transaction; đánh dấu purged_at.
+        
+        Trả về (số dòng đã purge, số blob đã xóa, số byte giải phóng). Lỗi của remove làm rollback cả lô.
+        """
+        if not recycle_ids:
+            return 0, 0, 0
+        removed = reclaimed_bytes = 0
+        with self.pool.transaction() as conn:
+            references = Counter(row[0] for row in conn.execute("""
+                SELECT content_hash FROM recycle_bin
+                WHERE id IN (SELECT value FROM json_each(?)) AND purged_at IS NULL AND content_hash IS NOT NULL
+            """, (json.dumps(list(recycle_ids)),)))
+            for sha256, count in references.items():
+                conn.execute("UPDATE blobs SET ref_count = ref_count - ? WHERE sha256 = ?", (count, sha256))
+                blob = conn.execute("""
+                    SELECT file_path FROM blobs WHERE sha256 = ? AND ref_count <= 0
+                """, (sha256,)).fetchone()
+                if blob:
+                    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    reclaimed_bytes += remove(blob[0])
+                    removed += 1
+            cursor = conn.execute("""
+                UPDATE recycle_bin SET purged_at = ?, trash_path = NULL
+                WHERE id IN (SELECT value FROM json_each(?)) AND purged_at IS NULL
+            """, (vietnam_now_isoformat(), json.dumps(list(recycle_ids))))
+        if removed:
+            logger.info(f"Released {removed} unreferenced blobs ({reclaimed_bytes} bytes)")
+        return cursor.rowcount, removed, reclaimed_bytes
+    
+    def get_blob(self, sha256):
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("""
+                SELECT sha256, file_path, size, ref_count, codec, stored_size FROM blobs WHERE sha256 = ?
+            """, (sha256,)).fetchone()
+            return dict(row) if row else None
+    
+    def get_uncoded_blobs(self, limit=200):
+        """Blob chưa được đánh giá nén (cũ trước), cho job nén định kỳ"""
+        with self.pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT sha256 FROM blobs WHERE codec IS NULL ORDER BY created_at LIMIT ?
+            """, (limit,)).fetchall()
+            return [row[0] for row in rows]
+    
+    def set_blob_codec(self, sha256, codec, stored_size):
+        """Ghi kết quả nén; chỉ áp dụng cho blob còn tồn tại và chưa có codec. Trả về True nếu đã ghi"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE blobs SET codec = ?, stored_size = ? WHERE sha256 = ? AND codec IS NULL
+            """, (codec, stored_size, sha256))
+            return cursor.rowcount > 0
+    
+    # ==================== STORAGE TIERING ====================
+    
+    def record_file_accesses(self, accesses):
+        """Ghi một lô lượt đọc [(file_id, số lượt, lần đọc cuối)] trong một transaction"""
+        if not accesses:
+            return 0
+        with self.pool.transaction() as conn:
+            cursor = conn.executemany("""
+                UPDATE files SET access_count = access_count + ?,
+                                 last_accessed_at = MAX(COALESCE(last_accessed_at, ''), ?)
+                WHERE id = ?
+            """, [(count, last_accessed_at, file_id) for file_id, count, last_accessed_at in accesses])
+            return cursor.rowcount
+    
+    def get_tiering_candidates(self, cutoff, limit=200):
+        """Blob ở tầng nóng không được đọc (hoặc upload) từ trước cutoff, lâu nhất trước"""
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("""
+                SELECT id, file_path, size FROM files
+                WHERE storage_tier = 'hot' AND file_path LIKE 'blobs/%' AND +status = 'completed'
+                  AND COALESCE(last_accessed_at, created_at) < ?
+                ORDER BY COALESCE(last_accessed_at, created_at)
+                LIMIT ?
+            """, (cutoff, limit)).fetchall()
+            return [dict(row) for row in rows]
+    
+    def is_path_recently_accessed(self, file_path, cutoff):
+        """Có file nào trỏ tới file_path được đọc / upload từ cutoff trở lại không"""
+        with self.pool.connection() as conn:
+            row = conn.execute("""
+                SELECT 1 FROM files
+                WHERE file_path = ? AND COALESCE(last_accessed_at, created_at) >= ?
+                LIMIT 1
+            """, (file_path, cutoff)).fetchone()
+            return row is not None
+    
+    def set_storage_tier(self, file_path, tier):
+        """Đánh dấu tầng lưu trữ cho mọi file trỏ tới file_path"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute("""
+                UPDATE files SET storage_tier = ? WHERE file_path = ? AND storage_tier != ?
+            """, (tier, file_path, tier))
+            return cursor.rowcount
+    
+    def get_storage_report(self):
+        """Dung lượng logic (tổng size các file, kể cả trong thùng rác chưa purge) so với dung lượng vật lý
+        (mỗi blob tính một lần + file chưa vào kho blob) và dung lượng thực trên đĩa sau khi nén"""
+        with self.pool.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            blobs = conn.execute("""
+                SELECT COUNT(*) AS blob_count, COALESCE(SUM(size), 0) AS blob_bytes,
+                       COALESCE(SUM(COALESCE(stored_size, size)), 0) AS blob_stored_bytes,
+                       COALESCE(SUM(codec = 'zstd'), 0) AS compressed_blobs,
+                       COALESCE(SUM(CASE WHEN codec = 'zstd' THEN size END), 0) AS compressed_bytes,
+                       COALESCE(SUM(CASE WHEN codec = 'zstd' THEN stored_size END), 0) AS compressed_stored_bytes,
+                       COALESCE(SUM(codec IS NULL), 0) AS uncoded_blobs,
+                       COALESCE(SUM(ref_count > 1), 0) AS shared_blobs,
+                       COALESCE(SUM(ref_count), 0) AS blob_references
+                FROM blobs
+            """).fetchone()
+            catalog = conn.execute("""
+                SELECT COALESCE(SUM(size), 0) AS logical_bytes,
+                       COALESCE(SUM(CASE WHEN content_hash IS NULL THEN size END), 0) AS unshared_bytes,
+                       COALESCE(SUM(content_hash IS NULL), 0) AS unshared_files,
+                       COUNT(*) AS stored_files
+                FROM (
+                    SELECT size, content_hash FROM files WHERE status = 'completed'
+                    UNION ALL
+                    SELECT size, content_hash FROM recycle_bin WHERE purged_at IS NULL AND status != 'restored'
+                )
+            """).fetchone()
+            tiers = conn.execute("""
+                SELECT COALESCE(SUM(storage_tier = 'cold'), 0) AS cold_files,
+                       COALESCE(SUM(CASE WHEN storage_tier = 'cold' THEN size END), 0) AS cold_bytes
+                FROM files WHERE status = 'completed'
+            """).fetchone()
+        physical_bytes = blobs['blob_bytes'] + catalog['unshared_bytes']
+        stored_bytes = blobs['blob_stored_bytes'] + catalog['unshared_bytes']
+        logical_bytes = catalog['logical_bytes']
+        return {
+            'logical_bytes': logical_bytes,
+            'physical_bytes': physical_bytes,
+            'stored_bytes': stored_bytes,
+            'saved_bytes': logical_bytes - stored_bytes,
+            'dedup_ratio': round(logical_bytes / physical_bytes, 3) if physical_bytes else None,
+            'compression_ratio': (round(blobs['compressed_bytes'] / blobs['compressed_stored_bytes'], 3)
+                                  if blobs['compressed_stored_bytes'] else None),
+            'compressed_blobs': blobs['compressed_blobs'],
+            'uncoded_blobs': blobs['uncoded_blobs'],
+            'cold_files': tiers['cold_files'],
+            'cold_bytes': tiers['cold_bytes'],
+            'stored_files': catalog['stored_files'],
+            'unshared_files': catalog['unshared_files'],
+            'blob_count': blobs['blob_count'],
+            'blob_references': blobs['blob_references'],
+            'shared_blobs': blobs['shared_blobs']
+        }
 
-# Global database instance
-db = FileDatabase()
+# Global database instance (thời gian chạy từng method được ghi vào metric db_query_seconds)
+db = instrument_methods(FileDatabase(), DB_QUERY_SECONDS)
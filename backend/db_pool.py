@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Chờ tối đa (ms) khi database đang bị khóa bởi writer khác thay vì báo lỗi "database is locked" ngay
+BUSY_TIMEOUT_MS = 5000
+# Số prepared statement được cache trên mỗi connection
+STATEMENT_CACHE_SIZE = 256
+# Số connection rảnh tối đa được giữ lại cho mỗi database
+MAX_IDLE_CONNECTIONS = 8
+
+
+class ConnectionPool:
+    """Pool các connection SQLite dùng lại giữa các request/thread.
+
+    Mỗi connection được cấu hình một lần khi mở: WAL (reader không bị writer chặn),
+    busy_timeout, synchronous=NORMAL (an toàn với WAL, ít fsync hơn) và statement cache.
+    Một connection chỉ được một thread dùng tại một thời điểm (checkout/checkin).
+    """
+
+    def __init__(self, db_path, attach=None, max_idle=MAX_IDLE_CONNECTIONS):
+        self.db_path = db_path
+        # {alias: đường dẫn} - các database được ATTACH sẵn trên mọi connection
+        self.attach = dict(attach or {})
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        for alias, path in self.attach.items():
+            conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+            conn.execute(f"PRAGMA {alias}.journal_mode = WAL")
+        return conn
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Mượn một connection; commit khi thoát bình thường, rollback nếu có exception
+
+        Giống `with sqlite3.connect(...) as conn:` nhưng connection được trả lại pool thay vì bỏ đi.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """Transaction tường minh. BEGIN IMMEDIATE lấy write lock ngay từ đầu nên busy_timeout
+        áp dụng được, tránh lỗi "database is locked" khi nâng cấp từ read lên write giữa chừng.
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            yield conn
+
+    def close_all(self):
+        """Đóng các connection đang rảnh (connection đang được mượn sẽ đóng khi trả lại)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.max_idle = 0
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path, attach=None):
+    """Lấy pool dùng chung cho một database (cùng đường dẫn + cùng danh sách ATTACH)"""
+    key = (os.path.abspath(db_path), tuple(sorted((attach or {}).items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path, attach=attach)
+            logger.info(f"Created SQLite connection pool for {db_path}")
+        return pool
@@ -0,0 +1,290 @@
+import os
+import re
+import json
+import wave
+import struct
+import logging
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from storage_codec import open_stored
+
+logger = logging.getLogger(__name__)
+
+# Pillow là tùy chọn: không cài thì không có thumbnail / kích thước ảnh, các metadata khác vẫn có
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DERIVATIVES_ENABLED = os.environ.get('DERIVATIVES_ENABLED', '1') != '0'
+DERIVATIVE_WORKERS = int(os.environ.get('DERIVATIVE_WORKERS', 2))
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))
+# Thời gian tối đa request chờ tạo lại derivative bị thiếu
+DERIVATIVE_TIMEOUT = float(os.environ.get('DERIVATIVE_TIMEOUT', 30))
+# Số giây trình duyệt nên chờ trước khi hỏi lại derivative đang được tạo (202 + Retry-After)
+DERIVATIVE_RETRY_AFTER = 2
+# Process con không được fork từ process Flask đa luồng (có thể thừa hưởng lock logging / sqlite đang bị giữ)
+DERIVATIVE_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Tăng khi đổi cách tạo derivative -> ETag đổi và bản cũ được tạo lại
+DERIVATIVE_VERSION = 1
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+MP4_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.m4a'}
+TEXT_EXTENSIONS = {'.txt', '.md', '.csv', '.log', '.json', '.xml', '.tsv'}
+TEXT_SAMPLE_SIZE = 64 * 1024
+PDF_SCAN_LIMIT = 32 * 1024 * 1024
+THUMBNAIL_QUALITY = 80
+
+BOMS = [
+    (b'\xef\xbb\xbf', 'utf-8-sig'),
+    (b'\xff\xfe\x00\x00', 'utf-32-le'),
+    (b'\x00\x00\xfe\xff', 'utf-32-be'),
+    (b'\xff\xfe', 'utf-16-le'),
+    (b'\xfe\xff', 'utf-16-be'),
+]
+
+
+def detect_text_encoding(sample):
+    """Đoán encoding của đoạn đầu file text: BOM, UTF-8 hợp lệ, UTF-16 không BOM, cuối cùng là cp1258"""
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Mẫu bị cắt giữa một ký tự nhiều byte
+        if e.reason == 'unexpected end of data' and e.start >= len(sample) - 3:
+            return 'utf-8'
+    if sample and sample.count(0) > len(sample) // 4:
+        return 'utf-16-le' if sample[1::2].count(0) > sample[0::2].count(0) else 'utf-16-be'
+    # File tiếng Việt cũ (Windows) thường dùng code page 1258
+    return 'cp1258'
+
+
+def _image_metadata(reader, thumbnail_path, thumbnail_size):
+    if Image is None:
+        return {}
+    with Image.open(reader) as image:
+        meta = {'width': image.width, 'height': image.height, 'format': image.format}
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG không có kênh alpha: đặt lên nền trắng
+            rgba = image.convert('RGBA')
+            thumbnail = Image.new('RGB', rgba.size, (255, 255, 255))
+            thumbnail.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            thumbnail = image.convert('RGB')
+    partial_path = thumbnail_path.with_name(thumbnail_path.name + '.part')
+    thumbnail.save(partial_path, 'JPEG', quality=THUMBNAIL_QUALITY)
+    os.replace(partial_path, thumbnail_path)
+    meta['thumbnail'] = True
+    return meta
+
+
+def _pdf_metadata(reader):
+    data = reader.read(PDF_SCAN_LIMIT)
+    # Gốc cây trang có /Count lớn nhất; PDF nén object stream thì đếm được các /Type /Page lộ ra
+    counts = [int(n) for n in re.findall(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)', data)]
+    counts += [int(n) for n in re.findall(rb'/Count\s+(\d+)[^>]*?/Type\s*/Pages\b', data)]
+    pages = max(counts) if counts else len(re.findall(rb'/Type\s*/Page\b', data))
+    return {'page_count': pages} if pages else {}
+
+
+def _mp4_metadata(reader, size):
+    """Đọc thời lượng từ box moov/mvhd (MP4 / MOV) mà không cần ffprobe"""
+    offset, end = 0, size
+    while offset + 8 <= end:
+        reader.seek(offset)
+        box_size, box_type = struct.unpack('>I4s', reader.read(8))
+        header = 8
+        if box_size == 1:
+            box_size = struct.unpack('>Q', reader.read(8))[0]
+            header = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header:
+            break
+        if box_type == b'moov':
+            offset, end = offset + header, offset + box_size
+            continue
+        if box_type == b'mvhd':
+            version = reader.read(4)[0]
+            if version == 1:
+                reader.read(16)
+                timescale, duration = struct.unpack('>IQ', reader.read(12))
+            else:
+                reader.read(8)
+                timescale, duration = struct.unpack('>II', reader.read(8))
+            return {'duration_seconds': round(duration / timescale, 3)} if timescale else {}
+        offset += box_size
+    return {}
+
+
+def _wav_metadata(reader):
+    with wave.open(reader) as audio:
+        frames, rate = audio.getnframes(), audio.getframerate()
+        return {
+            'duration_seconds': round(frames / rate, 3) if rate else None,
+            'sample_rate': rate,
+            'channels': audio.getnchannels()
+        }
+
+
+def _text_metadata(reader):
+    sample = reader.read(TEXT_SAMPLE_SIZE)
+    encoding = detect_text_encoding(sample)
+    text = sample.decode(encoding, errors='replace')
+    return {
+        'encoding': encoding,
+        'line_ending': 'crlf' if '\r\n' in text else 'lf'
+    }
+
+
+def generate_derivatives(source_path, extension, out_dir, key, thumbnail_size=THUMBNAIL_SIZE):
+    """Chạy trong process con: đọc file gốc (kể cả blob đã nén) và ghi <key>.json (+ <key>.jpg nếu là ảnh)"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    meta = {'version': DERIVATIVE_VERSION, 'thumbnail': False}
+    reader, size, _ = open_stored(source_path)
+    with reader:
+        try:
+            if extension in IMAGE_EXTENSIONS:
+                meta.update(_image_metadata(reader, out_dir / f"{key}.jpg", thumbnail_size))
+            elif extension == '.pdf':
+                meta.update(_pdf_metadata(reader))
+            elif extension in MP4_EXTENSIONS:
+                meta.update(_mp4_metadata(reader, size))
+            elif extension == '.wav':
+                meta.update(_wav_metadata(reader))
+            elif extension in TEXT_EXTENSIONS:
+                meta.update(_text_metadata(reader))
+        except Exception as e:
+            # File hỏng / định dạng lạ: vẫn lưu metadata rỗng để không tạo lại mãi
+            meta['error'] = str(e)
+    partial_path = out_dir / f"{key}.json.part"
+    partial_path.write_text(json.dumps(meta), encoding='utf-8')
+    os.replace(partial_path, out_dir / f"{key}.json")
+    return meta
+
+
+class DerivativePipeline:
+    """Tạo thumbnail / metadata trong process pool sau khi upload xong, lưu trên đĩa theo nội dung file.
+
+    Key là content_hash (file trùng nội dung dùng chung derivative), file cũ chưa có hash dùng id.
+    Derivative bị thiếu (xóa tay, đổi DERIVATIVE_VERSION) được tạo lại khi có request cần tới.
+    """
+
+    def __init__(self, root, workers=DERIVATIVE_WORKERS, enabled=DERIVATIVES_ENABLED):
+        self.root = Path(root)
+        self.workers = max(1, workers)
+        self.enabled = enabled
+        self._executor = None
+        self._futures = {}  # key -> Future đang chạy
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.generated = 0
+        self.failures = 0
+        self.lazy_regenerations = 0
+
+    @staticmethod
+    def key_for(file_info):
+        return file_info.get('content_hash') or f"file{file_info['id']}"
+
+    def _dir(self, key):
+        return self.root / key[:2]
+
+    def metadata_path(self, key):
+        return self._dir(key) / f"{key}.json"
+
+    def thumbnail_path(self, key):
+        return self._dir(key) / f"{key}.jpg"
+
+    def etag(self, key):
+        return f"{key}-v{DERIVATIVE_VERSION}"
+
+    def load(self, key):
+        """Metadata đã tạo (đúng phiên bản hiện tại) hoặc None"""
+        try:
+            meta = json.loads(self.metadata_path(key).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != DERIVATIVE_VERSION:
+            return None
+        if meta.get('thumbnail') and not self.thumbnail_path(key).exists():
+            return None
+        return meta
+
+    def submit(self, file_info, source_path):
+        """Xếp việc tạo derivative (bỏ qua nếu đã có / đang chạy). Trả về Future hoặc None"""
+        if not self.enabled:
+            return None
+        key = self.key_for(file_info)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+            if self.load(key) is not None:
+                return None
+            if self._executor is None:
+                # Tạo pool khi cần lần đầu (không fork process lúc import module)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(DERIVATIVE_START_METHOD))
+            extension = Path(file_info['original_filename']).suffix.lower()
+            future = self._executor.submit(generate_derivatives, str(source_path), extension,
+                                           str(self._dir(key)), key)
+            self._futures[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda done, key=key: self._finished(key, done))
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            self._futures.pop(key, None)
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or error is not None:
+            self.failures += 1
+            logger.warning(f"Derivative generation failed for {key}: {error}")
+        else:
+            self.generated += 1
+
+    def get(self, file_info, source_path, wait=True):
+        """Metadata của file; nếu chưa có thì tạo (chờ tối đa DERIVATIVE_TIMEOUT giây khi wait=True).
+        Request handler nên dùng wait=False: None nghĩa là đang tạo, hỏi lại sau"""
+        key = self.key_for(file_info)
+        meta = self.load(key)
+        if meta is not None or not self.enabled:
+            return meta
+        future = self.submit(file_info, source_path)
+        self.lazy_regenerations += 1
+        if future is None or not wait:
+            return self.load(key)
+        try:
+            return future.result(timeout=DERIVATIVE_TIMEOUT)
+        except FutureTimeout:
+            return None
+        except Exception:
+            # Lỗi đã được ghi log trong _finished
+            return None
+
+    def discard(self, key):
+        """Xóa derivative của nội dung không còn được dùng"""
+        for path in (self.metadata_path(key), self.thumbnail_path(key)):
+            path.unlink(missing_ok=True)
+
+    def stats(self):
+        with self._lock:
+            running = len(self._futures)
+        return {
+            'enabled': self.enabled,
+            'thumbnails': Image is not None,
+            'workers': self.workers,
+            'running': running,
+            'submitted': self.submitted,
+            'generated': self.generated,
+            'failures': self.failures,
+            'lazy_regenerations': self.lazy_regenerations
+        }
@@ -1,18 +1,34 @@
-from flask import Flask, render_template, request, jsonify, send_file, abort, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, abort, session, redirect, url_for, Response
 from flask_cors import CORS
 import os
-import json
 import uuid
-import sqlite3
 import re
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from pathlib import Path
 import shutil
+import errno
 from werkzeug.utils import secure_filename
 import logging
-from database import db
-from auth_database import AuthDatabase
-from functools import wraps
+from database import db, FILE_SORT_COLUMNS
+from auth_database import AuthDatabase, PasswordHashBusy
+from login_throttle import LoginThrottle
+from quota import StorageQuota
+from maintenance import MaintenanceScheduler, MAINTENANCE_ENABLED
+from path_index import UploadPathIndex
+from blob_store import BlobStore, BLOB_DIRNAME, is_blob_path
+from storage_codec import CompressionWorker, open_stored, stored_exists
+from tiering import AccessTracker, StorageTiering
+from read_cache import ReadCache, MemoryReader
+from derivatives import DerivativePipeline, DERIVATIVE_RETRY_AFTER
+from text_preview import TextPreview, CSV_EXTENSIONS, DEFAULT_PREVIEW_LINES, DEFAULT_PREVIEW_BYTES
+from tracing import Tracer, TRACE_HEADER
+from metrics import (REGISTRY, CONTENT_TYPE, THROUGHPUT_BUCKETS, THROUGHPUT_MIN_BYTES, token_cache_collector,
+                     authorized as metrics_authorized)
+from zip_stream import stream_zip, unique_arcname, COMPRESSION_TYPES
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO)
@@ -27,10 +43,12 @@ app.secret_key = os.environ.get('SECRET_KEY', os.urandom(32).hex())
 
 # Khởi tạo auth database
 auth_db = AuthDatabase()
+# Chặn login dồn dập theo tài khoản / IP trước khi tốn CPU hash mật khẩu
+login_throttle = LoginThrottle()
 
 # Cấu hình
-UPLOAD_FOLDER = Path(__file__).parent / "remote_uploads"
-TEMP_FOLDER = Path(__file__).parent / "temp_uploads"
+UPLOAD_FOLDER = Path(os.environ.get('UPLOAD_FOLDER', Path(__file__).parent / "remote_uploads"))
+TEMP_FOLDER = Path(os.environ.get('TEMP_UPLOAD_FOLDER', Path(__file__).parent / "temp_uploads"))
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 TEMP_FOLDER.mkdir(parents=True, exist_ok=True)
 
@@ -40,22 +58,22 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # Kiểm tra session token
+        # SECURITY FIX: Không log token / nội dung session
         token = request.headers.get('Authorization')
-        logger.info(f"🔐 Login check - Authorization header: {token}")
         if token and token.startswith('Bearer '):
             token = token[7:]  # Remove 'Bearer ' prefix
             user = auth_db.get_user_by_token(token)
             if user:
-                logger.info(f"✅ User found by token: {user}")
+                logger.debug(f"✅ User found by token: {user['username']} (ID: {user['id']})")
                 request.current_user = user
                 return f(*args, **kwargs)
         
-        # Kiểm tra session cookie
-        logger.info(f"🍪 Session data: {dict(session)}")
-        if 'user_token' in session:
-            user = auth_db.get_user_by_token(session['user_token'])
+        # Kiểm tra session cookie (bỏ qua nếu cùng token đã kiểm tra ở header)
+        session_token = session.get('user_token')
+        if session_token and session_token != token:
+            user = auth_db.get_user_by_token(session_token)
             if user:
-                logger.info(f"✅ User found by session: {user['username']} (ID: {user['id']})")
+                logger.debug(f"✅ User found by session: {user['username']} (ID: {user['id']})")
                 request.current_user = user
                 return f(*args, **kwargs)
         
@@ -66,7 +84,7 @@ def login_required(f):
 def get_current_user():
     """Lấy thông tin user hiện tại"""
     if hasattr(request, 'current_user'):
-        logger.info(f"🔐 Found current_user: {request.current_user['username']} (ID: {request.current_user['id']})")
+        logger.debug(f"🔐 Found current_user: {request.current_user['username']} (ID: {request.current_user['id']})")
         return request.current_user
     logger.warning("⚠️ No current_user found in request")
     return None
@@ -82,33 +100,74 @@ def admin_required(f):
     return decorated_function
 
 # Cấu hình
-UPLOAD_FOLDER = Path(__file__).parent / "remote_uploads"
-TEMP_FOLDER = Path(__file__).parent / "temp_uploads"
+UPLOAD_FOLDER = Path(os.environ.get('UPLOAD_FOLDER', Path(__file__).parent / "remote_uploads"))
+TEMP_FOLDER = Path(os.environ.get('TEMP_UPLOAD_FOLDER', Path(__file__).parent / "temp_uploads"))
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 TEMP_FOLDER.mkdir(parents=True, exist_ok=True)
+# Tầng lạnh cho blob lâu không được đọc (đặt trên ổ chậm / rẻ hơn qua COLD_STORAGE_FOLDER)
+COLD_FOLDER = Path(os.environ.get('COLD_STORAGE_FOLDER', Path(__file__).parent / "cold_uploads"))
+COLD_FOLDER.mkdir(parents=True, exist_ok=True)
+# Nội dung file lưu theo ID (blobs/<aa>/<bb>/<id>); tên file và folder chỉ là metadata trong DB
+blob_store = BlobStore(UPLOAD_FOLDER, TEMP_FOLDER, COLD_FOLDER)
+# Hạn mức dung lượng theo role / user (dùng bộ đếm user_stats + chỗ đang giữ của các upload dở)
+storage_quota = StorageQuota(db, UPLOAD_FOLDER)
+# Nén blob dễ nén (text, log, CSV...) trong thread nền sau khi upload xong (cần zstandard, STORAGE_CODEC)
+compression_worker = CompressionWorker(db, blob_store)
+# Lượt đọc file (gom theo lô) và chuyển blob giữa tầng nóng / lạnh
+access_tracker = AccessTracker(db)
+storage_tiering = StorageTiering(db, blob_store, access_tracker)
+# Nội dung file nhỏ vừa được download / preview (LRU trong bộ nhớ, key = file id + updated_at)
+read_cache = ReadCache()
+# Thumbnail / metadata (kích thước ảnh, thời lượng, số trang, encoding) tạo trong process pool sau khi upload
+DERIVATIVE_FOLDER = Path(os.environ.get('DERIVATIVE_FOLDER', Path(__file__).parent / "derivatives"))
+derivative_pipeline = DerivativePipeline(DERIVATIVE_FOLDER)
+# Preview text / CSV theo trang (chỉ mục dòng thưa giữ trong bộ nhớ)
+text_preview = TextPreview()
 
-# Legacy JSON database cho folders (giữ lại tạm thời)
+# Span của /api/upload nối vào trace upload của gateway qua header traceparent (xem tracing.py)
+tracer = Tracer("file_manager")
+
+# Metrics dạng Prometheus tại /metrics (METRICS_TOKEN để yêu cầu Bearer token, không đặt thì chỉ localhost)
+DOWNLOAD_BYTES = REGISTRY.counter('file_download_bytes_total', 'Số byte file đã gửi (download / preview)')
+DOWNLOAD_THROUGHPUT = REGISTRY.histogram('file_download_throughput_bytes_per_second',
+                                         'Tốc độ gửi của mỗi response file (tới khi stream xong)',
+                                         buckets=THROUGHPUT_BUCKETS)
+READ_CACHE_LOOKUPS = REGISTRY.counter('read_cache_lookups_total', 'Số lượt tra read cache', ['result'])
+READ_CACHE_BYTES = REGISTRY.gauge('read_cache_bytes', 'Dung lượng nội dung đang nằm trong read cache')
+
+def collect_read_cache_metrics():
+    stats = read_cache.stats()
+    READ_CACHE_LOOKUPS.labels('hit').set(stats['hits'])
+    READ_CACHE_LOOKUPS.labels('miss').set(stats['misses'])
+    READ_CACHE_BYTES.set(stats['bytes'])
+
+REGISTRY.add_collector(collect_read_cache_metrics)
+REGISTRY.add_collector(token_cache_collector(auth_db))
+
+# Legacy JSON database cho folders - chỉ còn dùng cho migration một lần sang bảng folders
 DB_FILE = UPLOAD_FOLDER / "files_db.json"
+db.migrate_legacy_folders(str(DB_FILE))
 
-def load_legacy_db():
-    """Load legacy database từ file JSON (chỉ cho folders)"""
-    if DB_FILE.exists():
-        try:
-            with open(DB_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Chỉ trả về folders, files sẽ lấy từ SQLite
-                return {"folders": data.get("folders", [])}
-        except Exception as e:
-            logger.error(f"Error loading legacy database: {e}")
-    return {"folders": []}
-
-def save_legacy_db(data):
-    """Lưu legacy database vào file JSON (chỉ cho folders)"""
-    try:
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Error saving database: {e}")
+# Khu chứa file vật lý của thùng rác, cùng volume với UPLOAD_FOLDER để chuyển vào chỉ cần rename.
+# Username chỉ gồm chữ, số, _ và - nên không trùng với thư mục của user nào.
+TRASH_DIRNAME = ".trash"
+# trash_path khi lúc xóa file vật lý đã không còn (không có gì được chuyển vào .trash).
+# Khác NULL: NULL là dòng cũ từ trước khi có .trash, file vẫn nằm ở file_path
+NOTHING_TRASHED = ""
+(UPLOAD_FOLDER / TRASH_DIRNAME).mkdir(exist_ok=True)
+
+def format_folder(folder):
+    """Convert format folder từ DB cho frontend compatibility"""
+    return {
+        "id": folder["id"],
+        "name": folder["name"],
+        "path": folder["path"],
+        "parent_id": folder["parent_id"],
+        "user_id": folder["user_id"],
+        "username": folder["username"],
+        "created_time": folder["created_at"],
+        "type": "folder"
+    }
 
 def create_folder_structure(file_path):
     """Tạo cấu trúc folder cho file"""
@@ -146,6 +205,12 @@ def admin_page():
     """Trang admin - chỉ cho admin"""
     return render_template('admin.html')
 
+def retry_later(message, status, retry_after):
+    """Response 429/503 kèm header Retry-After"""
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, status
+
 # Authentication API Routes
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -174,12 +239,22 @@ def login():
         
         logger.info(f"🔑 Login attempt for username: {username}")
         
+        retry_after = login_throttle.acquire(username, request.remote_addr)
+        if retry_after:
+            logger.warning(f"🔑 Login throttled for username: {username} from {request.remote_addr}")
+            return retry_later('Too many login attempts, please try again later', 429, retry_after)
+        
         # Xác thực user
         logger.info(f"🔑 Authenticating user: {username}")
-        user = auth_db.authenticate_user(username, password)
+        try:
+            user = auth_db.authenticate_user(username, password)
+        except PasswordHashBusy:
+            logger.warning(f"🔑 Password hash pool busy, rejecting login for: {username}")
+            return retry_later('Server is busy, please try again', 503, 1)
         logger.info(f"🔑 Authentication result: {user is not None}")
         
         if user:
+            login_throttle.succeeded(username)
             logger.info(f"🔑 Login successful for user: {user['username']} (ID: {user['id']}, Role: {user['role']})")
             # Tạo session token
             token = auth_db.create_session(user['id'])
@@ -223,6 +298,8 @@ def register():
         else:
             return jsonify({'error': 'Username already exists'}), 409
             
+    except PasswordHashBusy:
+        return retry_later('Server is busy, please try again', 503, 1)
     except Exception as e:
         logger.error(f"Register error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -286,174 +363,327 @@ def upload_file():
         if not file_name or not file_size or not file_id:
             return jsonify({"error": "Missing required headers"}), 400
         
-        # Tạo tên file an toàn
-        safe_filename = secure_filename(file_name)
-        
-        # Tạo đường dẫn file với user folder (sử dụng username thay vì user_id)
-        user_folder = UPLOAD_FOLDER / user['username']
-        user_folder.mkdir(exist_ok=True)
-        file_path = user_folder / safe_filename
-        
-        # Xử lý trùng tên file
-        counter = 1
-        original_name = file_path.stem
-        original_ext = file_path.suffix
-        while file_path.exists():
-            file_path = user_folder / f"{original_name} ({counter}){original_ext}"
-            counter += 1
-        
-        # Lưu file
-        with open(file_path, 'wb') as f:
-            chunk_size = 1024 * 1024  # 1MB
-            while True:
-                chunk = request.stream.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
-
-        # Lưu thông tin file vào SQLite database với user_id
+        # Giữ chỗ theo X-File-Size trước khi nhận byte nào (upload qua WebSocket đã được server.py
+        # kiểm tra ở handle_start, kiểm tra lại ở đây để upload HTTP trực tiếp không vượt hạn mức)
+        reservation_key = f"http:{user['id']}:{file_id}"
+        admission = storage_quota.reserve(user, reservation_key, file_size)
+        if not admission['allowed']:
+            if admission['reason'] == 'quota':
+                return jsonify({"error": "Storage quota exceeded", "quota": admission}), 413
+            return jsonify({"error": "Server storage is full", "quota": admission}), 507
+        
+        span = tracer.from_header('fm_upload', request.headers.get(TRACE_HEADER), file_name=file_name,
+                                  file_size=file_size)
         try:
-            file_db_id = db.add_file(
-                filename=safe_filename,
-                original_filename=file_name,
-                size=file_size,
-                uploader=user['username'],
-                user_id=user['id'],
-                folder_id=folder_id,
-                temp_path=None  # File đã hoàn tất, không còn ở temp
-            )
-            
-            # Cập nhật status thành completed và lưu file_path tương đối
-            # Lấy tên file cuối cùng sau khi xử lý duplicate
-            final_filename = file_path.name
-            relative_file_path = f"{user['username']}/{final_filename}"
-            
-            db.update_file_status(
-                file_id=file_db_id,
-                status="completed",
-                file_path=relative_file_path
-            )
-            
-            logger.info(f"File uploaded successfully: {file_name} -> {file_path} (DB ID: {file_db_id})")
-            
+            # Tạo tên file an toàn
+            safe_filename = secure_filename(file_name)
+        
+            # Tạo dòng DB trước để có ID (đặt tên file tạm); nội dung được đưa vào kho blob theo SHA-256 bên dưới
+            try:
+                with span.child('db_add_file'):
+                    file_db_id = db.add_file(
+                        filename=safe_filename,
+                        original_filename=file_name,
+                        size=file_size,
+                        uploader=user['username'],
+                        user_id=user['id'],
+                        folder_id=folder_id,
+                        temp_path=None  # File đã hoàn tất, không còn ở temp
+                    )
+            except Exception as db_error:
+                logger.error(f"Database error: {db_error}")
+                return jsonify({"error": "Database error"}), 500
+        
+            # Ghi ra file tạm (tính SHA-256 trong lúc ghi), rồi trỏ tới blob đã có cùng nội dung hoặc đưa vào kho
+            partial_path = None
+            try:
+                with span.child('receive_body'):
+                    partial_path, written, digest = blob_store.receive(file_db_id, request.stream)
+                relative_file_path = blob_store.content_path(digest)
+                with span.child('db_register'):
+                    deduplicated = db.attach_blob(file_db_id, digest, written, relative_file_path,
+                                                  partial(blob_store.place, relative_file_path, partial_path))
+            except Exception:
+                db.delete_file(file_db_id)
+                raise
+            finally:
+                if partial_path:
+                    partial_path.unlink(missing_ok=True)
+        
+            logger.info(f"File uploaded successfully: {file_name} -> {relative_file_path} (DB ID: {file_db_id}"
+                        f"{', deduplicated' if deduplicated else ''})")
+            span.set(file_id=file_db_id, deduplicated=deduplicated)
+            if not deduplicated:
+                compression_worker.submit(digest)
+            derivative_pipeline.submit({'id': file_db_id, 'content_hash': digest, 'original_filename': file_name},
+                                       blob_store.root / relative_file_path)
+        
             return jsonify({
                 "success": True,
                 "file_id": file_db_id,
+                "deduplicated": deduplicated,
                 "message": "File uploaded successfully"
             })
-            
-        except Exception as db_error:
-            # Nếu lỗi database, xóa file đã tạo
-            if file_path.exists():
-                file_path.unlink()
-            logger.error(f"Database error: {db_error}")
-            return jsonify({"error": "Database error"}), 500
+        finally:
+            storage_quota.release(reservation_key)
+            span.end()
     except Exception as e:
         logger.error(f"Error uploading file: {e}")
         return jsonify({"error": str(e)}), 500
 
-def cleanup_stuck_uploads(user_id):
-    """Clean up files stuck in uploading status for more than 30 minutes"""
-    try:
-        cutoff_time = datetime.now() - timedelta(minutes=30)
-        
-        # Get files stuck in uploading status
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, filename FROM files 
-                WHERE user_id = ? AND status = 'uploading' 
-                AND datetime(created_at) < datetime(?)
-            """, (user_id, cutoff_time.isoformat()))
-            
-            stuck_files = cursor.fetchall()
-            
-            if stuck_files:
-                logger.info(f"🧹 Found {len(stuck_files)} stuck uploads for user {user_id}, cleaning up...")
-                
-                # Delete stuck uploads
-                for file_id, filename in stuck_files:
-                    cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
-                    logger.info(f"  Deleted stuck upload: {filename}")
-                
-                conn.commit()
-                logger.info(f"✅ Cleaned up {len(stuck_files)} stuck uploads")
-        
-    except Exception as e:
-        logger.error(f"Error cleaning up stuck uploads: {e}")
+# Dọn dẹp định kỳ chạy trong thread nền (maintenance.py), không chạy trong các GET handler
+STUCK_UPLOAD_MAX_AGE_MINUTES = int(os.environ.get('STUCK_UPLOAD_MAX_AGE_MINUTES', 30))
+ORPHAN_PART_MAX_AGE_HOURS = float(os.environ.get('ORPHAN_PART_MAX_AGE_HOURS', 24))
+ORPHAN_PART_SWEEP_LIMIT = 1000
+
+# Purge thùng rác: mỗi lần chạy xóa tối đa MAX_BATCHES lô, nghỉ giữa các lô để không chiếm hết I/O đĩa
+RECYCLE_PURGE_BATCH_SIZE = int(os.environ.get('RECYCLE_PURGE_BATCH_SIZE', 200))
+RECYCLE_PURGE_MAX_BATCHES = int(os.environ.get('RECYCLE_PURGE_MAX_BATCHES', 20))
+RECYCLE_PURGE_BATCH_PAUSE = float(os.environ.get('RECYCLE_PURGE_BATCH_PAUSE', 0.5))
+
+def remove_blob(relative_path):
+    """Xóa blob theo nội dung không còn tham chiếu cùng thumbnail / metadata của nó"""
+    freed = blob_store.remove(relative_path)
+    derivative_pipeline.discard(Path(relative_path).name)
+    text_preview.discard(Path(relative_path).name)
+    return freed
+
+def purge_recycle_bin():
+    """Đánh dấu file hết hạn trong thùng rác rồi xóa file vật lý của các dòng expired / permanently_deleted theo lô"""
+    expired = db.cleanup_expired_recycle_files()
+    purged = missing = failed = reclaimed_bytes = released_blobs = 0
+    after_id = 0
+    for batch_number in range(RECYCLE_PURGE_MAX_BATCHES):
+        if batch_number:
+            time.sleep(RECYCLE_PURGE_BATCH_PAUSE)
+        batch = db.get_purgeable_recycle_files(after_id, RECYCLE_PURGE_BATCH_SIZE)
+        if not batch:
+            break
+        done = []
+        shared = []
+        for entry in batch:
+            # Blob theo nội dung có thể đang được file khác dùng: chỉ xóa khi ref_count về 0 (bên dưới)
+            if entry['content_hash']:
+                shared.append(entry['id'])
+                continue
+            if not entry['trash_path'] and is_blob_path(entry['file_path']):
+                # Blob theo ID (migrate_blobs.py) không vào .trash và có thể đang ở tầng lạnh
+                try:
+                    freed = blob_store.remove(entry['file_path'])
+                except OSError as e:
+                    failed += 1
+                    logger.warning(f"Could not purge recycle bin file {entry['id']}: {e}")
+                    continue
+                reclaimed_bytes += freed
+                missing += not freed
+                done.append(entry['id'])
+                continue
+            if entry['trash_path'] == NOTHING_TRASHED:
+                # File đã mất từ lúc xóa: không được đụng tới file_path (có thể đã là file khác cùng tên)
+                missing += 1
+                done.append(entry['id'])
+                continue
+            # Dòng cũ (trước khi có .trash, trash_path NULL) vẫn nằm ở file_path trong thư mục của user
+            physical_path = resolve_upload_path(entry['trash_path'] or entry['file_path'])
+            try:
+                if physical_path:
+                    size = physical_path.stat().st_size
+                    physical_path.unlink()
+                    reclaimed_bytes += size
+                else:
+                    missing += 1
+            except FileNotFoundError:
+                missing += 1
+            except OSError as e:
+                # Giữ lại dòng để lần chạy sau thử lại
+                failed += 1
+                logger.warning(f"Could not purge recycle bin file {entry['id']}: {e}")
+                continue
+            done.append(entry['id'])
+        purged += db.mark_recycle_files_purged(done)
+        try:
+            released, removed, freed = db.release_recycled_blobs(shared, remove_blob)
+            purged += released
+            released_blobs += removed
+            reclaimed_bytes += freed
+        except OSError as e:
+            failed += len(shared)
+            logger.warning(f"Could not release blobs for recycle bin entries {shared}: {e}")
+        after_id = batch[-1]['id']
+        if len(batch) < RECYCLE_PURGE_BATCH_SIZE:
+            break
+    if purged or failed:
+        logger.info(f"🧹 Recycle purge: {purged} files purged, {reclaimed_bytes} bytes reclaimed, {failed} failed")
+    return {'expired': len(expired), 'purged': purged, 'missing': missing, 'failed': failed,
+            'released_blobs': released_blobs, 'reclaimed_bytes': reclaimed_bytes}
+
+def sweep_orphan_part_files():
+    """Xóa các file temp_uploads/*.part không được ghi thêm quá ORPHAN_PART_MAX_AGE_HOURS (upload bị bỏ dở)"""
+    cutoff = time.time() - ORPHAN_PART_MAX_AGE_HOURS * 3600
+    removed = 0
+    freed_bytes = 0
+    with os.scandir(TEMP_FOLDER) as entries:
+        for entry in entries:
+            if removed >= ORPHAN_PART_SWEEP_LIMIT:
+                break
+            if not entry.name.endswith('.part') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+                    freed_bytes += stat.st_size
+            except FileNotFoundError:
+                continue
+    if removed:
+        logger.info(f"🧹 Removed {removed} orphaned .part files ({freed_bytes} bytes)")
+    return {'removed': removed, 'freed_bytes': freed_bytes}
+
+maintenance = MaintenanceScheduler()
+maintenance.add_job('stuck_uploads', lambda: db.cleanup_stuck_uploads(STUCK_UPLOAD_MAX_AGE_MINUTES),
+                    int(os.environ.get('STUCK_UPLOAD_CLEANUP_INTERVAL', 300)))
+maintenance.add_job('recycle_purge', purge_recycle_bin,
+                    int(os.environ.get('RECYCLE_PURGE_INTERVAL', 600)))
+maintenance.add_job('expired_sessions', auth_db.cleanup_expired_sessions,
+                    int(os.environ.get('SESSION_CLEANUP_INTERVAL', 3600)))
+maintenance.add_job('orphan_parts', sweep_orphan_part_files,
+                    int(os.environ.get('ORPHAN_PART_SWEEP_INTERVAL', 1800)))
+# Blob chưa được đánh giá nén (process dừng giữa chừng, dữ liệu có trước khi bật codec)
+maintenance.add_job('blob_compression', compression_worker.sweep,
+                    int(os.environ.get('BLOB_COMPRESSION_SWEEP_INTERVAL', 900)))
+maintenance.add_job('access_flush', access_tracker.flush,
+                    int(os.environ.get('ACCESS_FLUSH_INTERVAL', 60)))
+maintenance.add_job('storage_tiering', storage_tiering.demote_cold_files,
+                    int(os.environ.get('STORAGE_TIERING_INTERVAL', 3600)))
+
+# Chỉ mục file trên đĩa để đối chiếu khi file_path trong DB không còn đúng (xem locate_file_on_disk)
+upload_path_index = UploadPathIndex(UPLOAD_FOLDER, skip_dirs={TRASH_DIRNAME, BLOB_DIRNAME})
+maintenance.add_job('path_index', upload_path_index.rebuild,
+                    int(os.environ.get('PATH_INDEX_REBUILD_INTERVAL', 3600)))
+
+@app.before_request
+def start_maintenance():
+    """Khởi động scheduler ở request đầu tiên (process cha của reloader không phục vụ request nên không chạy job)"""
+    if MAINTENANCE_ENABLED and not maintenance.started:
+        maintenance.start()
+        # Chỉ mục đường dẫn cần có sớm (không chờ lượt chạy định kỳ đầu tiên)
+        maintenance.run_in_background('path_index')
+
+# Kích thước trang mặc định / tối đa cho /api/files
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def format_file_for_frontend(file):
+    """Convert format file từ DB cho frontend compatibility"""
+    # Normalize file path separators cho consistency
+    normalized_path = file["file_path"].replace('\\', '/') if file["file_path"] else None
+    
+    return {
+        "id": file["id"],
+        "name": file["original_filename"],
+        "filename": file["original_filename"],
+        "file_path": normalized_path,
+        "folder_id": file.get("folder_id"),
+        "size": file["size"],
+        "upload_time": file["created_at"],
+        "status": file["status"],
+        "uploader": file["uploader"],
+        "user_id": file["user_id"],
+        "extension": file.get("extension"),
+        "type": "file"
+    }
 
 @app.route('/api/files', methods=['GET'])
 @login_required
 def get_files():
-    """Lấy danh sách files của user hiện tại từ SQLite database"""
+    """Lấy danh sách files của user hiện tại (keyset pagination, sort và lọc phía server)"""
     try:
         user = get_current_user()
-        logger.info(f"🔍 API /api/files called by user: {user['id']} ({user['username']})")
-        
-        # FIX: Clean up stuck uploads before returning files
-        cleanup_stuck_uploads(user['id'])
         
         # Lấy tham số query
         status = request.args.get('status')  # completed, uploading, paused
-        limit = request.args.get('limit', type=int)
-        offset = request.args.get('offset', 0, type=int)
+        folder_id = request.args.get('folder_id')  # 'root' = file không nằm trong folder nào
+        extension = request.args.get('extension')
+        sort = request.args.get('sort', 'created_at')
+        order = request.args.get('order', 'desc')
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        
+        if sort not in FILE_SORT_COLUMNS:
+            return jsonify({"error": f"Invalid sort. Valid: {list(FILE_SORT_COLUMNS)}"}), 400
+        if order not in ('asc', 'desc'):
+            return jsonify({"error": "Invalid order. Valid: ['asc', 'desc']"}), 400
         
-        # Lấy files của user từ database
-        files = db.get_user_files(user['id'], status=status)
-        logger.info(f"📁 Found {len(files)} files for user {user['id']}")
+        try:
+            page = db.get_files_page(
+                user_id=user['id'],
+                status=status,
+                folder_id=folder_id,
+                extension=extension,
+                sort=sort,
+                order=order,
+                limit=limit,
+                cursor=cursor
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Log first few files for debugging
-        for i, f in enumerate(files[:3]):
-            logger.info(f"  File {i+1}: {f['original_filename']} (Status: {f['status']}, Path: {f.get('file_path', 'NULL')})")
+        logger.debug(f"📁 Returning {len(page['files'])}/{page['total']} files for user {user['id']}")
+        return jsonify({
+            "files": [format_file_for_frontend(file) for file in page['files']],
+            "next_cursor": page['next_cursor'],
+            "total": page['total'],
+            "limit": limit
+        })
+    except Exception as e:
+        logger.error(f"Error getting files: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/files/search', methods=['GET'])
+@login_required
+def search_files():
+    """Tìm kiếm file của user hiện tại theo tên (FTS5 trigram, xếp hạng theo độ liên quan)
+
+    Query params: q, mode (substring|prefix), extension, limit, cursor
+    """
+    try:
+        user = get_current_user()
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
         
-        # Convert format cho frontend compatibility
-        formatted_files = []
-        for file in files:
-            # Normalize file path separators cho consistency
-            normalized_path = file["file_path"].replace('\\', '/') if file["file_path"] else None
-            
-            formatted_files.append({
-                "id": file["id"],
-                "name": file["original_filename"],
-                "filename": file["original_filename"],
-                "file_path": normalized_path,
-                "folder_id": file.get("folder_id"),
-                "size": file["size"],
-                "upload_time": file["created_at"],
-                "status": file["status"],
-                "uploader": file["uploader"],
-                "user_id": file["user_id"],
-                "type": "file"
-            })
+        try:
+            page = db.search_files(
+                user_id=user['id'],
+                query=request.args.get('q'),
+                mode=request.args.get('mode', 'substring'),
+                extension=request.args.get('extension'),
+                limit=limit,
+                cursor=request.args.get('cursor')
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        logger.info(f"✅ Returning {len(formatted_files)} formatted files to frontend")
-        return jsonify(formatted_files)
+        return jsonify({
+            "files": [format_file_for_frontend(file) for file in page['files']],
+            "next_cursor": page['next_cursor'],
+            "limit": limit
+        })
     except Exception as e:
-        logger.error(f"Error getting files: {e}")
+        logger.error(f"Error searching files: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/folders', methods=['GET'])
 @login_required
 def get_folders():
-    """Lấy danh sách folders của user hiện tại từ legacy database - USER ISOLATED"""
+    """Lấy danh sách folders của user hiện tại - USER ISOLATED"""
     try:
         user = get_current_user()
-        user_id = user['id']
         parent_id = request.args.get('parent_id')  # Thêm filter by parent_id
-        legacy_data = load_legacy_db()
-        
-        # Lọc folders của user hiện tại
-        user_folders = []
-        for folder in legacy_data.get("folders", []):
-            # Chỉ lấy folders của user hiện tại
-            if folder.get("user_id") == user_id:
-                if parent_id is not None:
-                    # Filter by parent_id nếu có
-                    if folder.get("parent_id") == parent_id:
-                        user_folders.append(folder)
-                else:
-                    # Lấy tất cả folders của user
-                    user_folders.append(folder)
+        
+        # Lọc folders của user hiện tại bằng index (user_id, parent_id)
+        user_folders = [format_folder(folder) for folder in db.get_user_folders(user['id'], parent_id=parent_id)]
         
         logger.info(f"Found {len(user_folders)} folders for user {user['username']}")
         return jsonify(user_folders)
@@ -483,6 +713,87 @@ def get_file_info(file_id):
         logger.error(f"Error getting file info: {e}")
         return jsonify({"error": str(e)}), 500
 
+def locate_stored_file(file_info, file_path):
+    """Vị trí thực của nội dung file (file_path là đường dẫn ở tầng nóng, đã kiểm tra path traversal);
+    ghi nhận lượt đọc cho tiering"""
+    access_tracker.record(file_info['id'])
+    if is_blob_path(file_info['file_path']) and not stored_exists(file_path):
+        return blob_store.locate(file_info['file_path'])
+    return file_path
+
+def send_reader(reader, size, mtime, **kwargs):
+    """send_file cho file object đã mở (kèm kích thước nội dung), vẫn hỗ trợ Range / If-Modified-Since"""
+    reader = MeteredReader(reader)
+    try:
+        response = send_file(reader, conditional=False, last_modified=mtime, **kwargs)
+        # send_file không biết kích thước của file object -> tự đặt rồi xử lý Range / If-Modified-Since
+        response.content_length = size
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    except Exception:
+        reader.close()
+        raise
+    reader.sent_bytes = response.content_length or 0
+    return response
+
+class MeteredReader:
+    """Bọc file object của response để ghi số liệu download khi WSGI server đóng body (đã gửi xong).
+
+    Body được trả thẳng cho server (direct_passthrough) nên response.close() không được gọi; file wrapper
+    của server gọi close() của file. Không bọc body nên wsgi.file_wrapper / sendfile của server vẫn dùng được.
+    """
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._started = time.perf_counter()
+        self._closed = False
+        self.sent_bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+    def __iter__(self):
+        return iter(self._reader)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._reader.close()
+        # Thời gian tính tới lúc body stream xong, gồm cả lúc gửi qua mạng
+        DOWNLOAD_BYTES.inc(self.sent_bytes)
+        if self.sent_bytes >= THROUGHPUT_MIN_BYTES:
+            DOWNLOAD_THROUGHPUT.observe(self.sent_bytes / max(time.perf_counter() - self._started, 1e-6))
+
+def send_cached_file(file_info, **kwargs):
+    """Phục vụ file từ read cache (memoryview, không copy); None nếu file không có trong cache"""
+    if not read_cache.cacheable(file_info['size']):
+        return None
+    cached = read_cache.get(file_info['id'], file_info['updated_at'])
+    if cached is None:
+        return None
+    access_tracker.record(file_info['id'])
+    if file_info.get('storage_tier') == 'cold':
+        # Nội dung trong cache vẫn còn sau khi blob bị chuyển sang tầng lạnh
+        storage_tiering.promote(file_info['file_path'])
+    view, mtime = cached
+    return send_reader(MemoryReader(view), len(view), mtime, **kwargs)
+
+def send_stored_file(file_path, file_info=None, **kwargs):
+    """send_file cho file có thể đã được nén khi lưu: giải nén trong lúc stream, Range chỉ giải nén
+    các frame cần thiết (SeekableZstdReader seek theo frame index). Blob ở tầng lạnh được phục vụ trực
+    tiếp rồi đưa về tầng nóng trong nền. File nhỏ (có file_info) được đọc hết vào read cache"""
+    reader, size, mtime = open_stored(file_path)
+    if file_info and read_cache.cacheable(size):
+        with reader:
+            data = reader.read()
+        read_cache.put(file_info['id'], file_info['updated_at'], data, mtime)
+        reader = MemoryReader(memoryview(data))
+    response = send_reader(reader, size, mtime, **kwargs)
+    # File đã mở nên việc chuyển tầng (xóa bản lạnh) không ảnh hưởng response này
+    if blob_store.is_cold(file_path):
+        storage_tiering.promote(Path(file_path).relative_to(blob_store.cold_root).as_posix())
+    return response
+
 @app.route('/api/files/<int:file_id>/download', methods=['GET'])
 @login_required
 def download_file(file_id):
@@ -510,6 +821,10 @@ def download_file(file_id):
         if file_info["status"] != "completed":
             return jsonify({"error": "File not ready for download"}), 400
         
+        cached_response = send_cached_file(file_info, as_attachment=True, download_name=file_info["original_filename"])
+        if cached_response:
+            return cached_response
+        
         if file_info["file_path"]:
             # SECURITY FIX: Validate and sanitize file path to prevent path traversal
             file_path = UPLOAD_FOLDER / file_info["file_path"]
@@ -527,12 +842,14 @@ def download_file(file_id):
                 logger.error(f"🚨 SECURITY: Path resolution error: {e}")
                 return jsonify({"error": "Invalid file path"}), 400
             
+            file_path = locate_stored_file(file_info, file_path)
             logger.info(f"🔽 Looking for file at: {file_path}")
             
-            if file_path.exists():
+            if stored_exists(file_path):
                 logger.info(f"🔽 File found at original path, sending: {file_info['original_filename']}")
-                return send_file(
+                return send_stored_file(
                     file_path,
+                    file_info=file_info,
                     as_attachment=True,
                     download_name=file_info["original_filename"]
                 )
@@ -568,6 +885,155 @@ def download_file(file_id):
         logger.error(f"Error downloading file {file_id}: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Giới hạn số file trong một archive để tránh request quá lớn
+MAX_ARCHIVE_FILES = 10000
+
+def resolve_upload_path(relative_path):
+    """Chuyển đường dẫn tương đối trong DB thành đường dẫn tuyệt đối, chặn path traversal"""
+    if not relative_path:
+        return None
+    try:
+        file_path = (UPLOAD_FOLDER / relative_path).resolve()
+        upload_folder_resolved = UPLOAD_FOLDER.resolve()
+        if not str(file_path).startswith(str(upload_folder_resolved)):
+            logger.error(f"🚨 SECURITY: Path traversal attempt detected! Path: {file_path}")
+            return None
+        return file_path
+    except Exception as e:
+        logger.error(f"🚨 SECURITY: Path resolution error: {e}")
+        return None
+
+def available_upload_path(file_path, reserved=None):
+    """Đường dẫn chưa bị chiếm: thêm hậu tố " (n)" như khi upload trùng tên
+    
+    reserved: tập các đường dẫn đã được giữ chỗ trong cùng thao tác hàng loạt (được cập nhật luôn).
+    """
+    reserved = reserved if reserved is not None else set()
+    candidate = file_path
+    counter = 1
+    while candidate in reserved or candidate.exists():
+        candidate = file_path.with_name(f"{file_path.stem} ({counter}){file_path.suffix}")
+        counter += 1
+    reserved.add(candidate)
+    return candidate
+
+def move_to_trash(relative_path):
+    """Rename file vật lý vào .trash; trả về trash_path, hoặc NOTHING_TRASHED nếu file không còn trên đĩa
+
+    Blob không cần chuyển (trả về None): đường dẫn theo ID không bị file khác chiếm, purge xóa thẳng file_path.
+    """
+    if is_blob_path(relative_path):
+        return None
+    source = resolve_upload_path(relative_path)
+    if not source or not source.is_file():
+        return NOTHING_TRASHED
+    trash_path = f"{TRASH_DIRNAME}/{uuid.uuid4().hex}_{source.name}"
+    os.rename(source, UPLOAD_FOLDER / trash_path)
+    return trash_path
+
+def recycle_file(file_info, deleted_by, days_to_keep):
+    """Chuyển file vào thùng rác: rename file vật lý sang .trash (O(1)) rồi chuyển dòng DB sang recycle_bin"""
+    read_cache.invalidate(file_info['id'])
+    trash_path = move_to_trash(file_info.get('file_path'))
+    success = db.move_to_recycle_bin(file_info['id'], deleted_by, days_to_keep=days_to_keep, trash_path=trash_path)
+    if not success and trash_path:
+        os.rename(UPLOAD_FOLDER / trash_path, resolve_upload_path(file_info['file_path']))
+    return success
+
+@app.route('/api/files/archive', methods=['GET', 'POST'])
+@login_required
+def download_archive():
+    """Download nhiều file hoặc cả folder dưới dạng ZIP được tạo dạng stream"""
+    try:
+        user = get_current_user()
+
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            file_ids = data.get('file_ids') or []
+            folder_id = data.get('folder_id')
+            compression = data.get('compression', 'store')
+        else:
+            ids_param = request.args.get('ids', '')
+            file_ids = [i for i in ids_param.split(',') if i.strip()]
+            folder_id = request.args.get('folder_id')
+            compression = request.args.get('compression', 'store')
+
+        if compression not in COMPRESSION_TYPES:
+            return jsonify({"error": f"Invalid compression. Valid: {list(COMPRESSION_TYPES)}"}), 400
+        if not file_ids and not folder_id:
+            return jsonify({"error": "file_ids or folder_id is required"}), 400
+
+        try:
+            file_ids = sorted({int(i) for i in file_ids})
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid file id"}), 400
+
+        if len(file_ids) > MAX_ARCHIVE_FILES:
+            return jsonify({"error": f"Too many files (max {MAX_ARCHIVE_FILES})"}), 400
+
+        # Admin được tải file của mọi user, user thường chỉ file của mình
+        owner_filter = None if user.get('role') == 'admin' else user['id']
+        entries = []
+
+        if file_ids:
+            # Kiểm tra quyền cho toàn bộ danh sách bằng một truy vấn
+            files = db.get_files_by_ids(file_ids, user_id=owner_filter)
+            if len(files) != len(file_ids):
+                logger.warning(f"User {user['id']} requested archive with inaccessible files")
+                return jsonify({"error": "Some files were not found or permission denied"}), 403
+            for file_info in files:
+                entries.append((file_info, file_info["original_filename"]))
+            archive_name = f"files_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+
+        if folder_id:
+            subtree = db.get_folder_subtree(folder_id, user['id'])
+            if not subtree:
+                return jsonify({"error": "Folder not found or access denied"}), 404
+            folder_paths = {folder["id"]: folder["relative_path"] for folder in subtree}
+            files = db.get_files_in_folders(list(folder_paths), user_id=user['id'])
+            for file_info in files:
+                entries.append((file_info, f"{folder_paths[file_info['folder_id']]}/{file_info['original_filename']}"))
+            if not file_ids:
+                archive_name = f"{subtree[0]['name']}.zip"
+
+        if len(entries) > MAX_ARCHIVE_FILES:
+            return jsonify({"error": f"Too many files (max {MAX_ARCHIVE_FILES})"}), 400
+
+        # Resolve đường dẫn trước khi bắt đầu stream, lỗi sau khi đã gửi header không thể trả về cho client
+        used_names = set()
+        archive_entries = []
+        for file_info, arcname in entries:
+            if file_info["status"] != "completed":
+                continue
+            file_path = resolve_upload_path(file_info["file_path"])
+            if not file_path:
+                continue
+            file_path = locate_stored_file(file_info, file_path)
+            archive_entries.append((unique_arcname(arcname, used_names), str(file_path)))
+
+        logger.info(f"📦 Streaming archive {archive_name} with {len(archive_entries)} files for user {user['username']} (compression: {compression})")
+
+        return Response(
+            stream_zip(archive_entries, compression=compression),
+            mimetype='application/zip',
+            headers={
+                'Content-Disposition': f"attachment; filename*=UTF-8''{quote(archive_name)}",
+                'Cache-Control': 'no-store'
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error creating archive: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# MIME type khi preview inline
+PREVIEW_MIME_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.gif': 'image/gif', '.bmp': 'image/bmp', '.webp': 'image/webp',
+    '.pdf': 'application/pdf', '.txt': 'text/plain',
+    '.mp4': 'video/mp4', '.avi': 'video/avi', '.mov': 'video/quicktime',
+    '.mp3': 'audio/mpeg', '.wav': 'audio/wav', '.ogg': 'audio/ogg'
+}
+
 @app.route('/api/files/<int:file_id>/preview', methods=['GET'])
 @login_required
 def preview_file(file_id):
@@ -587,29 +1053,23 @@ def preview_file(file_id):
         if file_info["status"] != "completed":
             return jsonify({"error": "File not ready for preview"}), 400
         
+        # Determine file type for appropriate headers (blob không có extension -> lấy từ tên gốc)
+        file_ext = Path(file_info["original_filename"]).suffix.lower()
+        preview_options = {
+            'mimetype': PREVIEW_MIME_TYPES.get(file_ext, 'application/octet-stream'),
+            'as_attachment': False,  # Display inline for preview
+            'download_name': file_info["original_filename"]
+        }
+        
+        # File nhỏ được preview nhiều: phục vụ thẳng từ bộ nhớ, không chạm tới đĩa
+        cached_response = send_cached_file(file_info, **preview_options)
+        if cached_response:
+            return cached_response
+        
         if file_info["file_path"]:
-            file_path = UPLOAD_FOLDER / file_info["file_path"]
-            if file_path.exists():
-                # Determine file type for appropriate headers
-                file_ext = file_path.suffix.lower()
-                
-                # Set appropriate MIME type
-                mime_types = {
-                    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
-                    '.gif': 'image/gif', '.bmp': 'image/bmp', '.webp': 'image/webp',
-                    '.pdf': 'application/pdf', '.txt': 'text/plain',
-                    '.mp4': 'video/mp4', '.avi': 'video/avi', '.mov': 'video/quicktime',
-                    '.mp3': 'audio/mpeg', '.wav': 'audio/wav', '.ogg': 'audio/ogg'
-                }
-                
-                mimetype = mime_types.get(file_ext, 'application/octet-stream')
-                
-                return send_file(
-                    file_path,
-                    mimetype=mimetype,
-                    as_attachment=False,  # Display inline for preview
-                    download_name=file_info["original_filename"]
-                )
+            file_path = locate_stored_file(file_info, UPLOAD_FOLDER / file_info["file_path"])
+            if stored_exists(file_path):
+                return send_stored_file(file_path, file_info=file_info, **preview_options)
             else:
                 return jsonify({"error": "File not found on disk"}), 404
         else:
@@ -619,6 +1079,117 @@ def preview_file(file_id):
         logger.error(f"Error previewing file: {e}")
         return jsonify({"error": str(e)}), 500
 
+def load_derivatives(file_id):
+    """Kiểm tra quyền rồi lấy metadata derivative của file. Derivative bị thiếu được xếp hàng tạo lại
+    ở nền thay vì giữ worker thread chờ: trả về 202 + Retry-After để client hỏi lại.
+    Trả về (file_info, metadata, None) hoặc (None, None, response lỗi)"""
+    user = get_current_user()
+    file_info = db.get_file_by_id(file_id)
+    if not file_info:
+        return None, None, (jsonify({"error": "File not found"}), 404)
+    if file_info["user_id"] != user['id'] and user.get('role') != 'admin':
+        return None, None, (jsonify({"error": "Permission denied"}), 403)
+    if file_info["status"] != "completed" or not file_info["file_path"]:
+        return None, None, (jsonify({"error": "File not ready"}), 400)
+    if is_blob_path(file_info["file_path"]):
+        source_path = blob_store.locate(file_info["file_path"])
+    else:
+        source_path = resolve_upload_path(file_info["file_path"])
+    if not source_path or not stored_exists(source_path):
+        return None, None, (jsonify({"error": "File not found on disk"}), 404)
+    metadata = derivative_pipeline.get(file_info, source_path, wait=False)
+    if metadata is None and derivative_pipeline.enabled:
+        response = jsonify({"status": "pending", "retry_after": DERIVATIVE_RETRY_AFTER})
+        response.status_code = 202
+        response.headers['Retry-After'] = str(DERIVATIVE_RETRY_AFTER)
+        return None, None, response
+    return file_info, metadata, None
+
+@app.route('/api/files/<int:file_id>/thumbnail', methods=['GET'])
+@login_required
+def get_file_thumbnail(file_id):
+    """Thumbnail JPEG của ảnh (ETag theo nội dung, trình duyệt chỉ cần revalidate)"""
+    try:
+        file_info, metadata, error = load_derivatives(file_id)
+        if error:
+            return error
+        if not metadata or not metadata.get('thumbnail'):
+            return jsonify({"error": "Thumbnail not available"}), 404
+        key = derivative_pipeline.key_for(file_info)
+        return send_file(derivative_pipeline.thumbnail_path(key), mimetype='image/jpeg',
+                         etag=derivative_pipeline.etag(key))
+    except Exception as e:
+        logger.error(f"Error getting thumbnail for file {file_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/files/<int:file_id>/metadata', methods=['GET'])
+@login_required
+def get_file_metadata(file_id):
+    """Metadata trích xuất lúc upload: kích thước ảnh, thời lượng, số trang PDF, encoding của file text"""
+    try:
+        file_info, metadata, error = load_derivatives(file_id)
+        if error:
+            return error
+        if metadata is None:
+            return jsonify({"error": "Metadata not available"}), 404
+        response = jsonify({"id": file_info["id"], "metadata": metadata})
+        response.set_etag(derivative_pipeline.etag(derivative_pipeline.key_for(file_info)))
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error(f"Error getting metadata for file {file_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/files/<int:file_id>/text', methods=['GET'])
+@login_required
+def preview_text(file_id):
+    """Preview file text theo trang thay vì gửi cả file.
+    
+    mode=lines (start, count) | bytes (offset, length) | csv (start, count: hàng dữ liệu, kèm tên cột).
+    Mặc định csv cho .csv / .tsv, lines cho các file khác.
+    """
+    try:
+        user = get_current_user()
+        file_info = db.get_file_by_id(file_id)
+        if not file_info:
+            return jsonify({"error": "File not found"}), 404
+        if file_info["user_id"] != user['id'] and user.get('role') != 'admin':
+            return jsonify({"error": "Permission denied"}), 403
+        if file_info["status"] != "completed" or not file_info["file_path"]:
+            return jsonify({"error": "File not ready for preview"}), 400
+        
+        file_ext = Path(file_info["original_filename"]).suffix.lower()
+        mode = request.args.get('mode') or ('csv' if file_ext in CSV_EXTENSIONS else 'lines')
+        if mode not in ('lines', 'bytes', 'csv'):
+            return jsonify({"error": "Invalid mode. Valid: ['lines', 'bytes', 'csv']"}), 400
+        try:
+            start = int(request.args.get('start', 0))
+            count = int(request.args.get('count', DEFAULT_PREVIEW_LINES))
+            offset = int(request.args.get('offset', 0))
+            length = int(request.args.get('length', DEFAULT_PREVIEW_BYTES))
+        except ValueError:
+            return jsonify({"error": "start, count, offset and length must be integers"}), 400
+        
+        source_path = locate_stored_file(file_info, resolve_upload_path(file_info["file_path"]))
+        if not source_path or not stored_exists(source_path):
+            return jsonify({"error": "File not found on disk"}), 404
+        
+        key = derivative_pipeline.key_for(file_info)
+        reader, size, _ = open_stored(source_path)
+        with reader:
+            try:
+                if mode == 'bytes':
+                    window = text_preview.read_bytes(key, reader, size, offset, length)
+                elif mode == 'csv':
+                    window = text_preview.read_csv(key, reader, file_ext, start, count)
+                else:
+                    window = text_preview.read_lines(key, reader, start, count)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        return jsonify({"id": file_info["id"], "name": file_info["original_filename"], "size": size, **window})
+    except Exception as e:
+        logger.error(f"Error previewing text of file {file_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/files/<int:file_id>/info', methods=['GET'])
 @login_required
 def get_file_preview_info(file_id):
@@ -637,6 +1208,11 @@ def get_file_preview_info(file_id):
         # Determine preview type based on file extension
         file_ext = Path(file_info["original_filename"]).suffix.lower()
         
+        # Metadata đã tạo lúc upload (không chờ tạo lại ở đây: request /thumbnail, /metadata sẽ tạo nếu thiếu)
+        metadata = None
+        if file_info["status"] == "completed":
+            metadata = derivative_pipeline.load(derivative_pipeline.key_for(file_info))
+        
         preview_type = "download"  # default
         if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
             preview_type = "image"
@@ -656,7 +1232,10 @@ def get_file_preview_info(file_id):
             "upload_time": file_info["created_at"],
             "preview_type": preview_type,
             "extension": file_ext,
-            "preview_url": f"/api/files/{file_id}/preview" if preview_type != "download" else None
+            "preview_url": f"/api/files/{file_id}/preview" if preview_type != "download" else None,
+            "thumbnail_url": f"/api/files/{file_id}/thumbnail" if preview_type == "image" else None,
+            "text_preview_url": f"/api/files/{file_id}/text" if preview_type == "text" else None,
+            "metadata": metadata
         })
         
     except Exception as e:
@@ -688,48 +1267,28 @@ def create_folder():
         
         if parent_id:
             # Tìm parent folder - CHỈ TRONG FOLDER CỦA USER
-            legacy_data = load_legacy_db()
-            parent_folder = None
-            for folder in legacy_data["folders"]:
-                if folder["id"] == parent_id and folder.get("user_id") == user_id:
-                    parent_folder = folder
-                    break
+            parent_folder = db.get_folder(parent_id, user_id=user_id)
             
             if not parent_folder:
                 return jsonify({"error": "Parent folder not found or access denied"}), 404
             
             # Tạo nested path trong folder của user
-            folder_path = UPLOAD_FOLDER / parent_folder["path"] / folder_name
             relative_path = str((Path(parent_folder["path"]) / folder_name))
         else:
             # Root level folder - TRONG FOLDER CỦA USER
-            folder_path = UPLOAD_FOLDER / user_base_path / folder_name
             relative_path = f"{user_base_path}/{folder_name}"
         
-        # Tạo folder trên disk
-        folder_path.mkdir(parents=True, exist_ok=True)
-        
-        # Tạo thông tin folder - VỚI USER_ID
-        folder_info = {
-            "id": str(uuid.uuid4()),
-            "name": folder_name,
-            "path": relative_path,
-            "parent_id": parent_id,
-            "user_id": user_id,  # QUAN TRỌNG: Gán folder cho user
-            "username": username,
-            "created_time": datetime.now().isoformat(),
-            "type": "folder"
-        }
-        
-        # Lưu vào legacy database (cho folders)
-        legacy_data = load_legacy_db()
-        legacy_data["folders"].append(folder_info)
-        save_legacy_db(legacy_data)
+        # Folder chỉ là metadata: file mới được lưu dạng blob nên không cần tạo thư mục trên disk
+        # Lưu folder vào database - VỚI USER_ID
+        new_folder_id = str(uuid.uuid4())
+        if not db.create_folder(new_folder_id, folder_name, relative_path.replace('\\', '/'), user_id,
+                                username=username, parent_id=parent_id or None):
+            return jsonify({"error": "Failed to create folder"}), 500
         
         logger.info(f"Folder created: {folder_name} by user {username} (user_id: {user_id}, parent: {parent_id})")
         return jsonify({
             "success": True,
-            "folder_id": folder_info["id"],
+            "folder_id": new_folder_id,
             "message": "Folder created successfully"
         })
         
@@ -740,47 +1299,46 @@ def create_folder():
 @app.route('/api/folders/<folder_id>', methods=['DELETE'])
 @login_required
 def delete_folder(folder_id):
-    """Xóa folder từ legacy database - USER ISOLATED"""
+    """Xóa folder và các folder con - USER ISOLATED"""
     try:
         user = get_current_user()
         user_id = user['id']
         logger.info(f"Deleting folder {folder_id} for user {user['username']} (ID: {user_id})")
         
-        # FIX: First, move all files in this folder to recycle bin
-        files_in_folder = db.get_files_by_folder(folder_id, user_id)
+        subtree = db.get_folder_subtree(folder_id, user_id)
+        if not subtree:
+            logger.warning(f"Folder {folder_id} not found or access denied for user {user_id}")
+            return jsonify({"error": "Folder not found or access denied"}), 404
+        
+        # FIX: First, move all files in this folder (và các folder con) to recycle bin
+        files_in_folder = db.get_files_in_folders([folder["id"] for folder in subtree], user_id)
         deleted_files_count = 0
         
         for file_info in files_in_folder:
-            success = db.move_to_recycle_bin(file_info['id'], user_id, days_to_keep=7)
+            success = recycle_file(file_info, user_id, days_to_keep=7)
             if success:
                 deleted_files_count += 1
                 logger.info(f"Moved file {file_info['filename']} to recycle bin")
         
         logger.info(f"Moved {deleted_files_count} files to recycle bin before deleting folder")
         
-        legacy_data = load_legacy_db()
-        for i, folder_info in enumerate(legacy_data["folders"]):
-            if folder_info["id"] == folder_id and folder_info.get("user_id") == user_id:
-                # Xóa folder từ disk
-                folder_path = UPLOAD_FOLDER / folder_info["path"]
-                logger.info(f"Attempting to delete folder path: {folder_path}")
-                if folder_path.exists():
-                    shutil.rmtree(folder_path)
-                    logger.info(f"Successfully deleted folder from disk: {folder_path}")
-                
-                # Xóa khỏi legacy database
-                deleted_folder = legacy_data["folders"].pop(i)
-                save_legacy_db(legacy_data)
-                
-                logger.info(f"Folder deleted: {deleted_folder['name']} by user {user['username']}")
-                return jsonify({
-                    "success": True, 
-                    "message": f"Folder deleted successfully. {deleted_files_count} files moved to recycle bin.",
-                    "deleted_files": deleted_files_count
-                })
+        # Xóa folder từ disk
+        root_folder = subtree[0]
+        folder_path = UPLOAD_FOLDER / root_folder["path"]
+        logger.info(f"Attempting to delete folder path: {folder_path}")
+        if folder_path.exists():
+            shutil.rmtree(folder_path)
+            logger.info(f"Successfully deleted folder from disk: {folder_path}")
+        
+        # Xóa folder và folder con khỏi database
+        deleted_folders = db.delete_folder_tree(folder_id, user_id)
         
-        logger.warning(f"Folder {folder_id} not found or access denied for user {user_id}")
-        return jsonify({"error": "Folder not found or access denied"}), 404
+        logger.info(f"Folder deleted: {root_folder['name']} ({deleted_folders} folders) by user {user['username']}")
+        return jsonify({
+            "success": True, 
+            "message": f"Folder deleted successfully. {deleted_files_count} files moved to recycle bin.",
+            "deleted_files": deleted_files_count
+        })
     except Exception as e:
         logger.error(f"Error deleting folder: {e}")
         return jsonify({"error": str(e)}), 500
@@ -788,49 +1346,23 @@ def delete_folder(folder_id):
 @app.route('/api/stats', methods=['GET'])
 @login_required
 def get_stats():
-    """Lấy thống kê của user hiện tại từ SQLite database"""
+    """Lấy thống kê của user hiện tại từ bộ đếm user_stats"""
     try:
         user = get_current_user()
-        logger.info(f"Getting stats for user: {user['id']} ({user['username']})")
-        
-        # Lấy files của user hiện tại
-        user_files = db.get_user_files(user['id'])
-        
-        # Tính toán stats cho user
-        total_files = len(user_files)
-        completed_files = len([f for f in user_files if f['status'] == 'completed'])
-        uploading_files = len([f for f in user_files if f['status'] == 'uploading'])
-        paused_files = len([f for f in user_files if f['status'] == 'paused'])
-        total_size = sum(f['size'] or 0 for f in user_files if f['status'] == 'completed')
-        
-        # Lấy folder stats từ legacy database - FILTER THEO USER_ID (kể cả admin)
-        legacy_data = load_legacy_db()
-        user_folders = []
-        for folder in legacy_data.get("folders", []):
-            # Chỉ đếm folders thuộc về user hiện tại
-            if folder.get("user_id") == user['id']:
-                user_folders.append(folder)
-        
-        total_folders = len(user_folders)
-        
-        # Lấy thống kê file types từ completed files của user
-        file_types = {}
-        for file_info in user_files:
-            if file_info['status'] == 'completed':
-                ext = Path(file_info["original_filename"]).suffix.lower()
-                if ext:
-                    file_types[ext] = file_types.get(ext, 0) + 1
-        
-        logger.info(f"User {user['id']} stats: {total_files} files, {completed_files} completed")
+        
+        # Bộ đếm được cập nhật theo từng thay đổi, không cần quét files của user
+        stats = db.get_user_stats(user['id'])
+        
+        logger.debug(f"User {user['id']} stats: {stats['total_files']} files, {stats['completed_files']} completed")
         
         return jsonify({
-            "total_files": total_files,
-            "completed_files": completed_files,
-            "uploading_files": uploading_files,
-            "paused_files": paused_files,
-            "total_folders": total_folders,
-            "total_size": total_size,
-            "file_types": file_types
+            "total_files": stats['total_files'],
+            "completed_files": stats['completed_files'],
+            "uploading_files": stats['uploading_files'],
+            "paused_files": stats['paused_files'],
+            "total_folders": stats['total_folders'],
+            "total_size": stats['total_size'],
+            "file_types": stats['file_types']
         })
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
@@ -894,17 +1426,8 @@ def move_file_to_folder(file_id):
         # Cho phép folder_id = null để di chuyển về root
         move_to_root = folder_id is None or folder_id == ""
         
-        if not move_to_root and not folder_id:
-            return jsonify({"error": "Folder ID is required"}), 400
-            
-        # Lấy thông tin file từ database
-        files = db.get_all_files()
-        file_info = None
-        for f in files:
-            if str(f["id"]) == str(file_id):
-                file_info = f
-                break
-                
+        # Lấy thông tin file theo khóa chính
+        file_info = db.get_file_by_id(file_id)
         if not file_info:
             logger.error(f"❌ File not found: {file_id}")
             return jsonify({"error": "File not found"}), 404
@@ -917,11 +1440,7 @@ def move_file_to_folder(file_id):
         # Lấy thông tin folder (nếu không phải di chuyển về root)
         folder = None
         if not move_to_root:
-            legacy_data = load_legacy_db()
-            for f in legacy_data["folders"]:
-                if f["id"] == folder_id:
-                    folder = f
-                    break
+            folder = db.get_folder(folder_id)
                     
             if not folder:
                 logger.error(f"❌ Folder not found: {folder_id}")
@@ -932,105 +1451,50 @@ def move_file_to_folder(file_id):
             if folder_user_id is not None and folder_user_id != user_id:
                 logger.error(f"❌ Folder permission denied: folder user_id={folder_user_id}, current user_id={user_id}")
                 return jsonify({"error": "Folder permission denied"}), 403
-            
-        # Xác định đường dẫn file hiện tại
-        current_file_path = file_info.get("file_path")
-        logger.info(f"📁 Current file_path in DB: {current_file_path}")
-        
-        # Tìm file trên disk
-        possible_paths = []
-        if current_file_path:
-            possible_paths.append(UPLOAD_FOLDER / current_file_path)
-        
-        # Thêm các đường dẫn có thể khác
-        possible_paths.extend([
-            UPLOAD_FOLDER / username / file_info["original_filename"],
-            UPLOAD_FOLDER / file_info["original_filename"],
-            UPLOAD_FOLDER / username / "root" / file_info["original_filename"]
-        ])
-        
-        current_path = None
-        for path in possible_paths:
-            logger.info(f"🔍 Checking path: {path}")
-            if path.exists():
-                current_path = path
-                logger.info(f"✅ Found file at: {path}")
-                break
+        target_name = folder['name'] if folder else "Root"
+        target_folder_id = None if move_to_root else folder_id
+        
+        if is_blob_path(file_info.get("file_path")):
+            # Blob: folder chỉ là metadata, không đụng tới đĩa
+            if not db.update_file_locations([(file_id, file_info["file_path"])], target_folder_id):
+                return jsonify({"error": "Failed to update database"}), 500
+            read_cache.invalidate(file_info['id'])
+            return jsonify({
+                "success": True,
+                "message": f"File moved to {target_name} successfully"
+            })
         
+        current_path = locate_file_on_disk(file_info, username)
         if not current_path:
-            logger.error(f"❌ File not found on disk. Searched paths: {[str(p) for p in possible_paths]}")
+            logger.error(f"❌ File not found on disk: {file_info.get('file_path')}")
             return jsonify({"error": f"File not found on disk"}), 404
-            
-        # Xác định đường dẫn đích
-        if move_to_root:
-            # Di chuyển về root - thư mục username
-            target_folder_path = UPLOAD_FOLDER / username
-            new_file_path = target_folder_path / file_info["original_filename"]
-            new_relative_path = f"{username}/{file_info['original_filename']}"
-            target_name = "Root"
-            logger.info(f"📂 Moving to root: {target_folder_path}")
-        else:
-            # Di chuyển vào folder
-            folder_path = folder.get("path")
-            if not folder_path or folder_path == "None" or folder_path.startswith("None/"):
-                # Folder cũ không có path đúng, tạo path mới
-                folder_path = f"{username}/{folder['name']}"
-            elif not folder_path.startswith(f"{username}/"):
-                # Path không có username prefix, thêm vào
-                folder_path = f"{username}/{folder['name']}"
-                
-            target_folder_path = UPLOAD_FOLDER / folder_path
-            new_file_path = target_folder_path / file_info["original_filename"]
-            new_relative_path = str(new_file_path.relative_to(UPLOAD_FOLDER))
-            target_name = folder['name']
-            logger.info(f"📂 Moving to folder: {target_folder_path}")
-            
-        logger.info(f"📄 New file path: {new_file_path}")
-        
-        # Tạo thư mục đích
-        target_folder_path.mkdir(parents=True, exist_ok=True)
-        
-        # Kiểm tra file đích đã tồn tại chưa
-        if new_file_path.exists():
-            # Nếu file đích đã tồn tại và khác với file nguồn, tạo tên mới
-            if new_file_path.resolve() != current_path.resolve():
-                # Tạo tên file mới với timestamp để tránh trùng lặp
-                from datetime import datetime
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                name_parts = file_info["original_filename"].rsplit('.', 1)
-                if len(name_parts) == 2:
-                    new_filename = f"{name_parts[0]}_{timestamp}.{name_parts[1]}"
-                else:
-                    new_filename = f"{file_info['original_filename']}_{timestamp}"
-                
-                new_file_path = target_folder_path / new_filename
-                new_relative_path = str(new_file_path.relative_to(UPLOAD_FOLDER))
-                logger.info(f"📝 File exists, using new name: {new_filename}")
-            else:
-                # Nếu là cùng một file (chỉ là symbolic link hoặc hardlink), bỏ qua
-                logger.info(f"✅ Source and destination are the same file, operation completed")
-                return jsonify({
-                    "success": True,
-                    "message": f"File is already in {target_name}"
-                })
-            
-        # Di chuyển file
-        shutil.move(str(current_path), str(new_file_path))
-        logger.info(f"✅ File moved successfully from {current_path} to {new_file_path}")
         
-        # Cập nhật database với path tương đối
-        success = db.update_file_path(file_id, new_relative_path)
+        target_folder_path = UPLOAD_FOLDER.resolve() / folder_relative_path(folder, username)
+        if current_path.parent == target_folder_path:
+            # File đã nằm đúng thư mục: chỉ cập nhật metadata
+            new_relative_path = upload_relative_path(current_path)
+            if not db.update_file_locations([(file_id, new_relative_path)], target_folder_id):
+                return jsonify({"error": "Failed to update database"}), 500
+            read_cache.invalidate(file_info['id'])
+            return jsonify({
+                "success": True,
+                "message": f"File is already in {target_name}"
+            })
         
-        if not success:
+        # Trùng tên ở thư mục đích -> thêm hậu tố " (n)" như khi upload
+        new_file_path = available_upload_path(target_folder_path / current_path.name)
+        new_relative_path = upload_relative_path(new_file_path)
+        move_on_disk(current_path, new_file_path)
+        logger.info(f"✅ File moved from {current_path} to {new_file_path}")
+        
+        # Cập nhật file_path và folder_id trong một câu lệnh
+        if not db.update_file_locations([(file_id, new_relative_path)], target_folder_id):
             logger.error(f"❌ Failed to update database for file {file_id}")
             # Rollback: move file back
-            shutil.move(str(new_file_path), str(current_path))
+            move_on_disk(new_file_path, current_path)
             return jsonify({"error": "Failed to update database"}), 500
-            
-        # Cập nhật folder_id trong database
-        # Nếu di chuyển về root thì folder_id = null
-        target_folder_id = None if move_to_root else folder_id
-        db.update_file_folder(file_id, target_folder_id)
+        read_cache.invalidate(file_info['id'])
+        upload_path_index.record_move(upload_relative_path(current_path), new_relative_path, file_info["size"])
         
         logger.info(f"✅ File {file_info['original_filename']} moved successfully to {target_name}")
         return jsonify({
@@ -1044,6 +1508,362 @@ def move_file_to_folder(file_id):
         logger.error(f"❌ Traceback: {traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
 
+def move_on_disk(source, target):
+    """Rename nguyên tử khi cùng filesystem; khác filesystem mới phải copy (shutil.move)"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(str(source), str(target))
+
+def locate_file_on_disk(file_info, username):
+    """Đường dẫn thật của file: file_path trong DB, nếu không còn đúng thì tra chỉ mục đường dẫn"""
+    recorded = resolve_upload_path(file_info.get("file_path"))
+    if recorded and recorded.is_file():
+        return recorded
+    if upload_path_index.built_at is None:
+        # Không quét cả thư mục upload trong request: chỉ mục đang được tạo ở thread nền, tạm coi là không tìm thấy
+        maintenance.run_in_background('path_index')
+        logger.warning(f"Upload path index not ready, cannot reconcile file {file_info['id']} yet")
+        return None
+    names = [Path(file_info["file_path"]).name] if file_info.get("file_path") else []
+    names += [secure_filename(file_info["original_filename"]), file_info["original_filename"]]
+    for name in dict.fromkeys(names):
+        relative_path = upload_path_index.lookup(username, name, file_info.get("size"))
+        found = resolve_upload_path(relative_path)
+        if found and found.is_file():
+            logger.info(f"🔍 Reconciled file {file_info['id']}: {file_info.get('file_path')} -> {relative_path}")
+            return found
+    return None
+
+# ============ BULK API ROUTES ============
+# Một request cho cả danh sách: kiểm tra quyền bằng một truy vấn, ghi DB trong một transaction,
+# thao tác đĩa (rename) chạy song song; kết quả trả về theo từng item.
+
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 5000))
+DISK_IO_WORKERS = int(os.environ.get('DISK_IO_WORKERS', 8))
+disk_executor = ThreadPoolExecutor(max_workers=DISK_IO_WORKERS, thread_name_prefix='disk-io')
+INVALID_FILENAME_CHARS = r'[<>:"/\\|?*]'
+
+def read_bulk_ids(data, key='ids'):
+    """Đọc danh sách ID (số nguyên, bỏ trùng, giữ thứ tự) từ body JSON"""
+    ids = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError(f"'{key}' must be a non-empty list")
+    if len(ids) > MAX_BULK_ITEMS:
+        raise ValueError(f"Too many items (max {MAX_BULK_ITEMS})")
+    return list(dict.fromkeys(int(item_id) for item_id in ids))
+
+def run_disk_ops(operations):
+    """Chạy song song {key: hàm không tham số}; trả về {key: (kết quả, lỗi)}"""
+    futures = {key: disk_executor.submit(operation) for key, operation in operations.items()}
+    outcomes = {}
+    for key, future in futures.items():
+        try:
+            outcomes[key] = (future.result(), None)
+        except OSError as e:
+            logger.warning(f"Disk operation failed for {key}: {e}")
+            outcomes[key] = (None, 'Disk operation failed')
+    return outcomes
+
+def rename_into_place(source, target):
+    """Rename file, tạo thư mục đích nếu chưa có"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.rename(source, target)
+
+def upload_relative_path(path):
+    return path.relative_to(UPLOAD_FOLDER.resolve()).as_posix()
+
+def folder_relative_path(folder, username):
+    """Thư mục trên đĩa (tương đối với UPLOAD_FOLDER) của folder; None = thư mục gốc của user"""
+    if not folder:
+        return username
+    folder_path = folder.get("path")
+    # Folder cũ không có path đúng hoặc thiếu tiền tố username
+    if not folder_path or folder_path == "None" or folder_path.startswith("None/") \
+            or not folder_path.startswith(f"{username}/"):
+        folder_path = f"{username}/{folder['name']}"
+    return folder_path
+
+def bulk_response(item_ids, results):
+    """Response chung của API bulk: kết quả theo đúng thứ tự ID gửi lên"""
+    ordered = [results[item_id] for item_id in item_ids]
+    succeeded = sum(1 for item in ordered if item['success'])
+    return jsonify({
+        'success': succeeded == len(ordered),
+        'succeeded': succeeded,
+        'failed': len(ordered) - succeeded,
+        'results': ordered
+    })
+
+def bulk_failure(item_id, error):
+    return {'id': item_id, 'success': False, 'error': error}
+
+@app.route('/api/files/bulk/delete', methods=['POST'])
+@login_required
+def bulk_delete_files():
+    """API chuyển nhiều file vào thùng rác"""
+    try:
+        user = get_current_user()
+        try:
+            file_ids = read_bulk_ids(request.get_json(silent=True))
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        is_admin = user.get('role') == 'admin'
+        files = {f['id']: f for f in db.get_files_by_ids(file_ids, None if is_admin else user['id'])}
+        results = {file_id: bulk_failure(file_id, 'File not found or permission denied')
+                   for file_id in file_ids if file_id not in files}
+        
+        # Rename song song vào .trash, sau đó chuyển các dòng DB trong một transaction
+        outcomes = run_disk_ops({file_id: partial(move_to_trash, f['file_path']) for file_id, f in files.items()})
+        entries = []
+        for file_id, (trash_path, error) in outcomes.items():
+            if error:
+                results[file_id] = bulk_failure(file_id, error)
+            else:
+                entries.append((file_id, trash_path))
+        read_cache.invalidate(*(file_id for file_id, _ in entries))
+        moved = set(db.move_files_to_recycle_bin(entries, user['id'], days_to_keep=30 if is_admin else 7))
+        
+        # Trả file về chỗ cũ nếu dòng DB không chuyển được
+        run_disk_ops({
+            file_id: partial(os.rename, UPLOAD_FOLDER / trash_path, resolve_upload_path(files[file_id]['file_path']))
+            for file_id, trash_path in entries if file_id not in moved and trash_path
+        })
+        for file_id, _ in entries:
+            results[file_id] = {'id': file_id, 'success': True} if file_id in moved \
+                else bulk_failure(file_id, 'Failed to move file to recycle bin')
+        
+        logger.info(f"🗑️ Bulk delete by {user['username']}: {len(moved)}/{len(file_ids)} files moved to recycle bin")
+        return bulk_response(file_ids, results)
+    except Exception as e:
+        logger.error(f"Error in bulk delete: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files/bulk/move', methods=['POST'])
+@login_required
+def bulk_move_files():
+    """API di chuyển nhiều file vào một folder (folder_id null = thư mục gốc)"""
+    try:
+        user = get_current_user()
+        data = request.get_json(silent=True)
+        try:
+            file_ids = read_bulk_ids(data)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        folder_id = data.get('folder_id') or None
+        folder = None
+        if folder_id:
+            folder = db.get_folder(folder_id, user['id'])
+            if not folder:
+                return jsonify({'error': 'Folder not found'}), 404
+        target_dir = UPLOAD_FOLDER.resolve() / folder_relative_path(folder, user['username'])
+        
+        files = {f['id']: f for f in db.get_files_by_ids(file_ids, user['id'])}
+        results = {file_id: bulk_failure(file_id, 'File not found or permission denied')
+                   for file_id in file_ids if file_id not in files}
+        
+        # Chọn tên đích tuần tự (tránh trùng giữa các file trong cùng request), rename song song
+        reserved = set()
+        moves = {}
+        updates = {}
+        for file_id, f in files.items():
+            if is_blob_path(f['file_path']):
+                updates[file_id] = f['file_path']
+                continue
+            source = locate_file_on_disk(f, user['username'])
+            if not source:
+                results[file_id] = bulk_failure(file_id, 'File not found on disk')
+                continue
+            if source.parent == target_dir:
+                updates[file_id] = upload_relative_path(source)
+                continue
+            target = available_upload_path(target_dir / source.name, reserved)
+            moves[file_id] = (source, target)
+            updates[file_id] = upload_relative_path(target)
+        
+        outcomes = run_disk_ops({file_id: partial(move_on_disk, source, target)
+                                 for file_id, (source, target) in moves.items()})
+        for file_id, (_, error) in outcomes.items():
+            if error:
+                results[file_id] = bulk_failure(file_id, error)
+                del updates[file_id]
+        
+        read_cache.invalidate(*updates)
+        if not db.update_file_locations(list(updates.items()), folder_id):
+            run_disk_ops({file_id: partial(os.rename, target, source)
+                          for file_id, (source, target) in moves.items() if file_id in updates})
+            for file_id in updates:
+                results[file_id] = bulk_failure(file_id, 'Failed to update database')
+        else:
+            for file_id, new_path in updates.items():
+                results[file_id] = {'id': file_id, 'success': True, 'file_path': new_path}
+        
+        logger.info(f"🔄 Bulk move by {user['username']} to {folder['name'] if folder else 'Root'}: "
+                    f"{sum(1 for r in results.values() if r['success'])}/{len(file_ids)} files")
+        return bulk_response(file_ids, results)
+    except Exception as e:
+        logger.error(f"Error in bulk move: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files/bulk/rename', methods=['POST'])
+@login_required
+def bulk_rename_files():
+    """API đổi tên nhiều file: {"items": [{"id": 1, "new_name": "..."}]}"""
+    try:
+        user = get_current_user()
+        data = request.get_json(silent=True)
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': "'items' must be a non-empty list"}), 400
+        if len(items) > MAX_BULK_ITEMS:
+            return jsonify({'error': f"Too many items (max {MAX_BULK_ITEMS})"}), 400
+        try:
+            new_names = {int(item['id']): str(item.get('new_name', '')).strip() for item in items}
+        except (KeyError, ValueError, TypeError):
+            return jsonify({'error': "Each item needs an integer 'id' and a 'new_name'"}), 400
+        file_ids = list(new_names)
+        
+        is_admin = user.get('role') == 'admin'
+        files = {f['id']: f for f in db.get_files_by_ids(file_ids, None if is_admin else user['id'])}
+        results = {file_id: bulk_failure(file_id, 'File not found or permission denied')
+                   for file_id in file_ids if file_id not in files}
+        
+        # Chuẩn hóa tên mới (giữ extension cũ như API rename đơn lẻ)
+        renames = {}
+        for file_id, f in files.items():
+            new_name = new_names[file_id]
+            if not new_name:
+                results[file_id] = bulk_failure(file_id, 'New file name is required')
+                continue
+            if re.search(INVALID_FILENAME_CHARS, new_name):
+                results[file_id] = bulk_failure(file_id, 'Invalid characters in file name')
+                continue
+            old_name_parts = f['original_filename'].rsplit('.', 1)
+            if len(old_name_parts) > 1:
+                new_name_parts = new_name.rsplit('.', 1)
+                if len(new_name_parts) == 1 or new_name_parts[1] != old_name_parts[1]:
+                    new_name = f"{new_name}.{old_name_parts[1]}"
+            source = resolve_upload_path(f['file_path'])
+            if not source:
+                results[file_id] = bulk_failure(file_id, 'File not found on disk')
+                continue
+            # Blob: đổi tên chỉ là cập nhật metadata, giữ nguyên đường dẫn
+            target = source if is_blob_path(f['file_path']) else source.parent / new_name
+            renames[file_id] = (new_name, source, target)
+        
+        # Trùng tên: với file khác trong DB (cùng chủ sở hữu), trên đĩa, hoặc giữa các item trong request
+        taken = {(row['user_id'], row['original_filename'].lower()): row['id'] for row in db.find_files_by_names(
+            {files[file_id]['user_id'] for file_id in renames}, [name for name, _, _ in renames.values()])}
+        claimed = set()
+        disk_ops = {}
+        for file_id, (new_name, source, target) in list(renames.items()):
+            key = (files[file_id]['user_id'], new_name.lower())
+            case_only = str(source).lower() == str(target).lower()
+            if taken.get(key, file_id) != file_id or key in claimed or (not case_only and target.exists()):
+                results[file_id] = bulk_failure(file_id, 'A file with this name already exists')
+                del renames[file_id]
+                continue
+            claimed.add(key)
+            if source != target and source.exists():
+                disk_ops[file_id] = partial(os.rename, source, target)
+        
+        for file_id, (_, error) in run_disk_ops(disk_ops).items():
+            if error:
+                results[file_id] = bulk_failure(file_id, error)
+                del renames[file_id]
+        
+        updates = [(file_id, new_name, upload_relative_path(target))
+                   for file_id, (new_name, _, target) in renames.items()]
+        read_cache.invalidate(*renames)
+        if not db.rename_files(updates):
+            run_disk_ops({file_id: partial(os.rename, target, source)
+                          for file_id, (_, source, target) in renames.items() if file_id in disk_ops})
+            for file_id in renames:
+                results[file_id] = bulk_failure(file_id, 'Failed to update database')
+        else:
+            for file_id, new_name, new_path in updates:
+                results[file_id] = {'id': file_id, 'success': True, 'new_name': new_name, 'new_path': new_path}
+        
+        return bulk_response(file_ids, results)
+    except Exception as e:
+        logger.error(f"Error in bulk rename: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/recycle-bin/bulk/restore', methods=['POST'])
+@login_required
+def bulk_restore_files():
+    """API khôi phục nhiều file từ thùng rác"""
+    try:
+        user = get_current_user()
+        try:
+            recycle_ids = read_bulk_ids(request.get_json(silent=True))
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        scope = None if user.get('role') == 'admin' else user['id']
+        entries = {entry['id']: entry for entry in db.get_recycle_entries(recycle_ids, scope)}
+        results = {recycle_id: bulk_failure(recycle_id, 'File not found or permission denied')
+                   for recycle_id in recycle_ids if recycle_id not in entries}
+        
+        # Đưa file từ .trash về chỗ cũ (tên khác nếu đã có file mới ở đó)
+        reserved = set()
+        moves = {}
+        file_paths = {}
+        for recycle_id, entry in entries.items():
+            file_paths[recycle_id] = entry['file_path']
+            trash_file = resolve_upload_path(entry['trash_path'])
+            original = resolve_upload_path(entry['file_path'])
+            if trash_file and original:
+                target = available_upload_path(original, reserved)
+                moves[recycle_id] = (trash_file, target)
+                file_paths[recycle_id] = upload_relative_path(target)
+        
+        outcomes = run_disk_ops({recycle_id: partial(rename_into_place, trash_file, target)
+                                 for recycle_id, (trash_file, target) in moves.items()})
+        for recycle_id, (_, error) in outcomes.items():
+            if error:
+                results[recycle_id] = bulk_failure(recycle_id, error)
+                del file_paths[recycle_id]
+        
+        restored = set(db.restore_many_from_recycle_bin(list(file_paths.items()), scope))
+        run_disk_ops({recycle_id: partial(os.rename, target, trash_file)
+                      for recycle_id, (trash_file, target) in moves.items()
+                      if recycle_id in file_paths and recycle_id not in restored})
+        for recycle_id, file_path in file_paths.items():
+            results[recycle_id] = {'id': recycle_id, 'success': True, 'file_path': file_path} \
+                if recycle_id in restored else bulk_failure(recycle_id, 'Failed to restore file')
+        
+        return bulk_response(recycle_ids, results)
+    except Exception as e:
+        logger.error(f"Error in bulk restore: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/recycle-bin/bulk/delete', methods=['POST'])
+@login_required
+def bulk_permanently_delete_files():
+    """API xóa vĩnh viễn nhiều file trong thùng rác (file vật lý do job recycle_purge xóa)"""
+    try:
+        user = get_current_user()
+        try:
+            recycle_ids = read_bulk_ids(request.get_json(silent=True))
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        scope = None if user.get('role') == 'admin' else user['id']
+        deleted = set(db.permanently_delete_many_from_recycle(recycle_ids, scope))
+        results = {recycle_id: {'id': recycle_id, 'success': True} if recycle_id in deleted
+                   else bulk_failure(recycle_id, 'File not found or permission denied')
+                   for recycle_id in recycle_ids}
+        return bulk_response(recycle_ids, results)
+    except Exception as e:
+        logger.error(f"Error in bulk permanent delete: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # ============ ADMIN API ROUTES ============
 
 @app.route('/api/admin/stats', methods=['GET'])
@@ -1052,42 +1872,123 @@ def move_file_to_folder(file_id):
 def admin_get_stats():
     """API lấy thống kê tổng quan cho admin"""
     try:
-        # Lấy tất cả users
-        users = auth_db.get_all_users()
-        
-        # Lấy tất cả files
-        all_files = db.get_all_files()
+        user_counts = auth_db.get_user_counts()
         
-        # Tính toán stats
-        total_users = len(users)
-        total_files = len(all_files)
-        total_size = sum(f.get('size', 0) or 0 for f in all_files if f.get('status') == 'completed')
+        # Thống kê files từ bộ đếm user_stats
+        stats = db.get_global_stats()
         
-        # Files upload hôm nay
-        from datetime import datetime, date
-        today = date.today().isoformat()
-        today_uploads = len([f for f in all_files if f.get('created_at', '').startswith(today)])
+        # Files upload hôm nay (theo giờ Việt Nam) - range query trên index created_at
+        daily_uploads = db.get_daily_upload_counts(days=7)
         
         return jsonify({
-            'total_users': total_users,
-            'total_files': total_files,
-            'total_size': total_size,
-            'today_uploads': today_uploads,
-            'active_users': len([u for u in users if u.get('last_login')]),
-            'completed_files': len([f for f in all_files if f.get('status') == 'completed'])
+            'total_users': user_counts['total_users'],
+            'total_files': stats['total_files'],
+            'total_size': stats['total_size'],
+            'today_uploads': daily_uploads[-1]['count'],
+            'daily_uploads': daily_uploads,
+            'active_users': user_counts['active_users'],
+            'completed_files': stats['completed_files']
         })
     except Exception as e:
         logger.error(f"Error getting admin stats: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/stats/rebuild', methods=['POST'])
+@login_required
+@admin_required
+def admin_rebuild_stats():
+    """API admin tính lại bộ đếm thống kê từ đầu (job sửa chữa)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        user_id = data.get('user_id')
+        if not db.rebuild_user_stats(user_id):
+            return jsonify({'error': 'Failed to rebuild stats'}), 500
+        return jsonify({'success': True, 'message': 'Stats rebuilt successfully'})
+    except Exception as e:
+        logger.error(f"Error rebuilding stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/auth-cache', methods=['GET'])
+@login_required
+@admin_required
+def admin_auth_cache_stats():
+    """API xem hit/miss của token cache (xác thực token trong process file manager)"""
+    return jsonify(auth_db.get_token_cache_stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics dạng Prometheus text format (scraper không đăng nhập được nên dùng METRICS_TOKEN thay cho session)"""
+    if not metrics_authorized(request.headers.get('Authorization'), request.remote_addr):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/api/admin/read-cache', methods=['GET'])
+@login_required
+@admin_required
+def admin_read_cache_stats():
+    """API xem hit ratio / dung lượng của read cache (nội dung file nhỏ trong bộ nhớ)"""
+    return jsonify(read_cache.stats())
+
+@app.route('/api/admin/maintenance', methods=['GET'])
+@login_required
+@admin_required
+def admin_maintenance_stats():
+    """API xem số liệu các job dọn dẹp định kỳ (số lần chạy, thời gian, kết quả gần nhất)"""
+    return jsonify({'enabled': MAINTENANCE_ENABLED, 'running': maintenance.started, 'jobs': maintenance.stats()})
+
+@app.route('/api/admin/maintenance/<job_name>/run', methods=['POST'])
+@login_required
+@admin_required
+def admin_run_maintenance_job(job_name):
+    """API chạy ngay một job dọn dẹp"""
+    if job_name not in maintenance.jobs:
+        return jsonify({'error': 'Unknown job'}), 404
+    result = maintenance.run_job(job_name)
+    return jsonify({'success': True, 'result': result, 'stats': maintenance.jobs[job_name].stats()})
+
+@app.route('/api/admin/login-protection', methods=['GET'])
+@login_required
+@admin_required
+def admin_login_protection_stats():
+    """API xem trạng thái pool hash mật khẩu và bộ đếm throttle login"""
+    return jsonify({
+        'hash_pool': auth_db.hash_pool.stats(),
+        'throttle': login_throttle.stats()
+    })
+
+@app.route('/api/admin/storage', methods=['GET'])
+@login_required
+@admin_required
+def admin_storage_report():
+    """API admin so sánh dung lượng logic (tổng size file) với dung lượng thật trên đĩa sau khi khử trùng lặp / nén"""
+    try:
+        return jsonify({**db.get_storage_report(), 'compression': compression_worker.stats(),
+                        'tiering': storage_tiering.stats(), 'derivatives': derivative_pipeline.stats(),
+                        'text_preview': text_preview.stats()})
+    except Exception as e:
+        logger.error(f"Error getting storage report: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/admin/users', methods=['GET'])
 @login_required
 @admin_required
 def admin_get_users():
-    """API lấy danh sách tất cả users cho admin"""
+    """API lấy danh sách users cho admin (phân trang, sort, lọc, kèm thống kê theo user)"""
     try:
-        users = auth_db.get_all_users()
-        return jsonify(users)
+        page = max(1, request.args.get('page', 1, type=int))
+        page_size = max(1, min(request.args.get('page_size', 50, type=int), MAX_PAGE_SIZE))
+        try:
+            result = db.get_admin_users_page(
+                search=request.args.get('q'),
+                role=request.args.get('role'),
+                sort=request.args.get('sort', 'id'),
+                order=request.args.get('order', 'asc'),
+                page=page,
+                page_size=page_size
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error getting users: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1162,26 +2063,56 @@ def admin_reset_password(user_id):
         logger.error(f"Error resetting password: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/users/<int:user_id>/quota', methods=['PUT'])
+@login_required
+@admin_required
+def admin_set_user_quota(user_id):
+    """API đặt hạn mức dung lượng riêng cho user: {"quota_bytes": số byte | 0 = không giới hạn | null = theo role}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        quota_bytes = data.get('quota_bytes')
+        if quota_bytes is not None and (not isinstance(quota_bytes, int) or quota_bytes < 0):
+            return jsonify({'error': 'quota_bytes must be a non-negative integer or null'}), 400
+        
+        if not auth_db.set_user_quota(user_id, quota_bytes):
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify({'success': True, 'quota_bytes': quota_bytes, 'used_bytes': db.get_user_used_bytes(user_id)})
+    except Exception as e:
+        logger.error(f"Error setting user quota: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/quotas', methods=['GET'])
+@login_required
+@admin_required
+def admin_quota_stats():
+    """API xem hạn mức theo role và các upload HTTP đang giữ chỗ"""
+    return jsonify(storage_quota.stats())
+
 @app.route('/api/admin/files', methods=['GET'])
 @login_required
 @admin_required
 def admin_get_files():
-    """API lấy danh sách tất cả files cho admin"""
+    """API lấy danh sách files toàn hệ thống cho admin (JOIN username trong SQL, keyset pagination)"""
     try:
-        all_files = db.get_all_files()
-        
-        # Lấy thông tin user cho mỗi file
-        users = {user['id']: user for user in auth_db.get_all_users()}
-        
-        # Thêm username vào file info
-        for file in all_files:
-            user_id = file.get('user_id')
-            if user_id and user_id in users:
-                file['username'] = users[user_id]['username']
-            else:
-                file['username'] = 'Unknown'
+        limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        try:
+            page = db.get_admin_files_page(
+                user_id=request.args.get('user_id', type=int),
+                status=request.args.get('status'),
+                extension=request.args.get('extension'),
+                search=request.args.get('q'),
+                created_from=request.args.get('created_from'),
+                created_to=request.args.get('created_to'),
+                sort=request.args.get('sort', 'created_at'),
+                order=request.args.get('order', 'desc'),
+                limit=limit,
+                cursor=request.args.get('cursor')
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify(all_files)
+        page['limit'] = limit
+        return jsonify(page)
     except Exception as e:
         logger.error(f"Error getting admin files: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1200,7 +2131,8 @@ def admin_delete_file(file_id):
         logger.info(f"🗑️ ADMIN DELETE FILE - User: {current_user['username']} (ID: {current_user['id']}) deleting file ID: {file_id}")
         
         # Di chuyển file vào recycle bin thay vì xóa ngay
-        success = db.move_to_recycle_bin(file_id, current_user['id'], days_to_keep=30)
+        file_info = db.get_file_by_id(file_id)
+        success = file_info is not None and recycle_file(file_info, current_user['id'], days_to_keep=30)
         if success:
             logger.info(f"✅ File {file_id} moved to recycle bin successfully by admin {current_user['username']}")
             return jsonify({'success': True, 'message': 'File moved to recycle bin successfully'})
@@ -1225,7 +2157,7 @@ def test_recycle_bin():
         logger.info("🧪 TEST RECYCLE BIN ENDPOINT CALLED")
         
         # Test database connection
-        with sqlite3.connect(db.db_path) as conn:
+        with db.pool.connection() as conn:
             cursor = conn.execute("SELECT COUNT(*) FROM recycle_bin")
             total_count = cursor.fetchone()[0]
             
@@ -1313,10 +2245,27 @@ def restore_file(recycle_id):
             return jsonify({'error': 'User not found'}), 401
         user_id = None if current_user.get('role') == 'admin' else current_user['id']
         
-        success = db.restore_from_recycle_bin(recycle_id, user_id)
+        entry = db.get_recycle_entry(recycle_id, user_id)
+        if not entry:
+            return jsonify({'error': 'Failed to restore file or file not found'}), 404
+        
+        # Đưa file vật lý từ .trash về chỗ cũ (tên khác nếu chỗ cũ đã có file mới)
+        file_path = entry['file_path']
+        trash_file = resolve_upload_path(entry['trash_path'])
+        original = resolve_upload_path(file_path)
+        target = None
+        if trash_file and original and trash_file.is_file():
+            target = available_upload_path(original)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(trash_file, target)
+            file_path = target.relative_to(UPLOAD_FOLDER.resolve()).as_posix()
+        
+        success = db.restore_from_recycle_bin(recycle_id, user_id, file_path=file_path)
         if success:
             return jsonify({'success': True, 'message': 'File restored successfully'})
         else:
+            if target:
+                os.rename(target, trash_file)
             return jsonify({'error': 'Failed to restore file or file not found'}), 404
     except Exception as e:
         logger.error(f"Error restoring file: {e}")
@@ -1341,7 +2290,7 @@ def delete_user_file(file_id):
             return jsonify({'error': 'Permission denied'}), 403
         
         # Di chuyển file vào recycle bin
-        success = db.move_to_recycle_bin(file_id, current_user['id'], days_to_keep=7)  # User file giữ 7 ngày
+        success = recycle_file(file_info, current_user['id'], days_to_keep=7)  # User file giữ 7 ngày
         if success:
             return jsonify({'success': True, 'message': 'File moved to recycle bin successfully'})
         else:
@@ -1398,9 +2347,10 @@ def rename_file(file_id):
                 new_name = f"{new_name}.{old_extension}"
                 logger.info(f"🔧 Auto-added extension: {new_name}")
         
-        # Tạo đường dẫn file mới
+        # Tạo đường dẫn file mới (blob: tên file chỉ là metadata, đường dẫn trên đĩa giữ nguyên)
+        is_blob = is_blob_path(file_info['file_path'])
         directory = old_file_path.parent
-        new_file_path = directory / new_name
+        new_file_path = old_file_path if is_blob else directory / new_name
         
         logger.info(f"🔧 New file path: {new_file_path}")
         logger.info(f"🔧 Old path exists: {old_file_path.exists()}")
@@ -1414,11 +2364,12 @@ def rename_file(file_id):
         logger.info(f"🔧 Case-insensitive same: {old_path_str == new_path_str}")
         
         # Nếu tên file giống nhau (case-insensitive), cho phép rename
-        if old_path_str == new_path_str:
+        same_name = old_name.lower() == new_name.lower() if is_blob else old_path_str == new_path_str
+        if same_name:
             logger.info(f"🔧 Same filename case-insensitive, allowing rename for case change")
         else:
             # Khác tên -> kiểm tra trung lặp
-            if new_file_path.exists():
+            if not is_blob and new_file_path.exists():
                 logger.warning(f"🔧 File already exists at {new_file_path}")
                 return jsonify({'error': 'A file with this name already exists'}), 409
             
@@ -1431,7 +2382,7 @@ def rename_file(file_id):
                     return jsonify({'error': 'A file with this name already exists'}), 409
         
         # Đổi tên file vật lý
-        if old_file_path.exists():
+        if not is_blob and old_file_path.exists():
             old_file_path.rename(new_file_path)
             logger.info(f"File renamed from {old_file_path} to {new_file_path}")
         
@@ -1440,6 +2391,7 @@ def rename_file(file_id):
         # Chuẩn hóa path separator cho cross-platform compatibility
         relative_new_path_normalized = relative_new_path.replace('\\', '/')
         
+        read_cache.invalidate(file_id)
         success = db.update_file_name(file_id, new_name, relative_new_path_normalized)
         
         if success:
@@ -1452,7 +2404,7 @@ def rename_file(file_id):
             })
         else:
             # Rollback file rename nếu database update thất bại
-            if new_file_path.exists():
+            if not is_blob and new_file_path.exists():
                 new_file_path.rename(old_file_path)
             return jsonify({'error': 'Failed to update database'}), 500
             
@@ -1472,13 +2424,7 @@ def permanently_delete_file(recycle_id):
         
         success, file_path = db.permanently_delete_from_recycle(recycle_id, user_id)
         if success:
-            # Xóa file vật lý
-            if file_path:
-                physical_path = UPLOAD_FOLDER / file_path
-                if physical_path.exists():
-                    physical_path.unlink()
-                    logger.info(f"Physical file deleted: {physical_path}")
-            
+            # File vật lý được job recycle_purge xóa theo lô (xem purge_recycle_bin)
             return jsonify({'success': True, 'message': 'File permanently deleted'})
         else:
             return jsonify({'error': 'Failed to delete file or file not found'}), 404
@@ -0,0 +1,84 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Mỗi tài khoản: tối đa LOGIN_ACCOUNT_LIMIT lần thử trong LOGIN_ACCOUNT_WINDOW giây (login đúng thì reset)
+LOGIN_ACCOUNT_LIMIT = int(os.environ.get('LOGIN_ACCOUNT_LIMIT', 5))
+LOGIN_ACCOUNT_WINDOW = float(os.environ.get('LOGIN_ACCOUNT_WINDOW', 300))
+# Mỗi IP: tối đa LOGIN_IP_LIMIT lần thử trong LOGIN_IP_WINDOW giây
+LOGIN_IP_LIMIT = int(os.environ.get('LOGIN_IP_LIMIT', 30))
+LOGIN_IP_WINDOW = float(os.environ.get('LOGIN_IP_WINDOW', 60))
+# Số key (tài khoản + IP) được theo dõi; key cũ nhất bị bỏ khi vượt quá
+LOGIN_THROTTLE_MAX_KEYS = int(os.environ.get('LOGIN_THROTTLE_MAX_KEYS', 100000))
+
+
+class LoginThrottle:
+    """Giới hạn số lần thử login theo tài khoản và theo IP (token bucket, chạy trước khi hash mật khẩu)
+
+    Mỗi lần thử lấy một token ở cả hai bucket; bucket được nạp lại đều đặn limit/window token mỗi giây.
+    limit <= 0 tắt giới hạn tương ứng.
+    """
+
+    def __init__(self, account_limit=LOGIN_ACCOUNT_LIMIT, account_window=LOGIN_ACCOUNT_WINDOW,
+                 ip_limit=LOGIN_IP_LIMIT, ip_window=LOGIN_IP_WINDOW, max_keys=LOGIN_THROTTLE_MAX_KEYS):
+        self.limits = {
+            'account': (account_limit, account_window),
+            'ip': (ip_limit, ip_window),
+        }
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # (loại, key) -> [số token, thời điểm cập nhật]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = {'account': 0, 'ip': 0}
+
+    def _refill(self, kind, key, now):
+        limit, window = self.limits[kind]
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            bucket = self._buckets[(kind, key)] = [float(limit), now]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / window)
+            bucket[1] = now
+            self._buckets.move_to_end((kind, key))
+        return bucket
+
+    def acquire(self, username, ip):
+        """Ghi nhận một lần thử login. Trả về 0 nếu được phép, ngược lại số giây nên chờ (Retry-After)"""
+        keys = {'account': (username or '').lower(), 'ip': ip or 'unknown'}
+        now = time.monotonic()
+        with self._lock:
+            buckets = {}
+            for kind, key in keys.items():
+                limit, window = self.limits[kind]
+                if limit <= 0:
+                    continue
+                bucket = buckets[kind] = self._refill(kind, key, now)
+                if bucket[0] < 1:
+                    self.rejected[kind] += 1
+                    return max(1, int((1 - bucket[0]) * window / limit + 0.999))
+            # Chỉ trừ token khi mọi bucket đều còn, để request bị chặn theo IP không khóa luôn tài khoản
+            for bucket in buckets.values():
+                bucket[0] -= 1
+            self.allowed += 1
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0
+
+    def succeeded(self, username):
+        """Login đúng: trả lại đủ lượt thử cho tài khoản"""
+        with self._lock:
+            self._buckets.pop(('account', (username or '').lower()), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'allowed': self.allowed,
+                'rejected_account': self.rejected['account'],
+                'rejected_ip': self.rejected['ip'],
+                'tracked_keys': len(self._buckets),
+                'account_limit': self.limits['account'][0],
+                'account_window_seconds': self.limits['account'][1],
+                'ip_limit': self.limits['ip'][0],
+                'ip_window_seconds': self.limits['ip'][1]
+            }
@@ -0,0 +1,133 @@
+import os
+import time
+import random
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Tắt scheduler (ví dụ khi chạy nhiều process và chỉ muốn một process dọn dẹp): MAINTENANCE_ENABLED=0
+MAINTENANCE_ENABLED = os.environ.get('MAINTENANCE_ENABLED', '1') != '0'
+# Lệch ngẫu nhiên ±10% chu kỳ để các process / các job không chạy dồn cùng một lúc
+MAINTENANCE_JITTER = float(os.environ.get('MAINTENANCE_JITTER', 0.1))
+
+
+class MaintenanceJob:
+    """Một job định kỳ kèm số liệu thời gian chạy"""
+
+    def __init__(self, name, func, interval, jitter):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        # Lần chạy đầu tiên rải ngẫu nhiên trong khoảng jitter để các job không khởi động cùng lúc
+        self.next_run = time.monotonic() + random.uniform(1, max(1, interval * jitter))
+        self.runs = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = None
+        self.last_run_at = None
+        self.last_result = None
+        self.last_error = None
+
+    def schedule_next(self):
+        spread = self.interval * self.jitter
+        self.next_run = time.monotonic() + self.interval + random.uniform(-spread, spread)
+
+    def stats(self):
+        return {
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'running': self.lock.locked(),
+            'last_run_at': self.last_run_at,
+            'last_duration_ms': self.last_ms,
+            'avg_duration_ms': round(self.total_ms / self.runs, 2) if self.runs else None,
+            'max_duration_ms': self.max_ms,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+            'next_run_in_seconds': round(max(0.0, self.next_run - time.monotonic()), 1)
+        }
+
+
+class MaintenanceScheduler:
+    """Chạy các job dọn dẹp định kỳ trong một thread nền (ngoài luồng xử lý request)"""
+
+    def __init__(self, jitter=MAINTENANCE_JITTER):
+        self.jitter = jitter
+        self.jobs = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_job(self, name, func, interval):
+        """Đăng ký job `func()` chạy mỗi `interval` giây; giá trị trả về được lưu làm last_result"""
+        self.jobs[name] = MaintenanceJob(name, func, interval, self.jitter)
+        self._wakeup.set()
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='maintenance', daemon=True)
+            self._thread.start()
+        logger.info(f"Maintenance scheduler started with jobs: {', '.join(self.jobs)}")
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run_job(self, name):
+        """Chạy ngay một job (bỏ qua nếu job đang chạy). Trả về kết quả của job"""
+        job = self.jobs[name]
+        if not job.lock.acquire(blocking=False):
+            return None
+        start = time.perf_counter()
+        try:
+            job.last_result = job.func()
+            job.last_error = None
+            return job.last_result
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            logger.error(f"Maintenance job {name} failed: {e}")
+        finally:
+            elapsed = round((time.perf_counter() - start) * 1000, 2)
+            job.runs += 1
+            job.last_ms = elapsed
+            job.total_ms += elapsed
+            job.max_ms = max(job.max_ms, elapsed)
+            job.last_run_at = datetime.now().isoformat()
+            job.schedule_next()
+            job.lock.release()
+
+    def run_in_background(self, name):
+        """Chạy ngay một job trong thread riêng, không chờ kết quả (bỏ qua nếu job đang chạy)"""
+        if self.jobs[name].lock.locked():
+            return False
+        threading.Thread(target=self.run_job, args=(name,), name=f'maintenance-{name}', daemon=True).start()
+        return True
+
+    def stats(self):
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for job in list(self.jobs.values()):
+                if job.next_run <= now and not self._stop.is_set():
+                    self.run_job(job.name)
+            next_run = min((job.next_run for job in self.jobs.values()), default=now + 60)
+            self._wakeup.clear()
+            # Tối thiểu 0.5s: job đang được chạy tay (run_job) thì vòng lặp không quay liên tục
+            self._wakeup.wait(max(0.5, next_run - time.monotonic()))
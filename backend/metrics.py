@@ -0,0 +1,284 @@
+import os
+import time
+import bisect
+import threading
+from functools import wraps
+
+# Số liệu dạng Prometheus (text exposition format 0.0.4) không cần thư viện ngoài.
+# Mỗi process (server, file_manager) có registry riêng; ghi số liệu chỉ là một bisect + cộng
+# dưới lock, các giá trị tốn công tính (số session theo trạng thái, token cache) lấy lúc scrape qua collector.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+# Đặt token thì /metrics yêu cầu header "Authorization: Bearer <token>"; không đặt thì chỉ nhận request
+# từ localhost (đứng sau reverse proxy cùng máy thì phải đặt token, vì mọi request đều tới từ localhost)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+LOOPBACK_ADDRESSES = {'127.0.0.1', '::1', '::ffff:127.0.0.1'}
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket mặc định (giây) cho latency, từ 0.5ms tới 10s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bucket cho thao tác dài (relay file lên file manager, download)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2,
+                      256 * 1024 ** 2, 1024 ** 3)
+# Lượt truyền nhỏ hơn chừng này thì thời gian chủ yếu là overhead, không tính vào histogram tốc độ
+THROUGHPUT_MIN_BYTES = 256 * 1024
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+
+    def labels(self, *values, **kwargs):
+        """Child theo giá trị label; code ở hot path nên lấy child một lần rồi giữ lại"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        child = self._children.get(values)
+        if child is None:
+            key = tuple(str(v) for v in values)
+            with self._lock:
+                child = self._children.get(key) or self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for key, child in children:
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value):
+        """Chỉ dùng trong collector, để copy một bộ đếm đã có sẵn ở nơi khác"""
+        self._value = value
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{_format_labels(labelnames, key)} {_format_value(self._value)}"]
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+
+class _HistogramChild:
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def render(self, name, labelnames, key):
+        counts, total = self.snapshot()
+        lines, cumulative = [], 0
+        for bound, count in zip(self._bounds + (float('inf'),), counts):
+            cumulative += count
+            le = (('le', _format_value(float(bound))),)
+            lines.append(f"{name}_bucket{_format_labels(labelnames, key, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, key)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """with HISTOGRAM.time(): ... -> ghi thời gian chạy (giây)"""
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class MetricsRegistry:
+    """Tập metric của một process; collector là hàm được gọi lúc scrape để cập nhật gauge"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Module được import lại (reload / test): dùng tiếp metric cũ
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def add_collector(self, func):
+        self._collectors.append(func)
+
+    def render(self):
+        """Nội dung trả về cho /metrics"""
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception:
+                # Collector lỗi không được làm hỏng cả trang metrics
+                pass
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'db_query_seconds', 'Thời gian chạy các method của FileDatabase', ['method'])
+
+
+def instrument_methods(obj, histogram, prefix=''):
+    """Bọc mọi method public của obj (trên instance) để ghi thời gian chạy vào histogram{method}"""
+    if not METRICS_ENABLED:
+        return obj
+    for name in dir(type(obj)):
+        if name.startswith('_') or not callable(getattr(type(obj), name)):
+            continue
+        method = getattr(obj, name)
+
+        # Child được tạo ở lần gọi đầu tiên: method chưa chạy lần nào không sinh series toàn số 0
+        def timed(*args, _method=method, _label=prefix + name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                histogram.labels(_label).observe(time.perf_counter() - start)
+
+        setattr(obj, name, wraps(method)(timed))
+    return obj
+
+
+def token_cache_collector(auth_db):
+    """Collector copy số hit / miss của token cache sang metric (token cache tự đếm, không ghi hai lần)"""
+    lookups = REGISTRY.counter('auth_token_cache_lookups_total', 'Số lượt tra token cache', ['result'])
+    entries = REGISTRY.gauge('auth_token_cache_entries', 'Số token đang nằm trong cache')
+
+    def collect():
+        stats = auth_db.get_token_cache_stats()
+        lookups.labels('hit').set(stats['hits'])
+        lookups.labels('miss').set(stats['misses'])
+        entries.set(stats['size'])
+    return collect
+
+
+def authorized(authorization_header, remote_addr):
+    """Có METRICS_TOKEN: kiểm tra header Authorization; không có: chỉ cho phép scrape từ localhost"""
+    if METRICS_TOKEN:
+        return authorization_header == f"Bearer {METRICS_TOKEN}"
+    return remote_addr in LOOPBACK_ADDRESSES
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Chuyển file đã upload từ cây thư mục cũ (remote_uploads/<username>/<folder>/<tên>) sang
+blob theo ID (remote_uploads/blobs/<aa>/<bb>/<id>) ngay tại chỗ (rename, không copy).
+
+Có thể dừng và chạy lại bất cứ lúc nào: trạng thái nằm trong files.db (file_path chưa bắt đầu
+bằng blobs/). Nếu lần trước đã rename file nhưng chưa kịp cập nhật DB, lần sau thấy blob đã có
+và chỉ cập nhật DB. Mỗi lô được ghi DB trong một transaction.
+
+File trong thùng rác giữ nguyên đường dẫn cũ (khôi phục / purge vẫn dùng đường dẫn đó).
+
+Chạy: python migrate_blobs.py [--db files.db] [--uploads remote_uploads] [--batch-size 500] [--dry-run]
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+from blob_store import BlobStore, BLOB_DIRNAME
+from database import FileDatabase
+
+BACKEND_DIR = Path(__file__).parent
+# Thư mục không chứa file của user (đã là blob / thùng rác)
+SKIP_DIRS = {BLOB_DIRNAME, '.trash'}
+
+
+def resolve_source(uploads_root, relative_path):
+    """Đường dẫn tuyệt đối của file_path cũ, None nếu ra ngoài thư mục upload"""
+    path = (uploads_root / relative_path).resolve()
+    if not str(path).startswith(str(uploads_root) + os.sep):
+        return None
+    return path
+
+
+def migrate_batch(db, store, uploads_root, rows, dry_run):
+    """Chuyển một lô file; trả về (số đã chuyển, số thiếu trên đĩa, số lỗi)"""
+    updates = []
+    missing = failed = 0
+    for row in rows:
+        source = resolve_source(uploads_root, row['file_path'])
+        blob_path = store.path(row['id'])
+        try:
+            if source and source.is_file():
+                if not dry_run:
+                    store.adopt(row['id'], source)
+            elif not blob_path.is_file():
+                missing += 1
+                print(f"  ! file {row['id']} not found on disk: {row['file_path']}")
+                continue
+            updates.append((row['id'], store.relative_path(row['id'])))
+        except OSError as e:
+            failed += 1
+            print(f"  ! file {row['id']} ({row['file_path']}): {e}")
+    if not dry_run:
+        db.update_file_paths(updates)
+    return len(updates), missing, failed
+
+
+def prune_empty_dirs(uploads_root):
+    """Xóa các thư mục rỗng còn lại của cây thư mục cũ (không đụng tới blobs/ và .trash/)"""
+    removed = 0
+    for entry in os.scandir(uploads_root):
+        if not entry.is_dir() or entry.name in SKIP_DIRS:
+            continue
+        for dirpath, _, _ in os.walk(entry.path, topdown=False):
+            try:
+                os.rmdir(dirpath)
+                removed += 1
+            except OSError:
+                pass  # Còn file (ví dụ file thiếu dòng DB) -> giữ lại
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate uploaded files to ID-addressed blob storage")
+    parser.add_argument('--db', default=str(BACKEND_DIR / 'files.db'), help="Đường dẫn files.db")
+    parser.add_argument('--uploads', default=str(BACKEND_DIR / 'remote_uploads'), help="Thư mục upload")
+    parser.add_argument('--batch-size', type=int, default=500, help="Số file mỗi lô / transaction")
+    parser.add_argument('--limit', type=int, default=None, help="Dừng sau khoảng N file (chạy lại để tiếp tục)")
+    parser.add_argument('--dry-run', action='store_true', help="Chỉ liệt kê, không rename / ghi DB")
+    parser.add_argument('--prune-empty-dirs', action='store_true', help="Xóa thư mục rỗng của cây cũ sau khi xong")
+    args = parser.parse_args()
+
+    uploads_root = Path(args.uploads).resolve()
+    if not uploads_root.is_dir():
+        print(f"Upload folder not found: {uploads_root}")
+        return 1
+    db = FileDatabase(args.db)
+    store = BlobStore(uploads_root, BACKEND_DIR / 'temp_uploads')
+
+    start = time.perf_counter()
+    migrated = missing = failed = 0
+    after_id = 0
+    while args.limit is None or migrated + missing + failed < args.limit:
+        rows = db.get_legacy_path_files(after_id, args.batch_size)
+        if not rows:
+            break
+        batch_migrated, batch_missing, batch_failed = migrate_batch(db, store, uploads_root, rows, args.dry_run)
+        migrated += batch_migrated
+        missing += batch_missing
+        failed += batch_failed
+        after_id = rows[-1]['id']
+        print(f"  ... up to file {after_id}: {migrated} migrated, {missing} missing, {failed} failed "
+              f"({time.perf_counter() - start:.1f}s)")
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {migrated} files to {BLOB_DIRNAME}/ ({missing} missing on disk, {failed} failed) "
+          f"in {time.perf_counter() - start:.1f}s")
+    if args.prune_empty_dirs and not args.dry_run:
+        print(f"Removed {prune_empty_dirs(uploads_root)} empty directories")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UploadPathIndex:
+    """Chỉ mục các file thật sự có trên đĩa: (thư mục cấp 1, tên file) -> [(đường dẫn tương đối, size)]
+
+    Dùng để tìm lại file khi file_path trong DB không còn đúng (file bị di chuyển ngoài ứng dụng,
+    dữ liệu cũ lưu sai thư mục) thay vì đoán và gọi exists() trên từng đường dẫn có thể.
+    Thư mục cấp 1 là username; file nằm thẳng trong thư mục gốc có thư mục cấp 1 là ''.
+    """
+
+    def __init__(self, root, skip_dirs=()):
+        self.root = str(root)
+        self.skip_dirs = set(skip_dirs)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.built_at = None
+        self.build_ms = None
+
+    def rebuild(self):
+        """Quét lại toàn bộ thư mục upload (chạy trong job nền). Trả về số file đã lập chỉ mục"""
+        start = time.perf_counter()
+        entries = {}
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            relative_dir = os.path.relpath(dirpath, self.root)
+            if relative_dir == '.':
+                relative_dir = ''
+                dirnames[:] = [name for name in dirnames if name not in self.skip_dirs]
+            top = relative_dir.replace('\\', '/').split('/', 1)[0]
+            for filename in filenames:
+                relative_path = f"{relative_dir}/{filename}" if relative_dir else filename
+                try:
+                    size = os.stat(os.path.join(dirpath, filename)).st_size
+                except OSError:
+                    continue
+                entries.setdefault((top, filename), []).append((relative_path.replace('\\', '/'), size))
+                count += 1
+        with self._lock:
+            self._entries = entries
+            self.built_at = time.monotonic()
+            self.build_ms = round((time.perf_counter() - start) * 1000, 2)
+        logger.info(f"Upload path index rebuilt: {count} files in {self.build_ms}ms")
+        return {'files': count, 'build_ms': self.build_ms}
+
+    def lookup(self, username, filename, size=None):
+        """Đường dẫn tương đối duy nhất khớp (username, tên file[, size]); None nếu không có hoặc không rõ ràng"""
+        with self._lock:
+            candidates = self._entries.get((username, filename), []) + self._entries.get(('', filename), [])
+        if size is not None:
+            candidates = [candidate for candidate in candidates if candidate[1] == size]
+        if len(candidates) != 1:
+            return None
+        return candidates[0][0]
+
+    def record_move(self, old_path, new_path, size):
+        """Cập nhật chỉ mục sau khi ứng dụng tự rename file (không cần chờ lần quét sau)"""
+        with self._lock:
+            for relative_path, add in ((old_path, False), (new_path, True)):
+                if not relative_path:
+                    continue
+                parts = relative_path.split('/')
+                key = (parts[0] if len(parts) > 1 else '', parts[-1])
+                paths = [entry for entry in self._entries.get(key, []) if entry[0] != relative_path]
+                if add:
+                    paths.append((relative_path, size))
+                if paths:
+                    self._entries[key] = paths
+                else:
+                    self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._entries),
+                'age_seconds': round(time.monotonic() - self.built_at, 1) if self.built_at else None,
+                'build_ms': self.build_ms
+            }
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Kiểm tra query plan: chạy mọi method của FileDatabase / AuthDatabase trên database tạm,
+ghi lại từng câu SQL thực thi rồi EXPLAIN QUERY PLAN. Thoát với mã 1 nếu có câu lệnh
+quét toàn bảng (SCAN <bảng> không dùng index) hoặc phải sort bằng TEMP B-TREE.
+
+Chạy: python query_plan_check.py [-v]
+"""
+
+import argparse
+import functools
+import os
+import re
+import sys
+import tempfile
+import threading
+import uuid
+
+import db_pool
+from auth_database import AuthDatabase
+
+# database.py tạo instance `db` toàn cục trên files.db của thư mục hiện tại ngay khi import:
+# import từ thư mục tạm để không migrate / ghi vào backend/files.db
+_import_dir = tempfile.TemporaryDirectory(prefix="query_plans_import_")
+_cwd = os.getcwd()
+os.chdir(_import_dir.name)
+try:
+    from database import FileDatabase, vietnam_now_isoformat
+finally:
+    os.chdir(_cwd)
+
+# Method cố ý duyệt toàn bộ bảng (migration, job sửa chữa, thống kê toàn hệ thống, danh sách đầy đủ)
+FULL_SCAN_ALLOWED = {
+    'FileDatabase.init_database',
+    'FileDatabase.migrate_legacy_folders',
+    'FileDatabase.rebuild_user_stats',
+    'FileDatabase.get_global_stats',
+    'FileDatabase.get_file_stats',
+    'FileDatabase.get_storage_report',
+    'AuthDatabase.init_database',
+    'AuthDatabase.get_all_users',
+    'AuthDatabase.get_user_counts',
+    # Bảng users nhỏ; tìm username LIKE '%q%' và sort theo cột tính toán không dùng được index
+    'FileDatabase.get_admin_users_page',
+}
+
+# Method mà việc sort kết quả là bản chất (xếp hạng theo độ liên quan)
+TEMP_SORT_ALLOWED = {
+    'FileDatabase.search_files',
+}
+
+# Method không chạy SQL
+NO_SQL_METHODS = {
+    'AuthDatabase.hash_password',
+    'AuthDatabase.verify_password',
+    'AuthDatabase.get_token_cache_stats',
+}
+
+# Chỉ kiểm tra câu lệnh đọc/ghi dữ liệu (bỏ qua DDL, PRAGMA, BEGIN/COMMIT, dòng trace của trigger)
+CHECKED_STATEMENT = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE|INSERT\s+INTO\s+\w+\s*(\([^)]*\))?\s*SELECT)', re.I)
+CTE_NAME = re.compile(r'(?:\bWITH(?:\s+RECURSIVE)?|,)\s+(\w+)\s*(?:\([^)]*\))?\s+AS\s*\(', re.I)
+TABLE_ALIAS = r'\b(?:FROM|JOIN)\s+{}\s+(?:AS\s+)?(\w+)'
+SCAN_DETAIL = re.compile(r'^SCAN (\S+)')
+
+_current = threading.local()
+
+
+class QueryRecorder:
+    """Gắn trace callback vào mọi connection của pool và ghi SQL theo method đang chạy"""
+
+    def __init__(self):
+        self.statements = []  # (method, sql)
+        self.called = set()
+
+    def install(self):
+        recorder = self
+        original_open = db_pool.ConnectionPool._open
+
+        def traced_open(pool):
+            conn = original_open(pool)
+            conn.set_trace_callback(recorder._trace)
+            return conn
+
+        db_pool.ConnectionPool._open = traced_open
+        for cls in (FileDatabase, AuthDatabase):
+            for name, method in list(vars(cls).items()):
+                if callable(method) and not name.startswith('_'):
+                    setattr(cls, name, self._wrap(cls.__name__, name, method))
+
+    def _wrap(self, class_name, name, method):
+        qualified = f"{class_name}.{name}"
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            self.called.add(qualified)
+            stack = getattr(_current, 'stack', None)
+            if stack is None:
+                stack = _current.stack = []
+            stack.append(qualified)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def _trace(self, sql):
+        stack = getattr(_current, 'stack', None)
+        if stack:
+            # Gán câu lệnh cho method ngoài cùng (method public được gọi trực tiếp)
+            self.statements.append((stack[0], sql))
+
+
+def run_workload(tmp_dir):
+    """Gọi mọi method public với dữ liệu mẫu"""
+    auth_db = AuthDatabase(os.path.join(tmp_dir, "auth.db"))
+    db = FileDatabase(os.path.join(tmp_dir, "files.db"))
+
+    alice = auth_db.create_user("alice", "secret1")
+    bob = auth_db.create_user("bob", "secret2")
+    auth_db.authenticate_user("alice", "secret1")
+    auth_db.authenticate_user("alice", "wrong")
+    token = auth_db.create_session(alice)
+    auth_db.get_user_by_token(token)
+    auth_db.get_user_by_token(token)
+    auth_db.get_token_cache_stats()
+    auth_db.get_all_users()
+    auth_db.get_user_counts()
+
+    folder_id = str(uuid.uuid4())
+    child_id = str(uuid.uuid4())
+    db.create_folder(folder_id, "docs", "alice/docs", alice, "alice")
+    db.create_folder(child_id, "2024", "alice/docs/2024", alice, "alice", parent_id=folder_id)
+
+    file_ids = []
+    for i in range(30):
+        name = f"report_{i}.pdf" if i % 2 else f"photo_{i}.jpg"
+        file_id = db.add_file(f"{i}_{name}", name, 1000 + i, "alice", alice,
+                              folder_id=folder_id if i % 3 == 0 else None)
+        db.update_file_status(file_id, "completed", f"alice/{name}")
+        file_ids.append(file_id)
+    bob_file = db.add_file("bob.txt", "bob.txt", 10, "bob", bob)
+
+    db.get_file_by_id(file_ids[0])
+    db.get_file_by_filename("1_report_1.pdf")
+    db.get_username_by_id(alice)
+    db.get_all_files(user_id=alice, limit=10)
+    page = db.get_files_page(user_id=alice, limit=5)
+    db.get_files_page(user_id=alice, limit=5, cursor=page['next_cursor'])
+    for sort in ('created_at', 'name', 'size'):
+        db.get_files_page(user_id=alice, sort=sort, order='asc', limit=5)
+    db.get_files_page(user_id=alice, status='completed', limit=5)
+    db.get_files_page(user_id=alice, folder_id=folder_id, limit=5)
+    db.get_files_page(user_id=alice, folder_id='root', limit=5)
+    db.get_files_page(user_id=alice, extension='pdf', limit=5)
+    db.count_files(user_id=alice)
+    db.get_user_files(alice)
+    db.get_files_by_folder(folder_id, alice)
+    db.get_files_by_folder(folder_id)
+    db.get_files_by_ids(file_ids[:5], alice)
+    db.get_files_in_folders([folder_id, child_id], alice)
+    db.search_files(alice, "report")
+    db.search_files(alice, "rep", mode='prefix')
+    db.search_files(alice, "re")
+    db.search_files(alice, extension="pdf")
+    db.get_folder(folder_id, alice)
+    db.get_user_folders(alice)
+    db.get_user_folders(alice, parent_id='root')
+    db.get_user_folders(alice, parent_id=folder_id)
+    db.get_folder_subtree(folder_id, alice)
+    db.count_user_folders(alice)
+    db.get_admin_files_page(limit=5)
+    db.get_admin_files_page(user_id=alice, search="report", limit=5)
+    db.get_admin_files_page(created_from="2000-01-01", created_to=vietnam_now_isoformat(), limit=5)
+    db.get_admin_users_page(sort='total_files', order='desc')
+    db.get_admin_users_page(search="ali", role='user')
+    db.count_uploads_between("2000-01-01", vietnam_now_isoformat())
+    db.get_daily_upload_counts(days=2)
+    db.get_user_stats(alice)
+    db.get_user_used_bytes(alice)
+    db.get_global_stats()
+    db.get_file_stats()
+    db.update_file_path(file_ids[1], "alice/moved.pdf")
+    db.update_file_folder(file_ids[1], child_id)
+    db.update_file_name(file_ids[1], "renamed.pdf", "alice/renamed.pdf")
+    db.find_files_by_names([alice], ["renamed.pdf", "photo_0.jpg"])
+    db.update_file_locations([(file_ids[4], "alice/docs/photo_4.jpg")], folder_id)
+    db.rename_files([(file_ids[5], "report_five.pdf", "alice/report_five.pdf")])
+    legacy = db.get_legacy_path_files(limit=2)
+    db.update_file_paths([(row['id'], f"blobs/00/00/{row['id']}") for row in legacy])
+    db.rebuild_user_stats(alice)
+    db.rebuild_user_stats()
+
+    digest = "ab" * 32
+    db.attach_blob(file_ids[2], digest, 10, f"blobs/ab/ab/{digest}", lambda: None)
+    db.attach_blob(file_ids[3], digest, 10, f"blobs/ab/ab/{digest}", lambda: None)
+    db.get_uncoded_blobs()
+    db.get_blob(digest)
+    db.set_blob_codec(digest, 'zstd', 4)
+    db.record_file_accesses([(file_ids[2], 3, "2024-01-02T00:00:00+07:00"), (file_ids[3], 1, "2024-01-03T00:00:00+07:00")])
+    db.get_tiering_candidates("2030-01-01T00:00:00+07:00")
+    db.is_path_recently_accessed(f"blobs/ab/ab/{digest}", "2024-01-01T00:00:00+07:00")
+    db.set_storage_tier(f"blobs/ab/ab/{digest}", 'cold')
+    db.move_to_recycle_bin(file_ids[2], alice)
+    db.move_to_recycle_bin(file_ids[3], alice)
+    recycled = db.get_recycle_bin_files(alice)
+    db.get_recycle_bin_files()
+    db.get_recycle_entry(recycled[0]['id'], alice)
+    db.restore_from_recycle_bin(recycled[0]['id'], alice)
+    db.permanently_delete_from_recycle(recycled[1]['id'], alice)
+    db.move_files_to_recycle_bin([(file_ids[6], None), (file_ids[7], ".trash/x_report_7.pdf")], alice)
+    bulk = [entry['id'] for entry in db.get_recycle_bin_files(alice)]
+    db.get_recycle_entries(bulk, alice)
+    db.restore_many_from_recycle_bin([(bulk[0], "alice/photo_6.jpg")], alice)
+    db.permanently_delete_many_from_recycle(bulk[1:], alice)
+    db.cleanup_expired_recycle_files()
+    purgeable = db.get_purgeable_recycle_files()
+    db.release_recycled_blobs([entry['id'] for entry in purgeable if entry['content_hash']], lambda path: 0)
+    db.mark_recycle_files_purged([entry['id'] for entry in purgeable])
+    db.get_storage_report()
+    db.cleanup_temp_files()
+    db.cleanup_stuck_uploads()
+    db.delete_file(bob_file)
+    db.delete_folder_tree(folder_id, alice)
+    db.migrate_legacy_folders(os.path.join(tmp_dir, "files_db.json"))
+
+    auth_db.update_last_login(alice)
+    auth_db.invalidate_session(token)
+    auth_db.cleanup_expired_sessions()
+    auth_db.set_user_quota(bob, 1024)
+    auth_db.reset_password(bob, "newsecret")
+    auth_db.delete_user(bob)
+    return db
+
+
+def cte_names(sql):
+    """Tên các CTE trong câu lệnh và alias của chúng (SCAN trên CTE không phải quét bảng thật)"""
+    names = {name.lower() for name in CTE_NAME.findall(sql)}
+    for name in list(names):
+        names.update(alias.lower() for alias in re.findall(TABLE_ALIAS.format(name), sql, re.I))
+    return names
+
+
+def plan_problems(conn, sql, allow_temp_sort=False):
+    """Trả về (plan, danh sách vấn đề) của một câu lệnh"""
+    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()]
+    ctes = cte_names(sql)
+    problems = []
+    for detail in plan:
+        if 'USE TEMP B-TREE' in detail:
+            if not allow_temp_sort:
+                problems.append(detail)
+            continue
+        match = SCAN_DETAIL.match(detail)
+        if not match or ' USING ' in detail or 'VIRTUAL TABLE' in detail:
+            continue
+        name = match.group(1)
+        if name.startswith('(') or name.lower() in ctes or name == 'CONSTANT':
+            continue
+        problems.append(detail)
+    return plan, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN regression check")
+    parser.add_argument('-v', '--verbose', action='store_true', help="In plan của mọi câu lệnh")
+    args = parser.parse_args()
+
+    recorder = QueryRecorder()
+    recorder.install()
+
+    with tempfile.TemporaryDirectory(prefix="query_plans_") as tmp_dir:
+        db = run_workload(tmp_dir)
+
+        expected = {
+            f"{cls.__name__}.{name}"
+            for cls in (FileDatabase, AuthDatabase)
+            for name, method in vars(cls).items()
+            if callable(method) and not name.startswith('_')
+        }
+        failures = []
+        not_called = sorted(expected - recorder.called)
+        for method in not_called:
+            failures.append(f"{method}: not exercised by the workload")
+
+        with_sql = {method for method, _ in recorder.statements}
+        for method in sorted(recorder.called - with_sql - NO_SQL_METHODS):
+            failures.append(f"{method}: no SQL recorded")
+
+        checked = 0
+        seen = set()
+        with db.joined_pool.connection() as conn:
+            for method, sql in recorder.statements:
+                if not CHECKED_STATEMENT.match(sql) or (method, sql) in seen:
+                    continue
+                seen.add((method, sql))
+                checked += 1
+                plan, problems = plan_problems(conn, sql, allow_temp_sort=method in TEMP_SORT_ALLOWED)
+                if args.verbose:
+                    print(f"[{method}] {' '.join(sql.split())[:160]}")
+                    for detail in plan:
+                        print(f"    {detail}")
+                if problems and method not in FULL_SCAN_ALLOWED:
+                    failures.append(f"{method}: {'; '.join(problems)}\n    {' '.join(sql.split())[:200]}")
+
+    print(f"Checked {checked} statements from {len(recorder.called)} methods")
+    if failures:
+        print(f"\n{len(failures)} problem(s):")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+    print("OK: no full table scans or temp B-tree sorts")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 * 1024 * 1024
+
+# Hạn mức dung lượng theo role (byte, 0 = không giới hạn); từng user có thể được đặt riêng (users.storage_quota)
+ROLE_QUOTAS = {
+    'user': int(os.environ.get('STORAGE_QUOTA_USER', 10 * GB)),
+    'admin': int(os.environ.get('STORAGE_QUOTA_ADMIN', 0)),
+}
+# Luôn chừa lại ít nhất chừng này dung lượng trống trên đĩa (kể cả khi user còn hạn mức)
+STORAGE_MIN_FREE_BYTES = int(os.environ.get('STORAGE_MIN_FREE_BYTES', GB))
+
+
+class StorageQuota:
+    """Kiểm tra hạn mức khi bắt đầu upload và giữ chỗ trước toàn bộ dung lượng file
+
+    Dung lượng đã dùng lấy từ bộ đếm user_stats (một lần đọc theo khóa chính), dung lượng đang
+    upload (chưa vào files.db) được giữ chỗ trong bộ nhớ theo key của upload cho tới khi release.
+    """
+
+    def __init__(self, db, disk_path, role_quotas=None, min_free_bytes=STORAGE_MIN_FREE_BYTES):
+        self.db = db
+        self.disk_path = str(disk_path)
+        self.role_quotas = dict(ROLE_QUOTAS if role_quotas is None else role_quotas)
+        self.min_free_bytes = min_free_bytes
+        self._reservations = {}  # key -> (user_id, số byte)
+        self._reserved_by_user = {}
+        self._reserved_total = 0
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = {'quota': 0, 'disk': 0}
+
+    def limit_for(self, user):
+        """Hạn mức của user (byte); 0 = không giới hạn"""
+        if user.get('storage_quota') is not None:
+            return user['storage_quota']
+        return self.role_quotas.get(user.get('role') or 'user', self.role_quotas.get('user', 0))
+
+    def reserve(self, user, key, size):
+        """Giữ chỗ `size` byte cho upload `key` (gọi lại với cùng key khi resume thì thay chỗ cũ).
+        Trả về dict kết quả: allowed, reason (khi bị từ chối), quota, used, reserved, available
+        """
+        limit = self.limit_for(user)
+        used = self.db.get_user_used_bytes(user['id'])
+        free = shutil.disk_usage(self.disk_path).free
+        with self._lock:
+            self._release_locked(key)
+            reserved = self._reserved_by_user.get(user['id'], 0)
+            available = max(0, limit - used - reserved) if limit else None
+            result = {'quota': limit or None, 'used': used, 'reserved': reserved, 'available': available}
+            if limit and size > available:
+                self.rejected['quota'] += 1
+                return {'allowed': False, 'reason': 'quota', **result}
+            if free - self._reserved_total - size < self.min_free_bytes:
+                self.rejected['disk'] += 1
+                return {'allowed': False, 'reason': 'disk', **result}
+            self._reservations[key] = (user['id'], size)
+            self._reserved_by_user[user['id']] = reserved + size
+            self._reserved_total += size
+            self.admitted += 1
+        result['reserved'] += size
+        if available is not None:
+            result['available'] -= size
+        return {'allowed': True, **result}
+
+    def release(self, key):
+        """Trả lại chỗ đã giữ (upload xong, dừng hoặc lỗi). Trả về số byte được trả"""
+        with self._lock:
+            return self._release_locked(key)
+
+    def _release_locked(self, key):
+        entry = self._reservations.pop(key, None)
+        if not entry:
+            return 0
+        user_id, size = entry
+        remaining = self._reserved_by_user[user_id] - size
+        if remaining > 0:
+            self._reserved_by_user[user_id] = remaining
+        else:
+            del self._reserved_by_user[user_id]
+        self._reserved_total -= size
+        return size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'rejected_quota': self.rejected['quota'],
+                'rejected_disk': self.rejected['disk'],
+                'active_reservations': len(self._reservations),
+                'reserved_bytes': self._reserved_total,
+                'role_quotas': self.role_quotas,
+                'min_free_bytes': self.min_free_bytes
+            }
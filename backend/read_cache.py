@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Cache nội dung file nhỏ được đọc nhiều (ảnh / PDF dùng chung) để không phải mở file trên đĩa mỗi lần preview
+READ_CACHE_MAX_BYTES = int(os.environ.get('READ_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+READ_CACHE_MAX_FILE_SIZE = int(os.environ.get('READ_CACHE_MAX_FILE_SIZE', 1024 * 1024))
+
+
+class MemoryReader:
+    """File object chỉ đọc trên nội dung đã cache, dùng làm body của response.
+
+    WSGI server chỉ nhận bytes nên read() trả luôn phần còn lại thành một chunk: cả file là chính object
+    bytes trong cache (không copy), sau seek (Range) thì chỉ copy đoạn từ vị trí hiện tại qua memoryview.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def read(self, size=-1):
+        if self._position >= len(self._view):
+            return b''
+        if self._position == 0 and isinstance(self._view.obj, bytes):
+            chunk = self._view.obj
+        else:
+            chunk = bytes(self._view[self._position:])
+        self._position = len(self._view)
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        pass
+
+
+class ReadCache:
+    """LRU giới hạn theo tổng số byte, key = (file_id, phiên bản); phiên bản là updated_at của file nên
+    đổi tên / di chuyển làm key cũ không còn được dùng tới, invalidate() giải phóng bộ nhớ ngay"""
+
+    def __init__(self, max_bytes=READ_CACHE_MAX_BYTES, max_file_size=READ_CACHE_MAX_FILE_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self._entries = OrderedDict()  # (file_id, version) -> (bytes, mtime)
+        self._versions = {}  # file_id -> version đang có trong cache
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def cacheable(self, size):
+        return self.max_bytes > 0 and size <= self.max_file_size
+
+    def get(self, file_id, version):
+        """Trả về (memoryview nội dung, mtime) hoặc None"""
+        key = (file_id, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        data, mtime = entry
+        return memoryview(data), mtime
+
+    def put(self, file_id, version, data, mtime):
+        if not self.cacheable(len(data)):
+            return False
+        with self._lock:
+            self._discard_locked(file_id)
+            self._entries[(file_id, version)] = (data, mtime)
+            self._versions[file_id] = version
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                (old_id, _), (old_data, _) = self._entries.popitem(last=False)
+                self._versions.pop(old_id, None)
+                self._bytes -= len(old_data)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, *file_ids):
+        """Bỏ nội dung đã cache của các file (đổi tên, di chuyển, xóa, ghi đè)"""
+        with self._lock:
+            for file_id in file_ids:
+                if self._discard_locked(file_id):
+                    self.invalidations += 1
+
+    def _discard_locked(self, file_id):
+        version = self._versions.pop(file_id, None)
+        if version is None:
+            return False
+        data, _ = self._entries.pop((file_id, version))
+        self._bytes -= len(data)
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_file_size': self.max_file_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
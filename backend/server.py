@@ -9,11 +9,16 @@ from typing import Dict, Optional
 from urllib.parse import urlparse, parse_qs
 import aiohttp
 import aiofiles
+from aiohttp import web
 
 import websockets
 from websockets.server import WebSocketServerProtocol
 from logger import setup_logger
 from database import db
+from quota import StorageQuota
+from metrics import (REGISTRY, CONTENT_TYPE, SIZE_BUCKETS, DURATION_BUCKETS, THROUGHPUT_BUCKETS,
+                     THROUGHPUT_MIN_BYTES, token_cache_collector, authorized as metrics_authorized)
+from tracing import Tracer, Span, TRACE_HEADER, TRACE_CHUNK_BATCH
 
 # Import auth database để verify tokens
 try:
@@ -31,13 +36,39 @@ REMOTE_UPLOAD_URL = os.environ.get("REMOTE_UPLOAD_URL", "http://localhost:5000/a
 REMOTE_SERVER_TOKEN = os.environ.get("REMOTE_SERVER_TOKEN", "your-secret-token")
 
 # Thư mục tạm để lưu file trước khi gửi đi
-TEMP_DIR = Path(__file__).parent / "temp_uploads"
+TEMP_DIR = Path(os.environ.get("TEMP_UPLOAD_FOLDER", Path(__file__).parent / "temp_uploads"))
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
+# Hạn mức dung lượng: kiểm tra và giữ chỗ fileSize ngay trong handle_start (xem quota.py)
+storage_quota = StorageQuota(db, TEMP_DIR)
+
 # Thư mục lưu files đã download
-DOWNLOADS_DIR = Path(__file__).parent / "remote_uploads"
+DOWNLOADS_DIR = Path(os.environ.get("UPLOAD_FOLDER", Path(__file__).parent / "remote_uploads"))
 DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
 
+# Trace từng lượt upload (xem tracing.py), ghi vào logs/traces-gateway.jsonl
+tracer = Tracer("gateway")
+
+# /metrics của gateway chạy trên port riêng (HTTP), METRICS_PORT=0 để tắt
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8766"))
+# Mặc định chỉ nghe trên localhost (Prometheus chạy cùng máy); mở ra ngoài thì nên đặt METRICS_TOKEN
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+CHUNK_BYTES = REGISTRY.counter("upload_chunk_bytes_total", "Số byte chunk upload đã ghi vào file tạm")
+CHUNK_SIZE_BYTES = REGISTRY.histogram("upload_chunk_size_bytes", "Kích thước chunk upload (sau khi decode base64)",
+                                      buckets=SIZE_BUCKETS)
+CHUNK_SECONDS = REGISTRY.histogram("upload_chunk_seconds", "Thời gian xử lý một chunk: decode, ghi đĩa, gửi chunk-ack")
+UPLOAD_SESSIONS = REGISTRY.gauge("upload_sessions", "Số upload session theo trạng thái", ["status"])
+WS_CONNECTIONS = REGISTRY.gauge("websocket_connections", "Số kết nối WebSocket đang mở")
+RELAY_IN_FLIGHT = REGISTRY.gauge("relay_in_flight", "Số file đang được chuyển lên file manager (/api/upload)")
+RELAY_SECONDS = REGISTRY.histogram("relay_seconds", "Thời gian chuyển một file lên file manager", ["result"],
+                                   buckets=DURATION_BUCKETS)
+RELAY_BYTES = REGISTRY.counter("relay_bytes_total", "Số byte đã chuyển thành công lên file manager")
+DOWNLOAD_BYTES = REGISTRY.counter("download_bytes_total", "Số byte DownloadManager đã tải về")
+DOWNLOAD_THROUGHPUT = REGISTRY.histogram("download_throughput_bytes_per_second",
+                                         "Tốc độ trung bình của mỗi lượt download (từ lúc bắt đầu / resume)",
+                                         buckets=THROUGHPUT_BUCKETS)
+
 @dataclass
 class UploadSession:
     file_id: str
@@ -51,6 +82,8 @@ class UploadSession:
     db_id: Optional[int] = None  # ID từ SQLite database
     user_id: Optional[int] = None  # ID của user upload
     user_token: Optional[str] = None  # Auth token của user
+    trace: Optional[Span] = None  # Span gốc của lượt upload
+    chunk_batch: Optional[dict] = None  # Lô chunk đang gom để ghi một span chunk_batch
 
     def temp_path(self) -> Path:
     # session.temp_file_path: .../temp_uploads/<file-id>_<name>
@@ -195,6 +228,7 @@ class DownloadManager:
                         
                         chunk_size = 64 * 1024  # 64KB chunks
                         last_progress_time = time.time()
+                        started, start_bytes = time.perf_counter(), session.downloaded_bytes
                         
                         async for chunk in response.content.iter_chunked(chunk_size):
                             if session.status != "active":
@@ -202,6 +236,7 @@ class DownloadManager:
                                 
                             await f.write(chunk)
                             session.downloaded_bytes += len(chunk)
+                            DOWNLOAD_BYTES.inc(len(chunk))
                             
                             # Send progress every 250ms
                             now = time.time()
@@ -223,6 +258,9 @@ class DownloadManager:
                     # Download completed
                     if session.downloaded_bytes >= session.total_size or session.total_size == 0:
                         session.status = "completed"
+                        transferred = session.downloaded_bytes - start_bytes
+                        if transferred >= THROUGHPUT_MIN_BYTES:
+                            DOWNLOAD_THROUGHPUT.observe(transferred / max(time.perf_counter() - started, 1e-6))
                         
                         # Move to final location (uploads directory)
                         final_path = DOWNLOADS_DIR / session.filename
@@ -312,6 +350,9 @@ class UploadManager:
         for session in sessions.values():
             if session.status == "active":
                 session.status = "paused"
+                self.flush_chunk_batch(session)
+                # Trả chỗ đã giữ; khi client kết nối lại, start sẽ kiểm tra hạn mức và giữ chỗ lại
+                storage_quota.release(session.file_id)
                 logger.info("Session paused due to disconnect: %s (%s)", 
                            session.file_id, session.file_name)
         logger.debug("Connection unregistered: %s", ws.remote_address)
@@ -384,6 +425,32 @@ class UploadManager:
             logger.debug("Removing session: %s (%s)", file_id, session.file_name)
             del self.file_id_to_session[file_id]
 
+    def trace_chunk(self, session: UploadSession, started: float, write_seconds: float, size: int) -> None:
+        """Gom chunk vào lô hiện tại, đủ TRACE_CHUNK_BATCH chunk thì ghi span"""
+        batch = session.chunk_batch
+        if batch is None:
+            batch = session.chunk_batch = {"start": started, "chunks": 0, "bytes": 0, "write_seconds": 0.0,
+                                           "offset": session.bytes_received - size}
+        batch["chunks"] += 1
+        batch["bytes"] += size
+        batch["write_seconds"] += write_seconds
+        if batch["chunks"] >= TRACE_CHUNK_BATCH:
+            self.flush_chunk_batch(session)
+
+    def flush_chunk_batch(self, session: UploadSession) -> None:
+        batch, session.chunk_batch = session.chunk_batch, None
+        if batch and session.trace:
+            session.trace.child("chunk_batch", start=batch["start"]).end(
+                chunks=batch["chunks"], bytes=batch["bytes"], offset=batch["offset"],
+                write_ms=round(batch["write_seconds"] * 1000, 3))
+
+    def end_trace(self, session: UploadSession, status: str) -> None:
+        """Kết thúc trace của session (completed / stopped / error)"""
+        self.flush_chunk_batch(session)
+        if session.trace:
+            session.trace.end(status=status, bytes_received=session.bytes_received)
+            session.trace = None
+
     async def broadcast_to_session(self, session: UploadSession, message: dict) -> None:
         """Gửi message đến tất cả client đang kết nối với session này"""
         for ws, sessions in self.connection_to_sessions.items():
@@ -393,8 +460,8 @@ class UploadManager:
                 except Exception as e:
                     logger.warning("Failed to send message to client: %s", e)
 
-    async def upload_to_remote_server(self, session: UploadSession) -> bool:
-        """Upload completed file to remote server"""
+    async def upload_to_remote_server(self, session: UploadSession, span: Optional[Span] = None) -> bool:
+        """Upload completed file to remote server (span: span relay, gửi sang file manager qua header traceparent)"""
         try:
             logger.info("Starting upload to remote server: %s (%s)", session.file_id, session.file_name)
             
@@ -442,6 +509,8 @@ class UploadManager:
                 'X-File-Size': str(session.file_size),
                 'X-File-ID': session.file_id
             }
+            if span:
+                headers[TRACE_HEADER] = span.header()
             
             # Sử dụng user token thay vì REMOTE_SERVER_TOKEN
             if session.user_token:
@@ -467,7 +536,10 @@ class UploadManager:
                             if session.db_id:
                                 # Lưu thông tin file path trong remote_uploads
                                 remote_file_path = f"{session.file_name}"  # Hoặc path từ result nếu có
+                                db_span = span.child("db_mark_completed") if span else None
                                 db.update_file_status(session.db_id, "completed", remote_file_path)
+                                if db_span:
+                                    db_span.end()
                             
                             logger.info("File uploaded to remote server successfully: %s, remote_id=%s", 
                                     session.file_id, session.remote_file_id)
@@ -522,6 +594,7 @@ class UploadManager:
             return False
 
     async def handle_start(self, ws: WebSocketServerProtocol, payload: dict) -> None:
+        started = time.time()
         file_id = payload.get("fileId")
         file_name = payload.get("fileName")
         file_size = int(payload.get("fileSize", 0))
@@ -531,8 +604,32 @@ class UploadManager:
             await self.send_error(ws, file_id, "Invalid start payload")
             return
 
-        session = self.get_or_create_session(ws, file_id, file_name, file_size)
+        # Kiểm tra hạn mức trước khi tạo session / ghi byte nào, để client dừng ngay nếu không đủ chỗ
+        user = self.get_connection_auth(ws)['user']
+        admission = storage_quota.reserve(user, file_id, file_size)
+        if not admission['allowed']:
+            error = "Storage quota exceeded" if admission['reason'] == 'quota' else "Server storage is full"
+            logger.warning("Upload rejected (%s): %s (%s), size=%d bytes, user=%s",
+                           admission['reason'], file_id, file_name, file_size, user['username'])
+            await self.send(ws, {
+                "event": "start-ack",
+                "fileId": file_id,
+                "status": "rejected",
+                "error": error,
+                "quota": admission,
+            })
+            return
+
+        try:
+            session = self.get_or_create_session(ws, file_id, file_name, file_size)
+        except Exception:
+            storage_quota.release(file_id)
+            raise
         session.status = "active"
+        if session.trace is None:
+            session.trace = tracer.start_span("upload", start=started, file_id=file_id, file_name=session.file_name,
+                                              file_size=file_size, user_id=session.user_id)
+        start_span = session.trace.child("start", start=started, offset=session.bytes_received)
 
         self.register_connection(ws)
         self.connection_to_sessions[ws][file_id] = session
@@ -545,9 +642,13 @@ class UploadManager:
             "fileId": session.file_id,
             "offset": session.bytes_received,
             "status": session.status,
+            "quota": admission,
         })
+        start_span.end()
 
     async def handle_chunk(self, ws: WebSocketServerProtocol, payload: dict) -> None:
+        started = time.perf_counter()
+        started_at = time.time()
         file_id = payload.get("fileId")
         data_b64 = payload.get("data")
         offset = int(payload.get("offset", -1))
@@ -591,14 +692,23 @@ class UploadManager:
             await self.send_error(ws, file_id, "Invalid base64 data")
             return
 
+        # Chỗ đã giữ chỉ bằng fileSize khai báo trong start
+        if session.bytes_received + len(data) > session.file_size:
+            logger.warning("Chunk exceeds declared size for %s: %d + %d > %d",
+                           file_id, session.bytes_received, len(data), session.file_size)
+            await self.send_error(ws, file_id, "Chunk exceeds declared file size")
+            return
+
         # Write chunk to temp .part file
         async with session.file_lock:
             temp_path = session.temp_path()
             temp_path.parent.mkdir(parents=True, exist_ok=True)
             
+            write_started = time.perf_counter()
             async with aiofiles.open(temp_path, 'ab') as f:
                 await f.write(data)
                 await f.flush()
+            write_seconds = time.perf_counter() - write_started
             
             session.bytes_received += len(data)
 
@@ -614,10 +724,16 @@ class UploadManager:
             "receivedBytes": len(data),
             "percent": round(percent, 2),
         })
+        CHUNK_BYTES.inc(len(data))
+        CHUNK_SIZE_BYTES.observe(len(data))
+        CHUNK_SECONDS.observe(time.perf_counter() - started)
+        self.trace_chunk(session, started_at, write_seconds, len(data))
         
         # Kiểm tra nếu upload hoàn tất
         if session.bytes_received >= session.file_size:
             logger.info("Local upload completed: %s, finalizing file", file_id)
+            self.flush_chunk_batch(session)
+            local_span = session.trace.child("local_complete") if session.trace else None
             
             # Đợi một chút để đảm bảo file được flush hoàn toàn
             await asyncio.sleep(0.1)
@@ -630,6 +746,8 @@ class UploadManager:
                 "fileId": file_id,
                 "message": "Local upload completed, finalizing..."
             })
+            if local_span:
+                local_span.end()
 
     async def handle_pause(self, ws: WebSocketServerProtocol, payload: dict) -> None:
         file_id = payload.get("fileId")
@@ -639,6 +757,7 @@ class UploadManager:
             await self.send_error(ws, file_id, "Session not found")
             return
         session.status = "paused"
+        self.flush_chunk_batch(session)
         
         # Cập nhật database status
         if session.db_id:
@@ -672,6 +791,8 @@ class UploadManager:
             await self.send_error(ws, file_id, "Session not found")
             return
         session.status = "stopped"
+        storage_quota.release(file_id)
+        self.end_trace(session, "stopped")
         logger.info("Upload stopped: %s (%s), delete=%s", file_id, session.file_name, delete)
         
         # Xóa file khỏi database nếu yêu cầu
@@ -722,22 +843,34 @@ class UploadManager:
                 logger.info("File completed locally: %s (%s) -> %s", 
                            file_id, session.file_name, final_temp_path.name)
                 
-                # Bắt đầu upload lên remote server
-                success = await self.upload_to_remote_server(session)
-                
+                # Bắt đầu upload lên remote server; xong (hoặc lỗi) thì trả chỗ đã giữ -
+                # file đã completed được tính vào user_stats
+                relay_started = time.perf_counter()
+                relay_span = session.trace.child("relay", bytes=session.file_size) if session.trace else None
+                RELAY_IN_FLIGHT.inc()
+                try:
+                    success = await self.upload_to_remote_server(session, relay_span)
+                finally:
+                    RELAY_IN_FLIGHT.dec()
+                    storage_quota.release(file_id)
+                if relay_span:
+                    relay_span.end(ok=success)
+                RELAY_SECONDS.labels("ok" if success else "error").observe(time.perf_counter() - relay_started)
                 if success:
-                    await self.send(ws, {
-                        "event": "complete-ack",
-                        "fileId": file_id,
-                        "remoteFileId": session.remote_file_id,
-                        "status": "uploaded_to_remote"
-                    })
-                else:
+                    RELAY_BYTES.inc(session.file_size)
+                
+                # upload_to_remote_server đã gửi complete-ack và client có thể đóng kết nối ngay sau đó:
+                # kết thúc trace trước, không gửi thêm gì sau khi thành công (lỗi gửi không được biến
+                # upload đã xong thành lỗi và giữ lại session)
+                self.end_trace(session, "completed" if success else session.status)
+                if not success:
                     await self.send_error(ws, file_id, "Failed to upload to remote server")
                     return
                     
             except Exception as exc:
                 session.status = "error"
+                storage_quota.release(file_id)
+                self.end_trace(session, "error")
                 logger.error("Failed to finalize upload %s: %s", file_id, exc)
                 await self.send_error(ws, file_id, f"Finalize failed: {exc}")
                 return
@@ -760,6 +893,37 @@ manager = UploadManager()
 download_manager = DownloadManager()
 
 
+def collect_session_metrics() -> None:
+    """Đếm session theo trạng thái lúc scrape (không phải cập nhật gauge ở mỗi lần đổi status)"""
+    counts = {status: 0 for status in ("active", "paused", "completing", "uploading", "completed", "stopped", "error")}
+    for session in list(manager.file_id_to_session.values()):
+        counts[session.status] = counts.get(session.status, 0) + 1
+    for status, count in counts.items():
+        UPLOAD_SESSIONS.labels(status).set(count)
+    WS_CONNECTIONS.set(len(manager.connection_to_sessions))
+
+
+REGISTRY.add_collector(collect_session_metrics)
+if auth_db:
+    REGISTRY.add_collector(token_cache_collector(auth_db))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if not metrics_authorized(request.headers.get("Authorization"), request.remote):
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """HTTP server nhỏ (aiohttp) chỉ phục vụ /metrics, chạy chung event loop với WebSocket server"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
 async def handler(ws: WebSocketServerProtocol, path: str) -> None:
     # Accept any path but recommend "/ws"
     # logger.debug("Client connected from %s path=%s", ws.remote_address, path)
@@ -909,9 +1073,17 @@ async def handler(ws: WebSocketServerProtocol, path: str) -> None:
 async def main() -> None:
     host = os.environ.get("WS_HOST", "localhost")
     port = int(os.environ.get("WS_PORT", "8765"))
-    async with websockets.serve(handler, host, port, origins=None, max_size=8 * 1024 * 1024):  # 8 MB frame
-        logger.info("WebSocket server listening on ws://%s:%d", host, port)
-        await asyncio.Future()  # run forever
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        logger.info("Metrics available at http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    try:
+        async with websockets.serve(handler, host, port, origins=None, max_size=8 * 1024 * 1024):  # 8 MB frame
+            logger.info("WebSocket server listening on ws://%s:%d", host, port)
+            await asyncio.Future()  # run forever
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
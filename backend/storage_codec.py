@@ -0,0 +1,270 @@
+import io
+import os
+import struct
+import bisect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# zstandard là tùy chọn: không cài thì blob luôn được lưu nguyên bản
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# STORAGE_CODEC=none để tắt nén khi lưu
+STORAGE_CODEC = os.environ.get('STORAGE_CODEC', 'zstd')
+CODEC_ENABLED = STORAGE_CODEC == 'zstd' and zstandard is not None
+CODEC_WORKERS = int(os.environ.get('STORAGE_CODEC_WORKERS', 2))
+CODEC_LEVEL = int(os.environ.get('STORAGE_CODEC_LEVEL', 3))
+# Chỉ nén khi mẫu thử nhỏ đi ít nhất chừng này lần (log / CSV thường > 3, ảnh / zip / video ~ 1)
+CODEC_MIN_RATIO = float(os.environ.get('STORAGE_CODEC_MIN_RATIO', 1.5))
+CODEC_MIN_SIZE = 64 * 1024
+CODEC_SAMPLE_SIZE = 64 * 1024
+CODEC_SAMPLES = 4
+# Mỗi frame nén độc lập chứa chừng này byte gốc; Range chỉ phải giải nén các frame chạm tới
+FRAME_SIZE = 1024 * 1024
+
+ZSTD_SUFFIX = ".zst"
+
+# Seek table theo định dạng "zstd seekable format": skippable frame ở cuối file, decoder thường bỏ qua
+# nên `zstd -d` vẫn giải nén được cả file
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')  # số frame, descriptor, magic
+SEEK_TABLE_ENTRY = struct.Struct('<II')    # kích thước nén, kích thước gốc
+
+
+def estimate_ratio(path, size):
+    """Ước lượng tỉ lệ nén bằng vài mẫu rải đều trong file"""
+    compressor = zstandard.ZstdCompressor(level=CODEC_LEVEL)
+    raw = compressed = 0
+    step = max(CODEC_SAMPLE_SIZE, size // CODEC_SAMPLES)
+    with open(path, 'rb') as f:
+        for offset in range(0, size, step)[:CODEC_SAMPLES]:
+            f.seek(offset)
+            sample = f.read(CODEC_SAMPLE_SIZE)
+            raw += len(sample)
+            compressed += len(compressor.compress(sample))
+    return raw / compressed if compressed else 0.0
+
+
+def write_seekable(source, target, level=CODEC_LEVEL, frame_size=FRAME_SIZE):
+    """Nén source thành các frame zstd độc lập + seek table. Trả về kích thước file nén"""
+    compressor = zstandard.ZstdCompressor(level=level)
+    entries = []
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            chunk = src.read(frame_size)
+            if not chunk:
+                break
+            frame = compressor.compress(chunk)
+            dst.write(frame)
+            entries.append((len(frame), len(chunk)))
+        table = b''.join(SEEK_TABLE_ENTRY.pack(*entry) for entry in entries)
+        table += SEEK_TABLE_FOOTER.pack(len(entries), 0, SEEKABLE_MAGIC)
+        dst.write(struct.pack('<II', SKIPPABLE_MAGIC, len(table)))
+        dst.write(table)
+        return dst.tell()
+
+
+class SeekableZstdReader(io.RawIOBase):
+    """Đọc file zstd seekable như file gốc: seek() tra frame index, read() chỉ giải nén frame cần thiết"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._load_seek_table()
+        except Exception:
+            self._file.close()
+            raise
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._position = 0
+        self._cached_index = None
+        self._cached_frame = b''
+
+    def _load_seek_table(self):
+        file_size = self._file.seek(0, os.SEEK_END)
+        self._file.seek(file_size - SEEK_TABLE_FOOTER.size)
+        frame_count, descriptor, magic = SEEK_TABLE_FOOTER.unpack(self._file.read(SEEK_TABLE_FOOTER.size))
+        if magic != SEEKABLE_MAGIC or descriptor & 0x80:
+            raise ValueError("Not a seekable zstd file (or checksums are not supported)")
+        table_size = frame_count * SEEK_TABLE_ENTRY.size
+        self._file.seek(file_size - SEEK_TABLE_FOOTER.size - table_size)
+        table = self._file.read(table_size)
+        # Vị trí bắt đầu của từng frame trong file nén và trong nội dung gốc
+        self._compressed_offsets = [0]
+        self._offsets = [0]
+        for compressed_size, size in SEEK_TABLE_ENTRY.iter_unpack(table):
+            self._compressed_offsets.append(self._compressed_offsets[-1] + compressed_size)
+            self._offsets.append(self._offsets[-1] + size)
+        self.size = self._offsets[-1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def _frame(self, index):
+        if index != self._cached_index:
+            start = self._compressed_offsets[index]
+            self._file.seek(start)
+            compressed = self._file.read(self._compressed_offsets[index + 1] - start)
+            self._cached_frame = self._decompressor.decompress(compressed)
+            self._cached_index = index
+        return self._cached_frame
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        index = bisect.bisect_right(self._offsets, self._position) - 1
+        frame = self._frame(index)
+        start = self._position - self._offsets[index]
+        count = min(len(buffer), len(frame) - start)
+        buffer[:count] = frame[start:start + count]
+        self._position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_stored(path):
+    """Mở nội dung gốc của file lưu tại path: file thường, hoặc path.zst nếu blob đã được nén.
+
+    File gốc chỉ bị xóa sau khi bản nén đã nằm đúng chỗ, nên thử file gốc trước rồi mới tới bản nén.
+    Trả về (file object nhị phân, kích thước nội dung gốc, mtime).
+    """
+    try:
+        f = open(path, 'rb')
+        stat = os.fstat(f.fileno())
+        return f, stat.st_size, stat.st_mtime
+    except FileNotFoundError:
+        compressed_path = f"{path}{ZSTD_SUFFIX}"
+        if zstandard is None or not os.path.exists(compressed_path):
+            raise
+    reader = SeekableZstdReader(compressed_path)
+    return io.BufferedReader(reader, buffer_size=FRAME_SIZE), reader.size, os.path.getmtime(compressed_path)
+
+
+def stored_exists(path):
+    return os.path.isfile(path) or os.path.isfile(f"{path}{ZSTD_SUFFIX}")
+
+
+class CompressionWorker:
+    """Nén blob trong pool thread nền (zstd nhả GIL): upload không phải chờ nén xong"""
+
+    def __init__(self, db, blob_store, workers=CODEC_WORKERS):
+        self.db = db
+        self.blob_store = blob_store
+        self.enabled = CODEC_ENABLED and workers > 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='blob-codec')
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.stored_raw = 0
+        self.failures = 0
+        self.saved_bytes = 0
+
+    def submit(self, sha256):
+        """Xếp blob vào hàng đợi nén (bỏ qua nếu đang chờ / tắt codec)"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if sha256 in self._pending:
+                return False
+            self._pending.add(sha256)
+        self._executor.submit(self._run, sha256)
+        return True
+
+    def sweep(self, limit=200):
+        """Job định kỳ: xếp hàng các blob chưa được đánh giá (upload lúc process dừng, dữ liệu trước khi có codec)"""
+        if not self.enabled:
+            return {'queued': 0}
+        queued = sum(1 for sha256 in self.db.get_uncoded_blobs(limit) if self.submit(sha256))
+        return {'queued': queued}
+
+    def _run(self, sha256):
+        try:
+            self.compress(sha256)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Blob compression failed for {sha256}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(sha256)
+
+    def compress(self, sha256):
+        """Nén một blob nếu mẫu thử cho tỉ lệ đủ cao; ghi codec và kích thước lưu vào bảng blobs"""
+        blob = self.db.get_blob(sha256)
+        if not blob or blob['codec'] is not None:
+            return None
+        # Blob có thể đã bị chuyển sang tầng lạnh (dữ liệu cũ trước khi bật codec): nén ngay tại tầng đó
+        source = self.blob_store.locate(blob['file_path'])
+        if not source.is_file():
+            # Mất file gốc: vẫn ghi 'none' để blob ra khỏi hàng đợi, không bị sweep thử lại mãi
+            logger.warning(f"Blob {sha256} not found at {source}, marking as stored raw")
+            self.db.set_blob_codec(sha256, 'none', blob['size'])
+            self.stored_raw += 1
+            return 'none'
+        if blob['size'] < CODEC_MIN_SIZE or estimate_ratio(source, blob['size']) < CODEC_MIN_RATIO:
+            self.db.set_blob_codec(sha256, 'none', blob['size'])
+            self.stored_raw += 1
+            return 'none'
+
+        compressed_path = source.with_name(source.name + ZSTD_SUFFIX)
+        if self.blob_store.is_cold(source):
+            # Tầng lạnh có thể nằm trên ổ khác: file tạm đặt cạnh đích để os.replace không phải đổi filesystem
+            partial_path = compressed_path.with_name(compressed_path.name + '.part')
+        else:
+            partial_path = self.blob_store.temp_dir / f"blob_{sha256}{ZSTD_SUFFIX}.part"
+        try:
+            stored_size = write_seekable(source, partial_path)
+            if stored_size >= blob['size']:
+                self.db.set_blob_codec(sha256, 'none', blob['size'])
+                self.stored_raw += 1
+                return 'none'
+            os.replace(partial_path, compressed_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+        if not self.db.set_blob_codec(sha256, 'zstd', stored_size):
+            # Blob vừa bị purge (hoặc đã được xử lý ở process khác)
+            if not self.db.get_blob(sha256):
+                compressed_path.unlink(missing_ok=True)
+            return None
+        # Người đọc luôn thử file gốc trước rồi tới bản .zst nên xóa file gốc lúc này là an toàn
+        source.unlink(missing_ok=True)
+        self.compressed += 1
+        self.saved_bytes += blob['size'] - stored_size
+        return 'zstd'
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'enabled': self.enabled,
+            'codec': STORAGE_CODEC if self.enabled else 'none',
+            'pending': pending,
+            'compressed': self.compressed,
+            'stored_raw': self.stored_raw,
+            'failures': self.failures,
+            'saved_bytes': self.saved_bytes
+        }
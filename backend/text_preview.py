@@ -0,0 +1,223 @@
+import os
+import csv
+import threading
+from collections import OrderedDict
+
+from derivatives import detect_text_encoding, TEXT_SAMPLE_SIZE
+
+# Preview file text / CSV theo trang: chi phí mỗi request không phụ thuộc kích thước file
+LINE_INDEX_STRIDE = int(os.environ.get('TEXT_PREVIEW_INDEX_STRIDE', 1000))
+TEXT_PREVIEW_CACHED_INDEXES = int(os.environ.get('TEXT_PREVIEW_CACHED_INDEXES', 256))
+DEFAULT_PREVIEW_LINES = 200
+MAX_PREVIEW_LINES = 1000
+DEFAULT_PREVIEW_BYTES = 64 * 1024
+MAX_PREVIEW_BYTES = 256 * 1024
+# Dòng dài hơn chừng này bị cắt trong preview
+MAX_LINE_BYTES = 16 * 1024
+SCAN_CHUNK_SIZE = 1024 * 1024
+CSV_EXTENSIONS = {'.csv': ',', '.tsv': '\t'}
+# Encoding mà byte '\n' luôn là xuống dòng (UTF-16/32 thì không) -> mới đánh index theo dòng được
+LINE_INDEXABLE_ENCODINGS = {'utf-8', 'utf-8-sig', 'cp1258'}
+
+
+class LineIndex:
+    """Chỉ mục thưa: vị trí byte của dòng 0, STRIDE, 2*STRIDE, ... Được mở rộng dần tới dòng cần đọc,
+    nên trang đầu của file 2GB không phải quét cả file"""
+
+    def __init__(self, encoding, stride=LINE_INDEX_STRIDE):
+        self.encoding = encoding
+        self.stride = stride
+        self.checkpoints = [3 if encoding == 'utf-8-sig' else 0]
+        self.scanned_lines = 0
+        self.scanned_to = self.checkpoints[0]
+        self.complete = False
+        self.ends_with_newline = False
+        self.lock = threading.Lock()
+
+    @property
+    def total_lines(self):
+        return self.scanned_lines if self.complete else None
+
+    def extend_to(self, reader, line):
+        """Quét tiếp (từ chỗ đã dừng) tới khi có checkpoint cho `line` hoặc hết file"""
+        needed = line // self.stride
+        if self.complete or len(self.checkpoints) > needed:
+            return
+        reader.seek(self.scanned_to)
+        until_checkpoint = self.stride - self.scanned_lines % self.stride
+        while len(self.checkpoints) <= needed:
+            chunk = reader.read(SCAN_CHUNK_SIZE)
+            if not chunk:
+                # Dòng cuối không có '\n' vẫn là một dòng
+                if self.scanned_to > self.checkpoints[0] and not self.ends_with_newline:
+                    self.scanned_lines += 1
+                self.complete = True
+                return
+            self.ends_with_newline = chunk.endswith(b'\n')
+            newlines = chunk.count(b'\n')
+            position = 0
+            # Chỉ tách chuỗi (ở C) trong các chunk có checkpoint, còn lại chỉ đếm
+            while newlines >= until_checkpoint:
+                rest = chunk[position:].split(b'\n', until_checkpoint)[-1]
+                position = len(chunk) - len(rest)
+                newlines -= until_checkpoint
+                self.scanned_lines += until_checkpoint
+                self.checkpoints.append(self.scanned_to + position)
+                until_checkpoint = self.stride
+            self.scanned_lines += newlines
+            until_checkpoint -= newlines
+            self.scanned_to += len(chunk)
+
+    def seek_line(self, reader, line):
+        """Đặt reader ở đầu dòng `line`. Trả về False nếu file có ít dòng hơn"""
+        self.extend_to(reader, line)
+        checkpoint = min(line // self.stride, len(self.checkpoints) - 1)
+        reader.seek(self.checkpoints[checkpoint])
+        for _ in range(line - checkpoint * self.stride):
+            if not _skip_line(reader):
+                return False
+        return True
+
+
+def _skip_line(reader):
+    while True:
+        chunk = reader.readline(SCAN_CHUNK_SIZE)
+        if not chunk:
+            return False
+        if chunk.endswith(b'\n'):
+            return True
+
+
+def _read_line(reader):
+    """Một dòng (bỏ ký tự xuống dòng), cắt ở MAX_LINE_BYTES. Trả về (bytes, bị cắt) hoặc (None, False) khi hết file"""
+    line = reader.readline(MAX_LINE_BYTES)
+    if not line:
+        return None, False
+    truncated = not line.endswith(b'\n') and len(line) >= MAX_LINE_BYTES
+    if truncated:
+        _skip_line(reader)
+    return line.rstrip(b'\r\n'), truncated
+
+
+class TextPreview:
+    """Đọc cửa sổ dòng / byte / trang CSV của file text; LineIndex của các file gần đây được giữ trong bộ nhớ"""
+
+    def __init__(self, max_indexes=TEXT_PREVIEW_CACHED_INDEXES):
+        self.max_indexes = max_indexes
+        self._indexes = OrderedDict()  # key nội dung -> LineIndex
+        self._lock = threading.Lock()
+        self.index_hits = 0
+        self.index_builds = 0
+
+    def _index(self, key, reader):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                self.index_hits += 1
+                return index
+        reader.seek(0)
+        index = LineIndex(detect_text_encoding(reader.read(TEXT_SAMPLE_SIZE)))
+        with self._lock:
+            index = self._indexes.setdefault(key, index)
+            self._indexes.move_to_end(key)
+            self.index_builds += 1
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def discard(self, key):
+        with self._lock:
+            self._indexes.pop(key, None)
+
+    def read_bytes(self, key, reader, size, offset, length):
+        """Cửa sổ theo byte (dùng được cho mọi encoding)"""
+        index = self._index(key, reader)
+        length = max(1, min(length, MAX_PREVIEW_BYTES))
+        offset = max(0, min(offset, size))
+        reader.seek(offset)
+        data = reader.read(length)
+        end = offset + len(data)
+        return {
+            'mode': 'bytes',
+            'encoding': index.encoding,
+            'offset': offset,
+            'length': len(data),
+            'size': size,
+            'text': data.decode(index.encoding, errors='replace'),
+            'next_offset': end if end < size else None
+        }
+
+    def _lines(self, index, reader, start, count):
+        lines, truncated = [], []
+        with index.lock:
+            found = index.seek_line(reader, start)
+            while found and len(lines) < count:
+                line, cut = _read_line(reader)
+                if line is None:
+                    break
+                if cut:
+                    truncated.append(start + len(lines))
+                lines.append(line.decode(index.encoding, errors='replace'))
+            eof = not reader.peek(1) if hasattr(reader, 'peek') else not reader.read(1)
+            total_lines = index.total_lines
+            if total_lines is None and found and eof:
+                # Đọc tới cuối file thì biết luôn số dòng mà không cần quét hết
+                total_lines = start + len(lines)
+        return lines, truncated, eof, total_lines
+
+    def read_lines(self, key, reader, start, count):
+        """Cửa sổ theo dòng: start (từ 0), count dòng"""
+        index = self._index(key, reader)
+        if index.encoding not in LINE_INDEXABLE_ENCODINGS:
+            raise ValueError(f"Line mode is not supported for {index.encoding} files, use mode=bytes")
+        start = max(0, start)
+        count = max(1, min(count, MAX_PREVIEW_LINES))
+        lines, truncated, eof, total_lines = self._lines(index, reader, start, count)
+        return {
+            'mode': 'lines',
+            'encoding': index.encoding,
+            'start': start,
+            'lines': lines,
+            'truncated_lines': truncated,
+            'next_start': None if eof else start + len(lines),
+            'total_lines': total_lines
+        }
+
+    def read_csv(self, key, reader, extension, start, count):
+        """Trang CSV: tên cột (dòng đầu) + count hàng dữ liệu bắt đầu từ hàng start (từ 0, không tính header).
+        Ô có xuống dòng bên trong dấu nháy bị tách theo dòng vật lý"""
+        index = self._index(key, reader)
+        if index.encoding not in LINE_INDEXABLE_ENCODINGS:
+            raise ValueError(f"CSV preview is not supported for {index.encoding} files, use mode=bytes")
+        start = max(0, start)
+        count = max(1, min(count, MAX_PREVIEW_LINES))
+        header, _, _, _ = self._lines(index, reader, 0, 1)
+        lines, truncated, eof, total_lines = self._lines(index, reader, start + 1, count)
+        delimiter = CSV_EXTENSIONS.get(extension, ',')
+        if header and extension != '.tsv':
+            try:
+                delimiter = csv.Sniffer().sniff(header[0], delimiters=',;\t|').delimiter
+            except csv.Error:
+                pass
+        columns = next(csv.reader(header, delimiter=delimiter), [])
+        return {
+            'mode': 'csv',
+            'encoding': index.encoding,
+            'delimiter': delimiter,
+            'columns': columns,
+            'start': start,
+            'rows': list(csv.reader(lines, delimiter=delimiter)),
+            'truncated_rows': [line - 1 for line in truncated],
+            'next_start': None if eof else start + len(lines),
+            'total_rows': total_lines - 1 if total_lines else None
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached_indexes': len(self._indexes),
+                'max_indexes': self.max_indexes,
+                'index_hits': self.index_hits,
+                'index_builds': self.index_builds
+            }
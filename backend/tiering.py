@@ -0,0 +1,180 @@
+import os
+import threading
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from database import get_vietnam_time, vietnam_now_isoformat
+
+logger = logging.getLogger(__name__)
+
+# Tầng lạnh: thư mục thứ hai (ổ chậm / rẻ hơn), cùng cấu trúc blobs/<aa>/<bb>/<tên> với UPLOAD_FOLDER
+TIERING_ENABLED = os.environ.get('TIERING_ENABLED', '1') != '0'
+COLD_AFTER_DAYS = float(os.environ.get('COLD_AFTER_DAYS', 14))
+TIERING_BATCH_SIZE = int(os.environ.get('TIERING_BATCH_SIZE', 200))
+# Lượt truy cập gom trong bộ nhớ, ghi DB một lần mỗi khi đủ chừng này file (hoặc theo job định kỳ)
+ACCESS_FLUSH_THRESHOLD = int(os.environ.get('ACCESS_FLUSH_THRESHOLD', 500))
+
+
+class AccessTracker:
+    """Đếm lượt đọc file trong bộ nhớ, ghi vào files.db theo lô thay vì một lệnh UPDATE mỗi lần download"""
+
+    def __init__(self, db, flush_threshold=ACCESS_FLUSH_THRESHOLD):
+        self.db = db
+        self.flush_threshold = flush_threshold
+        self._pending = {}  # file_id -> [số lượt, lần truy cập cuối]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def record(self, file_id):
+        now = vietnam_now_isoformat()
+        with self._lock:
+            entry = self._pending.get(file_id)
+            if entry:
+                entry[0] += 1
+                entry[1] = now
+            else:
+                self._pending[file_id] = [1, now]
+            self.recorded += 1
+            full = len(self._pending) >= self.flush_threshold
+        if full and self._flush_lock.acquire(blocking=False):
+            # Request đầu tiên thấy đầy thì ghi; các request khác không chờ
+            try:
+                self._flush_locked()
+            finally:
+                self._flush_lock.release()
+
+    def flush(self):
+        """Ghi các lượt truy cập đang gom vào DB (job định kỳ). Trả về số file được cập nhật"""
+        with self._flush_lock:
+            return self._flush_locked()
+
+    def _flush_locked(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            updated = self.db.record_file_accesses(
+                [(file_id, count, last_accessed_at) for file_id, (count, last_accessed_at) in pending.items()]
+            )
+        except Exception:
+            # Trả lại lô chưa ghi được để lần sau thử lại
+            with self._lock:
+                for file_id, (count, last_accessed_at) in pending.items():
+                    entry = self._pending.setdefault(file_id, [0, last_accessed_at])
+                    entry[0] += count
+                    entry[1] = max(entry[1], last_accessed_at)
+            raise
+        self.flushes += 1
+        self.flushed_rows += updated
+        return updated
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'recorded': self.recorded,
+            'pending_files': pending,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'flush_threshold': self.flush_threshold
+        }
+
+
+class StorageTiering:
+    """Chuyển blob lâu không được đọc sang tầng lạnh và đưa về tầng nóng khi có người đọc lại.
+
+    Vị trí thực của blob do filesystem quyết định (BlobStore.locate thử tầng nóng rồi tầng lạnh), cột
+    files.storage_tier chỉ để chọn ứng viên và thống kê. Khi chuyển tầng, bản mới được đặt xong rồi
+    bản cũ mới bị xóa nên người đọc luôn tìm thấy blob ở một trong hai tầng.
+    """
+
+    def __init__(self, db, blob_store, access_tracker, cold_after_days=COLD_AFTER_DAYS,
+                 batch_size=TIERING_BATCH_SIZE, enabled=TIERING_ENABLED):
+        self.db = db
+        self.blob_store = blob_store
+        self.access_tracker = access_tracker
+        self.cold_after = timedelta(days=cold_after_days)
+        self.batch_size = batch_size
+        self.enabled = enabled and blob_store.cold_root is not None
+        # Một thread là đủ: promote chỉ xảy ra khi file lạnh được đọc lại
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tier-promote')
+        self._promoting = set()
+        self._lock = threading.Lock()
+        self.demoted = 0
+        self.demoted_bytes = 0
+        self.promoted = 0
+        self.promoted_bytes = 0
+        self.failures = 0
+
+    def demote_cold_files(self):
+        """Job định kỳ: chuyển blob không được đọc trong cold_after_days sang tầng lạnh"""
+        if not self.enabled:
+            return {'demoted': 0}
+        # Lượt đọc còn nằm trong bộ nhớ cũng phải tính
+        self.access_tracker.flush()
+        cutoff = (get_vietnam_time() - self.cold_after).isoformat()
+        demoted = skipped = moved_bytes = 0
+        for candidate in self.db.get_tiering_candidates(cutoff, self.batch_size):
+            relative_path = candidate['file_path']
+            # Blob dùng chung (nội dung trùng / khôi phục từ thùng rác): còn file khác vừa được đọc thì giữ lại
+            if self.db.is_path_recently_accessed(relative_path, cutoff):
+                skipped += 1
+                continue
+            try:
+                moved_bytes += self.blob_store.move_to_tier(relative_path, cold=True)
+            except OSError as e:
+                self.failures += 1
+                logger.warning(f"Failed to demote {relative_path}: {e}")
+                continue
+            self.db.set_storage_tier(relative_path, 'cold')
+            demoted += 1
+        self.demoted += demoted
+        self.demoted_bytes += moved_bytes
+        if demoted:
+            logger.info(f"🧊 Moved {demoted} cold blobs ({moved_bytes} bytes) to {self.blob_store.cold_root}")
+        return {'demoted': demoted, 'kept_shared': skipped, 'moved_bytes': moved_bytes}
+
+    def promote(self, relative_path):
+        """Đưa blob về tầng nóng trong nền (gọi sau khi đã mở file để phục vụ request hiện tại)"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if relative_path in self._promoting:
+                return False
+            self._promoting.add(relative_path)
+        self._executor.submit(self._promote, relative_path)
+        return True
+
+    def _promote(self, relative_path):
+        try:
+            moved_bytes = self.blob_store.move_to_tier(relative_path, cold=False)
+            self.db.set_storage_tier(relative_path, 'hot')
+            self.promoted += 1
+            self.promoted_bytes += moved_bytes
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Failed to promote {relative_path}: {e}")
+        finally:
+            with self._lock:
+                self._promoting.discard(relative_path)
+
+    def stats(self):
+        with self._lock:
+            promoting = len(self._promoting)
+        return {
+            'enabled': self.enabled,
+            'cold_root': str(self.blob_store.cold_root) if self.blob_store.cold_root else None,
+            'cold_after_days': self.cold_after.total_seconds() / 86400,
+            'demoted': self.demoted,
+            'demoted_bytes': self.demoted_bytes,
+            'promoted': self.promoted,
+            'promoted_bytes': self.promoted_bytes,
+            'promoting': promoting,
+            'failures': self.failures,
+            'access': self.access_tracker.stats()
+        }
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Tracing nhẹ theo từng lượt truyền file: mỗi upload là một trace gồm các span (start, lô chunk,
+local complete, relay lên file manager, đăng ký vào DB...). Span đã kết thúc được ghi thành một dòng
+JSON vào file xoay vòng traces-<service>.jsonl (mỗi process một file vì RotatingFileHandler không an
+toàn khi nhiều process cùng ghi).
+
+Trace context đi từ gateway sang /api/upload qua header `traceparent` (định dạng W3C Trace Context).
+
+Xem đường găng (critical path) của các trace:
+    python tracing.py summarize [logs/traces-*.jsonl ...] [--trace <trace_id>] [--slowest 10]
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import secrets
+import logging
+import argparse
+from collections import defaultdict
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '1') != '0'
+TRACE_DIR = Path(os.environ.get('TRACE_DIR', Path(__file__).parent / "logs"))
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 20 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', 5))
+# Số chunk gom vào một span chunk_batch (một span mỗi chunk thì file trace to hơn cả dữ liệu đo được)
+TRACE_CHUNK_BATCH = int(os.environ.get('TRACE_CHUNK_BATCH', 64))
+TRACE_HEADER = 'traceparent'
+
+
+class Span:
+    """Một đoạn thời gian trong trace; end() ghi span ra file (chỉ lần đầu)"""
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'start', 'attrs', 'ended')
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, start=None, attrs=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.attrs = attrs or {}
+        self.ended = False
+
+    def child(self, name, start=None, **attrs):
+        return Span(self.tracer, name, self.trace_id, self.span_id, start, attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, end=None, **attrs):
+        if self.ended:
+            return
+        self.ended = True
+        self.attrs.update(attrs)
+        end = time.time() if end is None else end
+        self.tracer.write({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'service': self.tracer.service,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': round((end - self.start) * 1000, 3),
+            'attrs': self.attrs
+        })
+
+    def header(self):
+        """Giá trị header traceparent để span ở process khác nhận span này làm cha"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attrs['error'] = str(exc)
+        self.end()
+
+
+class Tracer:
+    """Tạo span và ghi span đã kết thúc ra traces-<service>.jsonl (mở file ở lần ghi đầu tiên)"""
+
+    def __init__(self, service, trace_dir=TRACE_DIR, enabled=TRACE_ENABLED):
+        self.service = service
+        self.path = Path(trace_dir) / f"traces-{service}.jsonl"
+        self.enabled = enabled
+        self._logger = None
+
+    def start_span(self, name, start=None, **attrs):
+        """Span gốc của một trace mới"""
+        return Span(self, name, secrets.token_hex(16), None, start, attrs)
+
+    def from_header(self, name, header_value, **attrs):
+        """Span nối vào trace của process gọi tới (header traceparent); header thiếu / sai thì mở trace mới"""
+        parts = (header_value or '').split('-')
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            return Span(self, name, parts[1], parts[2], None, attrs)
+        return self.start_span(name, **attrs)
+
+    def write(self, record):
+        if not self.enabled:
+            return
+        if self._logger is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT,
+                                          encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            trace_logger = logging.getLogger(f"trace.{self.service}")
+            trace_logger.propagate = False
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.handlers = [handler]
+            self._logger = trace_logger
+        self._logger.info(json.dumps(record, ensure_ascii=False))
+
+
+# ---------------------------------------------------------------------------
+# CLI: tóm tắt đường găng
+# ---------------------------------------------------------------------------
+
+def load_spans(paths):
+    """Đọc span từ các file JSONL (kể cả bản đã xoay vòng .1, .2...), gom theo trace_id"""
+    traces = defaultdict(list)
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) + sorted(glob.glob(f"{pattern}.[0-9]*")):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    span['end'] = span['start'] + span['duration_ms'] / 1000
+                    traces[span['trace_id']].append(span)
+    return traces
+
+
+def critical_path(span, children):
+    """Đường găng của span: đi ngược từ lúc span kết thúc, mỗi bước chọn span con kết thúc muộn nhất trước
+    thời điểm hiện tại. Khoảng không có span con nào được tính cho chính span đó (self time).
+    Trả về danh sách (tên span, giây) theo thứ tự thời gian."""
+    path = []
+    cursor = span['end']
+    remaining = sorted(children.get(span['span_id'], []), key=lambda s: s['end'])
+    while remaining:
+        candidates = [s for s in remaining if s['end'] <= cursor + 1e-6]
+        if not candidates:
+            break
+        last = candidates[-1]
+        remaining = [s for s in remaining if s['end'] < last['start'] + 1e-6]
+        if cursor > last['end']:
+            path.append((span['name'], cursor - last['end']))
+        path.extend(reversed(critical_path(last, children)))
+        cursor = min(cursor, last['start'])
+    if cursor > span['start']:
+        path.append((span['name'], cursor - span['start']))
+    path.reverse()
+    return path
+
+
+def summarize_trace(spans):
+    children = defaultdict(list)
+    ids = {span['span_id'] for span in spans}
+    roots = []
+    for span in spans:
+        if span['parent_id'] in ids:
+            children[span['parent_id']].append(span)
+        else:
+            roots.append(span)
+    root = max(roots, key=lambda s: s['duration_ms'])
+    breakdown = defaultdict(float)
+    for name, seconds in critical_path(root, children):
+        breakdown[name] += seconds
+    return root, breakdown
+
+
+def print_breakdown(breakdown, total):
+    for name, seconds in sorted(breakdown.items(), key=lambda item: -item[1]):
+        share = 100 * seconds / total if total else 0
+        print(f"    {name:<32} {seconds * 1000:>12.1f} ms  {share:5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the critical path of transfer traces")
+    sub = parser.add_subparsers(dest='command', required=True)
+    summarize = sub.add_parser('summarize', help='Critical path of the slowest traces and overall')
+    summarize.add_argument('paths', nargs='*', default=[str(TRACE_DIR / 'traces-*.jsonl')])
+    summarize.add_argument('--trace', help='Only this trace_id')
+    summarize.add_argument('--slowest', type=int, default=10, help='Number of slowest traces to show')
+    args = parser.parse_args()
+
+    traces = load_spans(args.paths)
+    if args.trace:
+        traces = {args.trace: traces.get(args.trace, [])}
+    traces = {trace_id: spans for trace_id, spans in traces.items() if spans}
+    if not traces:
+        print("No traces found")
+        return 1
+
+    summaries = [(trace_id, *summarize_trace(spans)) for trace_id, spans in traces.items()]
+    summaries.sort(key=lambda item: -item[1]['duration_ms'])
+    overall = defaultdict(float)
+    for _, root, breakdown in summaries:
+        for name, seconds in breakdown.items():
+            overall[name] += seconds
+
+    for trace_id, root, breakdown in summaries[:args.slowest]:
+        attrs = root.get('attrs', {})
+        print(f"{trace_id}  {root['name']}  {root['duration_ms']:.1f} ms  "
+              f"file={attrs.get('file_name')} size={attrs.get('file_size')} status={attrs.get('status')}")
+        print_breakdown(breakdown, root['duration_ms'] / 1000)
+    if len(summaries) > 1:
+        total = sum(root['duration_ms'] for _, root, _ in summaries) / 1000
+        print(f"\nCritical path over {len(summaries)} traces ({total:.1f} s total):")
+        print_breakdown(overall, total)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
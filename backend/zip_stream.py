@@ -0,0 +1,95 @@
+import os
+import time
+import zipfile
+import logging
+
+from storage_codec import open_stored
+
+logger = logging.getLogger(__name__)
+
+# Kích thước mỗi lần đọc file nguồn khi ghi vào archive
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+COMPRESSION_TYPES = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+
+class _StreamBuffer:
+    """File-like chỉ ghi, không seek được - zipfile sẽ tự dùng data descriptor.
+
+    Dữ liệu được lấy ra ngay sau mỗi lần ghi nên bộ nhớ không tăng theo kích thước archive.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks = self._chunks
+        self._chunks = []
+        return chunks
+
+
+def unique_arcname(arcname, used_names):
+    """Tránh trùng tên trong archive bằng hậu tố ' (n)'"""
+    if arcname not in used_names:
+        used_names.add(arcname)
+        return arcname
+
+    directory, name = os.path.split(arcname)
+    stem, ext = os.path.splitext(name)
+    counter = 1
+    while True:
+        candidate = f"{stem} ({counter}){ext}"
+        if directory:
+            candidate = f"{directory}/{candidate}"
+        if candidate not in used_names:
+            used_names.add(candidate)
+            return candidate
+        counter += 1
+
+
+def stream_zip(entries, compression='store', chunk_size=CHUNK_SIZE):
+    """Sinh từng đoạn bytes của file ZIP từ danh sách (arcname, đường dẫn trên disk).
+
+    Không ghi file tạm; ZIP64 được bật tự động khi file hoặc archive vượt giới hạn 4GB.
+    """
+    compress_type = COMPRESSION_TYPES.get(compression, zipfile.ZIP_STORED)
+    buffer = _StreamBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', compression=compress_type, allowZip64=True) as zf:
+        for arcname, path in entries:
+            try:
+                # File có thể đã được nén khi lưu (storage_codec): đọc ra nội dung gốc
+                src, size, mtime = open_stored(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping missing file in archive: {arcname} ({e})")
+                continue
+
+            # ZIP không hỗ trợ timestamp trước 1980
+            date_time = time.localtime(max(mtime, 315532800))[:6]
+            zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+            zinfo.compress_type = compress_type
+            zinfo.external_attr = 0o644 << 16
+            # Biết trước kích thước để zipfile quyết định có cần ZIP64 cho entry này không
+            zinfo.file_size = size
+
+            with src, zf.open(zinfo, 'w') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+
+    # Central directory được ghi khi đóng ZipFile
+    yield from buffer.drain()
@@ -218,7 +218,8 @@ class FlexTransferHub {
       });
 
       if (response.ok) {
-        const files = await response.json();
+        // API trả về trang mới nhất trước (sort created_at desc)
+        const { files } = await response.json();
 
         // Only show files from last 2 hours
         const twoHoursAgo = Date.now() - 2 * 60 * 60 * 1000;
@@ -746,6 +747,14 @@ class FlexTransferHub {
           console.warn("Received start-ack for unknown transfer:", fileId);
           return;
         }
+        // Server từ chối ngay khi bắt đầu (vượt hạn mức / hết dung lượng) -> không gửi chunk nào
+        if (msg.status === "rejected") {
+          transfer.status = "error";
+          this.showNotification(msg.error || "Không đủ dung lượng lưu trữ", "error");
+          this.renderTransfers();
+          this.maybeStartNextUploads();
+          return;
+        }
         // Only set to active if not already active (for safety)
         if (transfer.status !== "active") {
           transfer.status = "active";